@@ -0,0 +1,66 @@
+""" Benchmarks of qb.backup, run from the root of the repository, e.g.
+`python3 -m benchmarks.backup`. Results are appended as JSON lines to
+benchmarks/results/, so that versions can be compared.
+"""
+
+import json
+from pathlib import Path
+import platform
+import subprocess
+import time
+
+
+ROOT = Path(__file__).resolve().parent
+RESULTS = ROOT / "results"
+
+
+def version():
+    """ Version of the benchmarked tree, as given by git. """
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=str(ROOT),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def previous(path, params):
+    """ Last recorded result with the same parameters, if any. """
+    last = None
+    try:
+        with open(path) as fd:
+            for line in fd:
+                record = json.loads(line)
+                if record["params"] == params:
+                    last = record
+    except FileNotFoundError:
+        pass
+    return last
+
+
+def record(path, params, metrics, tree=None):
+    """ Append the metrics of a benchmark run with params to path. """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    entry = {
+        "version": tree or version(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "params": params,
+        "metrics": metrics,
+    }
+    with open(path, "a") as fd:
+        fd.write(json.dumps(entry) + "\n")
+
+
+def compare(metrics, last, key):
+    """ Relative change of a metric since the last result, as a string. """
+    if last is None or not last["metrics"].get(key):
+        return ""
+    return " ({:+.1%} vs {})".format(
+        metrics[key] / last["metrics"][key] - 1, last["version"]
+    )
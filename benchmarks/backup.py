@@ -0,0 +1,294 @@
+""" Benchmark of the orchestration of backups over large fleets.
+
+Backuper runs over a synthetic fleet with a fake ssh first on PATH (see
+benchmarks/fakessh/ssh), which behaves as planned for each host: duration drawn from
+a log-normal distribution, output volume, exit code, hang until the timeout, and a
+share of hosts contending for the same lock. Each fleet size is run in its own
+process, so that its peak RSS is its own.
+
+Reported per fleet size:
+ - wall time, and overhead over the ideal makespan of the planned durations
+ - CPU of the orchestrator, user and system, and of the fake ssh processes
+ - peak RSS of the orchestrator
+ - time spent in the logging handlers, mails being sent to a null SMTP server
+
+Results are appended as JSON lines to benchmarks/results/backup.jsonl, tagged with
+the version of the tree, and compared with the previous result of the same
+parameters:
+
+    $ python3 -m benchmarks.backup --hosts 10 1000 10000 --workers 64 --compare
+
+"""
+
+import argparse
+import heapq
+import json
+import logging
+import logging.config
+import os
+from pathlib import Path
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import RESULTS, ROOT, compare, previous, record, version
+
+
+FAKESSH = ROOT / "fakessh"
+
+
+def plan(params):
+    """ Plan the behaviour of the fake ssh for each host of the fleet.
+
+    :returns: a dict hostname -> (duration, lines, bytes, returncode), duration
+        being "hang" for hosts which never end
+    """
+    rng = random.Random(params["seed"])
+    fleet = {}
+    for i in range(params["hosts"]):
+        hostname = "host{:05d}.bench".format(i)
+        if rng.random() < params["hang"]:
+            duration = "hang"
+        else:
+            duration = rng.lognormvariate(0, params["sigma"]) * params["median"]
+            duration = round(duration, 3)
+        lines = int(rng.expovariate(1 / params["lines"])) if params["lines"] else 0
+        rc = 2 if rng.random() < params["failure"] else 0
+        fleet[hostname] = (duration, lines, params["line_bytes"], rc)
+    return fleet
+
+
+def ideal_makespan(durations, workers, timeout):
+    """ Makespan of the planned durations on the workers, without any overhead nor
+    lock contention, the hosts being started in order as soon as a worker is free.
+    """
+    ends = [0.0] * min(workers, len(durations) or 1)
+    for duration in durations:
+        start = heapq.heappop(ends)
+        heapq.heappush(ends, start + (timeout if duration == "hang" else duration))
+    return max(ends)
+
+
+class NullSMTP:
+    """ Stand-in for smtplib.SMTP, which discards mails. """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def sendmail(self, fromaddr, toaddrs, msg):
+        pass
+
+
+def instrument_handlers(cost):
+    """ Accumulate in cost[name] the time spent in each configured handler. """
+    for name, handler in logging._handlers.items():
+
+        def timed(method, name=name):
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    cost[name] = cost.get(name, 0) + time.perf_counter() - start
+
+            return wrapper
+
+        handler.handle = timed(handler.handle)
+        handler.flush = timed(handler.flush)
+
+
+def run_scenario(params, tmp):
+    """ Run a scenario in the current process. """
+    import qb.backup.logging
+    from qb.backup import Backuper, Config
+
+    fleet = plan(params)
+    plans = tmp / "plan"
+    plans.mkdir()
+    for hostname, behaviour in fleet.items():
+        (plans / hostname).write_text(" ".join(map(str, behaviour)) + "\n")
+    os.environ["FAKE_SSH_PLAN"] = str(plans)
+    os.environ["PATH"] = str(FAKESSH) + os.pathsep + os.environ["PATH"]
+
+    contended = str(tmp / "contended.lock")
+    rng = random.Random(params["seed"])
+    hosts = []
+    for hostname in fleet:
+        host = {"hostname": hostname}
+        if rng.random() < params["contention"]:
+            host["lock"] = contended
+        hosts.append(host)
+    conf = {
+        "default": {"lock": str(tmp / "{}.lock")},
+        "hosts": hosts,
+        "logging": {
+            "filename": str(tmp / "backup.log"),
+            "mail": {
+                "mailhost": ["localhost", 25],
+                "fromaddr": "bench@localhost",
+                "toaddrs": ["bench@localhost"],
+            },
+        },
+    }
+    qb.backup.logging.SMTP = NullSMTP
+
+    start = time.monotonic()
+    config = Config(conf)
+    logging.config.dictConfig(config.logging)
+    cost = {}
+    instrument_handlers(cost)
+    setup = time.monotonic() - start
+
+    Backuper.timeout = params["timeout"]
+    backuper = Backuper(
+        config.hosts,
+        workers=params["workers"],
+        lock_timeout=params["timeout"],
+    )
+    start = time.monotonic()
+    backuper.run()
+    logging.shutdown()
+    wall = time.monotonic() - start
+
+    this = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    ideal = ideal_makespan(
+        [d for d, *_ in fleet.values()], params["workers"], params["timeout"]
+    )
+    return {
+        "setup": setup,
+        "wall": wall,
+        "ideal": ideal,
+        "overhead": wall - ideal,
+        "cpu_user": this.ru_utime,
+        "cpu_system": this.ru_stime,
+        "cpu_ssh": children.ru_utime + children.ru_stime,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss": this.ru_maxrss * 1024,
+        "handlers": cost,
+        "handlers_total": sum(cost.values()),
+        "summary": {
+            k: backuper.summary[k] for k in ("SUCCEEDED", "FAILED", "SKIPPED", "TOTAL")
+        },
+    }
+
+
+def run(params):
+    """ Run a scenario in a child process and return its metrics. """
+    with tempfile.TemporaryDirectory(prefix="qb.backup.bench.") as tmp:
+        output = Path(tmp) / "metrics.json"
+        subprocess.run(
+            [sys.executable, "-m", "benchmarks.backup", "--child", json.dumps(params)],
+            cwd=str(ROOT.parent),
+            env=dict(os.environ, BENCH_TMP=tmp),
+            # The console handler writes every log line to stdout
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+        return json.loads(output.read_text())
+
+
+def report(params, metrics, last=None):
+    def change(key):
+        return compare(metrics, last, key)
+
+    print("{hosts} hosts, {workers} workers".format(**params))
+    print("  wall      {:10.3f}s{}".format(metrics["wall"], change("wall")))
+    print("  ideal     {:10.3f}s".format(metrics["ideal"]))
+    print("  overhead  {:10.3f}s{}".format(metrics["overhead"], change("overhead")))
+    print("  CPU user  {:10.3f}s{}".format(metrics["cpu_user"], change("cpu_user")))
+    print("  CPU sys   {:10.3f}s{}".format(metrics["cpu_system"], change("cpu_system")))
+    print("  CPU ssh   {:10.3f}s".format(metrics["cpu_ssh"]))
+    print(
+        "  peak RSS  {:10.1f}MB{}".format(
+            metrics["peak_rss"] / 2 ** 20, change("peak_rss")
+        )
+    )
+    print(
+        "  handlers  {:10.3f}s{}".format(
+            metrics["handlers_total"], change("handlers_total")
+        )
+    )
+    for name, cost in sorted(metrics["handlers"].items()):
+        print("    {:<12}{:9.3f}s".format(name, cost))
+    print("  results   {}".format(metrics["summary"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the orchestration of backups with a fake ssh"
+    )
+    parser.add_argument("--hosts", type=int, nargs="+", default=[10, 1000])
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument(
+        "--median", type=float, default=0.05, help="median duration of a backup (s)"
+    )
+    parser.add_argument(
+        "--sigma", type=float, default=0.5, help="spread of the log-normal durations"
+    )
+    parser.add_argument(
+        "--lines", type=int, default=20, help="mean number of lines of output"
+    )
+    parser.add_argument("--line-bytes", type=int, default=80)
+    parser.add_argument(
+        "--failure", type=float, default=0.02, help="share of failing hosts"
+    )
+    parser.add_argument(
+        "--hang", type=float, default=0.001, help="share of hosts never ending"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=2, help="timeout of a backup (s)"
+    )
+    parser.add_argument(
+        "--contention",
+        type=float,
+        default=0.01,
+        help="share of hosts sharing the same lock",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, default=RESULTS / "backup.jsonl")
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="compare with the previous result of the same parameters",
+    )
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        tmp = Path(os.environ["BENCH_TMP"])
+        metrics = run_scenario(json.loads(args.child), tmp)
+        (tmp / "metrics.json").write_text(json.dumps(metrics))
+        return
+
+    tree = version()
+    for hosts in args.hosts:
+        params = {
+            "hosts": hosts,
+            "workers": args.workers,
+            "median": args.median,
+            "sigma": args.sigma,
+            "lines": args.lines,
+            "line_bytes": args.line_bytes,
+            "failure": args.failure,
+            "hang": args.hang,
+            "timeout": args.timeout,
+            "contention": args.contention,
+            "seed": args.seed,
+        }
+        metrics = run(params)
+        report(params, metrics, previous(args.output, params) if args.compare else None)
+        record(args.output, params, metrics, tree)
+
+
+if __name__ == "__main__":
+    main()
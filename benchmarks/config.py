@@ -0,0 +1,277 @@
+""" Benchmark of the loading of the configuration and of the startup of main.py.
+
+A synthetic configuration is generated: a main file including hosts files spread
+over directories with a nested glob (hosts/*/*.yml), default settings included
+from several mappings, and a logging configuration extended with many loggers and
+handlers. The steps of the startup path are then timed:
+ - Config.load, without cache, with a cache of the included files and from a
+   compiled configuration
+ - IncludeLoader.merge of the included documents, hosts and mappings
+ - Config._init_hosts
+ - logging.config.dictConfig
+ - `python3 main.py run --help`, and the import time of its modules
+
+Results are appended as JSON lines to benchmarks/results/config.jsonl, tagged with
+the version of the tree:
+
+    $ python3 -m benchmarks.config --files 10 100 1000 --hosts-per-file 20 --compare
+
+"""
+
+import argparse
+import copy
+import logging
+import logging.config
+from pathlib import Path
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+
+from . import RESULTS, ROOT, compare, previous, record, version
+
+
+def generate(tmp, params):
+    """ Write a synthetic configuration in tmp.
+
+    :returns: path of the main configuration file
+    """
+    rng = random.Random(params["seed"])
+    tags = ["web", "db", "prod", "dev", "paris", "lyon", "cache", "batch"]
+    hosts = tmp / "hosts"
+    for i in range(params["files"]):
+        directory = hosts / "team{:03d}".format(i % params["directories"])
+        directory.mkdir(parents=True, exist_ok=True)
+        lines = ["---"]
+        for j in range(params["hosts_per_file"]):
+            hostname = "host{:05d}-{:03d}.bench".format(i, j)
+            kind = rng.random()
+            if kind < 0.3:
+                lines.append("- {}".format(hostname))
+                continue
+            lines.append("- hostname: {}".format(hostname))
+            lines.append("  tags: [{}]".format(", ".join(rng.sample(tags, 2))))
+            if kind < 0.6:
+                lines.append("  port: {}".format(rng.choice([22, 2222, 22222])))
+            if kind > 0.9:
+                lines.append('  interval: "{}h"'.format(rng.choice([6, 12, 24])))
+        (directory / "hosts{:05d}.yml".format(i)).write_text("\n".join(lines) + "\n")
+
+    defaults = tmp / "defaults"
+    defaults.mkdir()
+    (defaults / "00-port.yml").write_text("---\nport: 22\n")
+    (defaults / "10-lock.yml").write_text("---\nlock: {}/{{}}.lock\n".format(tmp))
+    (defaults / "20-schedule.yml").write_text('---\nschedule: "0 3 * * *"\n')
+
+    path = tmp / "config.yml"
+    path.write_text(
+        "---\n"
+        "logging:\n"
+        "  filename: {}/backup.log\n"
+        "  mail:\n"
+        "    mailhost: [localhost, 25]\n"
+        "    fromaddr: bench@localhost\n"
+        "    toaddrs: [bench@localhost]\n"
+        "workers: 16\n"
+        "default: !include defaults/*.yml\n"
+        "hosts: !include hosts/*/*.yml\n".format(tmp)
+    )
+    return path
+
+
+def extend_logging(conf, loggers):
+    """ Add loggers, each with its own file handler, to a logging configuration.
+
+    The logging section of configuration files only sets the log file and the
+    mails, the extra loggers stand for the size of the logging configuration of
+    larger deployments.
+    """
+    conf = copy.deepcopy(conf)
+    for i in range(loggers):
+        name = "bench{:04d}".format(i)
+        conf["handlers"][name] = {
+            "class": "logging.handlers.WatchedFileHandler",
+            "formatter": "default",
+            "level": "INFO",
+            "filename": "/dev/null",
+        }
+        conf["loggers"]["qb.backup.bench." + name] = {
+            "level": "DEBUG",
+            "handlers": [name],
+        }
+    return conf
+
+
+def timed(function, repeat):
+    """ Durations of repeat calls of function, in seconds. """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return {"min": min(durations), "median": statistics.median(durations)}
+
+
+def import_time(argv):
+    """ Import time of the modules of a command, as reported by -X importtime.
+
+    :returns: total import time in seconds, and the top level modules which
+        take the longest to import
+    """
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime"] + argv,
+        cwd=str(ROOT.parent),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    modules = {}
+    for line in p.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Top level imports are not indented
+        if not name.startswith("  "):
+            modules[name.strip()] = int(cumulative) / 1e6
+    top = sorted(modules.items(), key=lambda m: m[1], reverse=True)[:10]
+    return sum(modules.values()), dict(top)
+
+
+def run(params):
+    """ Generate a configuration and time the steps of the startup path. """
+    from qb.backup import Config
+    from qb.backup.config.parser import IncludeLoader
+
+    repeat = params["repeat"]
+    metrics = {}
+    with tempfile.TemporaryDirectory(prefix="qb.backup.bench.") as tmp:
+        tmp = Path(tmp)
+        path = generate(tmp, params)
+
+        metrics["load"] = timed(lambda: Config.load(path), repeat)
+        cache = {}
+        Config.load(path, cache=cache)
+        metrics["load_cached"] = timed(lambda: Config.load(path, cache=cache), repeat)
+        compiled = tmp / "config.compiled"
+        Config.load(path, compiled=compiled)
+        metrics["load_compiled"] = timed(
+            lambda: Config.load(path, compiled=compiled), repeat
+        )
+
+        files = sorted(tmp.glob("hosts/*/*.yml"))
+        documents = list(IncludeLoader._load_paths(files))
+        metrics["merge_hosts"] = timed(
+            lambda: list(IncludeLoader.merge(documents, files)), repeat
+        )
+        mappings = [{"key{}".format(i): i} for i in range(params["files"])]
+        metrics["merge_mappings"] = timed(
+            lambda: IncludeLoader.merge(mappings, strict=True), repeat
+        )
+
+        with open(path) as fd:
+            conf = IncludeLoader.materialize(yaml.load(fd, Loader=IncludeLoader))
+        config = Config(conf)
+        metrics["init_hosts"] = timed(lambda: config._init_hosts(conf), repeat)
+        metrics["hosts"] = len(conf["hosts"])
+
+        logging_conf = extend_logging(config.logging, params["loggers"])
+        metrics["dict_config"] = timed(
+            lambda: logging.config.dictConfig(logging_conf), repeat
+        )
+        # The configured handlers would log into the removed directory
+        logging.config.dictConfig(
+            {"version": 1, "loggers": {name: {} for name in logging_conf["loggers"]}}
+        )
+
+    help_ = [str(ROOT.parent / "main.py"), "run", "--help"]
+    metrics["startup"] = timed(
+        lambda: subprocess.run(
+            [sys.executable] + help_, stdout=subprocess.DEVNULL, check=True
+        ),
+        repeat,
+    )
+    metrics["import_total"], metrics["import_top"] = import_time(help_)
+    return metrics
+
+
+STEPS = (
+    "load",
+    "load_cached",
+    "load_compiled",
+    "merge_hosts",
+    "merge_mappings",
+    "init_hosts",
+    "dict_config",
+    "startup",
+)
+
+
+def report(params, metrics, last=None):
+    # Steps are compared on their median duration
+    medians = {key: metrics[key]["median"] for key in STEPS}
+    if last is not None:
+        steps = {k: v["median"] for k, v in last["metrics"].items() if k in STEPS}
+        last = dict(last, metrics=steps)
+    print(
+        "{files} files of {hosts_per_file} hosts, {loggers} loggers".format(**params)
+    )
+    for key in STEPS:
+        print(
+            "  {:<15}min {:9.4f}s  median {:9.4f}s{}".format(
+                key,
+                metrics[key]["min"],
+                metrics[key]["median"],
+                compare(medians, last, key),
+            )
+        )
+    print("  {:<15}{:9.4f}s".format("imports", metrics["import_total"]))
+    for name, duration in metrics["import_top"].items():
+        print("    {:<30}{:9.4f}s".format(name, duration))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the loading of the configuration"
+    )
+    parser.add_argument(
+        "--files", type=int, nargs="+", default=[10, 100], help="included files"
+    )
+    parser.add_argument("--hosts-per-file", type=int, default=20)
+    parser.add_argument(
+        "--directories", type=int, default=10, help="directories of the files"
+    )
+    parser.add_argument(
+        "--loggers", type=int, default=100, help="extra loggers and handlers"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, default=RESULTS / "config.jsonl")
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="compare with the previous result of the same parameters",
+    )
+    args = parser.parse_args(argv)
+
+    tree = version()
+    for files in args.files:
+        params = {
+            "files": files,
+            "hosts_per_file": args.hosts_per_file,
+            "directories": args.directories,
+            "loggers": args.loggers,
+            "repeat": args.repeat,
+            "seed": args.seed,
+        }
+        metrics = run(params)
+        report(params, metrics, previous(args.output, params) if args.compare else None)
+        record(args.output, params, metrics, tree)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,3 @@
 from .backup import Backuper
 from .config import Config, ConfigError
+from .selector import HostRegistry, SelectorError
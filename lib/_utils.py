@@ -1,12 +1,27 @@
+import asyncio
+import collections
+import contextlib
 from datetime import datetime, timedelta, timezone
+import errno
 import fcntl
+import math
+import os
 from pathlib import Path
+import socket
+import statistics
+import subprocess
+import threading
+import time
 
 
 class FLockError(OSError):
     pass
 
 
+class FLockBusyError(FLockError):
+    pass
+
+
 class FLock:
     """
     Create an interprocess lock with the flock Unix API.
@@ -15,7 +30,7 @@ class FLock:
     ...     ... # Locked code
 
     WARNING: this lock is not thread-safe and should not be used in a
-    multi-threaded environment.
+    multi-threaded environment, use LockManager instead.
 
     NOTE: For a better understanding of problematics with locks, check out
     http://0pointer.de/blog/projects/locking.html
@@ -51,6 +66,218 @@ class FLock:
         self.release()
 
 
+class LockManager:
+    """
+    Manage interprocess locks (lockf Unix API, as FLock) taken from several threads
+    or asyncio tasks of a process.
+
+    >>> with lock_manager.lock("/path/to/file.lock", timeout=60):
+    ...     ... # Locked code
+
+    Locks are held by processes, not by threads nor file descriptors, and closing
+    any file descriptor of a lock file releases the lock. The manager keeps a
+    registry of the locks held by the process: a lock held by a thread is busy for
+    the others, and a held lock file is never opened again.
+
+    Unlike FLock, the lock file is not truncated before the lock is taken. Once
+    taken, "<PID> <hostname> <timestamp>" of the holder is written in it, so that
+    the holder of a busy lock can be reported, and stale locks detected.
+
+    As the API has no timeout, blocking acquisitions poll the lock.
+    """
+
+    POLL_MIN = 0.01
+    POLL_MAX = 1.0
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        # path -> (fd, holder)
+        self._held = {}
+
+    @staticmethod
+    def _key(path):
+        return os.path.abspath(os.fspath(path))
+
+    def _try_acquire(self, path):
+        with self._mutex:
+            if path in self._held:
+                return False
+            try:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            except OSError as e:
+                raise FLockError(e)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                os.close(fd)
+                if e.errno in (errno.EACCES, errno.EAGAIN):
+                    return False
+                raise FLockError(e)
+            holder = (os.getpid(), socket.gethostname(), time.time())
+            try:
+                os.ftruncate(fd, 0)
+                os.write(fd, "{} {} {}\n".format(*holder).encode())
+            except OSError:
+                # Holder information is only informative
+                pass
+            self._held[path] = fd, holder
+            return True
+
+    def _busy(self, path):
+        holder = self.holder(path)
+        if holder is None:
+            return FLockBusyError("lock {} is busy".format(path))
+        pid, host, since, alive = holder
+        msg = "lock {} held by PID {} on {} since {}".format(
+            path, pid, host, datetime.fromtimestamp(since).isoformat(" ", "seconds")
+        )
+        if alive is False:
+            msg += " (stale: the process does not exist anymore)"
+        return FLockBusyError(msg)
+
+    def _delays(self, timeout):
+        """ Generate the delays to wait between attempts to take a lock. """
+        deadline = time.monotonic() + timeout
+        delay = self.POLL_MIN
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            yield min(delay, remaining)
+            delay = min(2 * delay, self.POLL_MAX)
+
+    def acquire(self, path, timeout=0):
+        """ Take a lock, waiting at most timeout seconds.
+
+        :raises FLockBusyError: if the lock is still busy after timeout
+        :raises FLockError: if the lock file cannot be opened or locked
+        """
+        path = self._key(path)
+        delays = self._delays(timeout)
+        while not self._try_acquire(path):
+            try:
+                time.sleep(next(delays))
+            except StopIteration:
+                raise self._busy(path)
+
+    async def acquire_async(self, path, timeout=0):
+        """ Same as acquire(), without blocking the event loop while waiting. """
+        path = self._key(path)
+        delays = self._delays(timeout)
+        while not self._try_acquire(path):
+            try:
+                await asyncio.sleep(next(delays))
+            except StopIteration:
+                raise self._busy(path)
+
+    def release(self, path):
+        with self._mutex:
+            fd, _ = self._held.pop(self._key(path))
+            os.close(fd)
+
+    @contextlib.contextmanager
+    def lock(self, path, timeout=0):
+        self.acquire(path, timeout)
+        try:
+            yield
+        finally:
+            self.release(path)
+
+    def held(self):
+        """ Paths of the locks held by the process. """
+        with self._mutex:
+            return list(self._held)
+
+    def holder(self, path):
+        """ Holder of a lock, as written in the lock file.
+
+        :returns: (pid, hostname, timestamp, alive) or None if unknown. alive is
+            None if the holder is on another host.
+        """
+        path = self._key(path)
+        with self._mutex:
+            if path in self._held:
+                return self._held[path][1] + (True,)
+            # Held lock files are never opened again, closing them would release
+            # the lock. The mutex prevents the lock to be taken while reading.
+            try:
+                with open(path) as fd:
+                    pid, host, since = fd.read().split()
+                pid, since = int(pid), float(since)
+            except (OSError, ValueError):
+                return None
+        alive = None
+        if host == socket.gethostname():
+            try:
+                os.kill(pid, 0)
+                alive = True
+            except ProcessLookupError:
+                alive = False
+            except PermissionError:
+                alive = True
+        return pid, host, since, alive
+
+
+# Process-wide lock manager, see LockManager
+lock_manager = LockManager()
+
+
+class FairSlots:
+    """ Slots shared by several groups of threads, such as the workers of several
+        configurations run in one process. When threads of several groups wait
+        for a slot, freed slots are granted to the groups in turn, whatever
+        their number of waiting threads.
+
+    >>> slots = FairSlots(8)
+    >>> with slots.slot("customer-a"):
+    ...     ... # At most 8 threads of all groups here
+
+    """
+
+    def __init__(self, count):
+        self.free = count
+        self._cond = threading.Condition()
+        # group -> number of waiting threads, in the order groups are served
+        self._waiting = collections.OrderedDict()
+        # group -> slots granted to threads of the group not woken up yet
+        self._granted = collections.Counter()
+
+    def acquire(self, group):
+        with self._cond:
+            if self.free and not self._waiting:
+                self.free -= 1
+                return
+            self._waiting[group] = self._waiting.get(group, 0) + 1
+            self._dispatch()
+            while not self._granted[group]:
+                self._cond.wait()
+            self._granted[group] -= 1
+
+    def release(self):
+        with self._cond:
+            self.free += 1
+            self._dispatch()
+
+    def _dispatch(self):
+        """ Grant the free slots to the waiting groups, in turn. """
+        while self.free and self._waiting:
+            group, count = self._waiting.popitem(last=False)
+            if count > 1:
+                # Served again once the other groups are
+                self._waiting[group] = count - 1
+            self._granted[group] += 1
+            self.free -= 1
+        self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, group):
+        self.acquire(group)
+        try:
+            yield
+        finally:
+            self.release()
+
+
 class Timer:
     def __init__(self):
         self._start = None
@@ -83,3 +310,144 @@ class Timer:
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.stop()
+
+
+def distribution(values):
+    """ Minimum, median and 95th percentile (nearest rank) of a non-empty iterable
+        of numbers.
+    """
+    values = sorted(values)
+    return {
+        "min": values[0],
+        "median": statistics.median(values),
+        "p95": values[math.ceil(0.95 * len(values)) - 1],
+    }
+
+
+class Phases:
+    """ Monotonic, nanosecond resolution durations of the successive phases of a
+        task, which is in one phase at a time.
+
+        >>> phases = Phases("lock")
+        >>> with lock:
+        ...     phases.enter("work")
+        ...     work()
+        >>> phases.stop()
+        >>> phases.seconds()
+        {'lock': 0.012, 'work': 2.25}
+
+        Thread-safe, phases may be entered from callbacks run by other threads.
+    """
+
+    def __init__(self, phase=None, since=None):
+        """
+        :param phase: optional initial phase
+        :param since: time.monotonic_ns() at which the initial phase started,
+            defaults to now
+        """
+        self.durations = {}
+        # (phase, start, end) in time.monotonic_ns(), in chronological order
+        self.spans = []
+        self.phase = phase
+        self._since = time.monotonic_ns() if since is None else since
+        self._mutex = threading.Lock()
+
+    def enter(self, phase, after=None):
+        """ End the current phase and start another one. A phase entered several
+            times accumulates its durations.
+
+        :param after: if given, only enter phase if the current phase is after
+        :returns: whether the phase was entered
+
+        """
+        with self._mutex:
+            if after is not None and self.phase != after:
+                return False
+            now = time.monotonic_ns()
+            if self.phase is not None:
+                elapsed = now - self._since
+                self.durations[self.phase] = self.durations.get(self.phase, 0) + elapsed
+                self.spans.append((self.phase, self._since, now))
+            self.phase, self._since = phase, now
+            return True
+
+    def stop(self):
+        """ End the current phase. """
+        self.enter(None)
+
+    def seconds(self):
+        """ Durations of the ended phases in seconds, in the order they started. """
+        return {phase: ns / 1e9 for phase, ns in self.durations.items()}
+
+    @staticmethod
+    def aggregate(phases):
+        """ Distribution of the duration of each phase over several tasks.
+
+        :param phases: iterable of dicts phase -> seconds, see seconds()
+        :returns: dict phase -> {"min": ..., "median": ..., "p95": ...}
+
+        """
+        durations = {}
+        for p in phases:
+            for phase, seconds in p.items():
+                durations.setdefault(phase, []).append(seconds)
+        return {phase: distribution(values) for phase, values in durations.items()}
+
+
+def run_command(cmd, timeout=None, on_line=None, on_start=None):
+    """ Run a command as subprocess.run(cmd, stdout=PIPE, stderr=PIPE, check=True,
+        timeout=timeout, universal_newlines=True) does, but reading its output
+        while it runs.
+
+    :param on_line: optional function called with ("stdout", line) or
+        ("stderr", line) as soon as each line is read, from reader threads
+    :param on_start: optional function called with the subprocess.Popen of the
+        command once started
+    :returns: a subprocess.CompletedProcess
+    :raises subprocess.TimeoutExpired: once the command is killed
+    :raises subprocess.CalledProcessError: if the command returns non-zero
+    :raises OSError: if the command cannot be started, e.g. FileNotFoundError
+
+    """
+    output = {"stdout": [], "stderr": []}
+
+    def read(name, stream):
+        for line in stream:
+            output[name].append(line)
+            if on_line is not None:
+                on_line(name, line)
+
+    with subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    ) as p:
+        if on_start is not None:
+            on_start(p)
+        readers = [
+            threading.Thread(target=read, args=(name, getattr(p, name)), daemon=True)
+            for name in output
+        ]
+        for reader in readers:
+            reader.start()
+        try:
+            p.wait(timeout)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.wait()
+            raise subprocess.TimeoutExpired(
+                cmd, timeout, *_join(readers, output, timeout=5)
+            )
+        stdout, stderr = _join(readers, output)
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd, stdout, stderr)
+    return subprocess.CompletedProcess(cmd, p.returncode, stdout, stderr)
+
+
+def _join(readers, output, timeout=None):
+    """ Wait for the reader threads of run_command, return stdout and stderr. """
+    for reader in readers:
+        # Processes started by the command may keep the pipes open once killed
+        reader.join(timeout)
+    return "".join(output["stdout"]), "".join(output["stderr"])
@@ -1,8 +1,26 @@
+import collections
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+import heapq
 import logging
+import sqlite3
 import subprocess
+import time
 
+from .borg import BorgStats, format_size
+from .cgroup import format_usage, resources
 from .logging import META
-from ._utils import FLock, FLockError, Timer
+from . import regression
+from .ramp import REFUSED
+from ._utils import (
+    FLockBusyError,
+    FLockError,
+    Phases,
+    Timer,
+    distribution,
+    lock_manager,
+    run_command,
+)
 
 
 log = logging.getLogger("qb.backup")
@@ -22,51 +40,242 @@ def handle_SubprocessError(e: subprocess.SubprocessError, hostname="<undefined>"
     log.error(bound(e.stdout, "stdout"))
 
 
+def throughput(results):
+    """ Distribution of the throughput of the hosts whose backup reported one. """
+    stats = (r.get("stats", {}) for r in results)
+    values = [s["throughput"] for s in stats if "throughput" in s]
+    return distribution(values) if values else {}
+
+
+def describe(r):
+    """ Log message and arguments describing a regression, see Backuper.compare(). """
+    if r["metric"] == "duration":
+        value = timedelta(seconds=round(r["value"]))
+        median = timedelta(seconds=round(r["median"]))
+    else:
+        value, median = format_size(r["value"]), format_size(r["median"])
+    return (
+        "%-20s: %s, %s %s instead of %s (%+.0f%%, %.1f MADs)",
+        r["hostname"],
+        regression.METRICS[r["metric"]],
+        r["metric"],
+        value,
+        median,
+        100 * (r["value"] / r["median"] - 1),
+        r["score"],
+    )
+
+
+def open_circuit(c):
+    """ Log message and arguments describing a host whose circuit is open, see
+        CircuitBreaker.
+    """
+    return (
+        "%-20s: circuit open, %d consecutive failures since %s",
+        c["hostname"],
+        c["failures"],
+        c["since"],
+    )
+
+
 class Backuper:
-    def __init__(self, hosts, failfast=False):
+
+    # Maximum duration of the backup of a host, in seconds
+    timeout = 23 * 3600 + 600  # +10min for checkpoints
+    # Number of previous successful backups of a host its backups are compared
+    # with, see regression.detect()
+    baseline = 10
+
+    def __init__(
+        self,
+        hosts,
+        failfast=False,
+        history=None,
+        workers=1,
+        lock_timeout=0,
+        locks=None,
+        on_done=None,
+        trace=None,
+        masters=None,
+        name=None,
+        slots=None,
+        cgroups=None,
+        launch=None,
+        breaker=None,
+    ):
+        """
+        :param hosts: iterable of hosts to backup
+        :param failfast: do not start any backup after a failure
+        :param history: History in which results are recorded
+        :param workers: number of backups run concurrently
+        :param lock_timeout: a host whose lock is busy is tried again after the
+            other hosts are started, waiting at most lock_timeout seconds for it
+        :param locks: LockManager of the host locks
+        :param on_done: function called with each host once its backup is over
+        :param trace: optional Trace in which the timeline of the run is recorded
+        :param masters: optional ssh.ControlMasters, sharing a connection between
+            the probe of the circuit breaker and the backup of each host
+        :param name: name of the run, its worker threads being named
+            "<name>_<number>"
+        :param slots: optional FairSlots shared with other runs, a slot being
+            taken by each backup in the group of this run
+        :param cgroups: optional cgroup.Cgroups, in which the processes of the
+            backup of each host are isolated
+        :param launch: optional ramp.LaunchRamp, limiting the rate at which
+            backups connect to their hosts, for the transports opening a tunnel
+        :param breaker: optional breaker.CircuitBreaker, loaded from history at
+            the start of the run, skipping the hosts whose backups keep failing
+
+        """
         self.hosts = hosts
         self.failfast = failfast
+        self.history = history
+        self.workers = workers
+        self.lock_timeout = lock_timeout
+        self.locks = locks or lock_manager
+        self.on_done = on_done
+        self.trace = trace
+        self.masters = masters
+        self.name = name
+        self.slots = slots
+        self.cgroups = cgroups
+        self.launch = launch
+        self.breaker = breaker
+        self.results = []
+        self.summary = None
 
     def run(self):
         rc = 0
         succeeded = 0
         failed = 0
-        with Timer() as timer:
-            for host in self.hosts:
-                try:
-                    self.backup(host)
-                    succeeded += 1
-                except subprocess.TimeoutExpired as e:
-                    log.error("backup of %s timed out (%ds)", host.hostname, e.timeout)
-                    handle_SubprocessError(e, host.hostname)
-                    failed += 1
-                    rc = 1
-                except subprocess.CalledProcessError as e:
-                    log.error("backup of %s returned %d", host.hostname, e.returncode)
-                    handle_SubprocessError(e, host.hostname)
-                    failed += 1
-                    rc = 1
-                except FLockError:
-                    log.warning("failed to take lock on file %s", host.lock)
-                    log.warning("backup of host %s aborted", host.hostname)
-                    failed += 1
-                    rc = 1
-                if self.failfast and rc != 0:
+        handled = 0
+        self.results = []
+        regressions = []
+        circuits = []
+        if self.breaker is not None and self.history is not None:
+            self.breaker.load(self.history)
+        run_id = datetime.now(tz=timezone.utc).isoformat(timespec="seconds")
+        hosts = iter(self.hosts)
+        # Hosts wait for a worker since the start of the run
+        started = time.monotonic_ns()
+        # Hosts whose lock was busy and time they were re-queued, tried again once
+        # the others are started
+        requeued = collections.deque()
+        # future -> (host, worker slot), the free slots being in a heap
+        running = {}
+        slots = list(range(self.workers))
+        with Timer() as timer, ThreadPoolExecutor(
+            self.workers, self.name or ""
+        ) as pool:
+            while True:
+                while len(running) < self.workers and not (self.failfast and rc):
+                    host = next(hosts, None)
+                    retry = host is None
+                    if retry and not requeued:
+                        break
+                    if retry:
+                        host, ready = requeued.popleft()
+                    else:
+                        handled += 1
+                        ready = started
+                    future = pool.submit(self.attempt, host, retry, ready)
+                    running[future] = host, heapq.heappop(slots)
+                    if self.trace is not None:
+                        self.trace.counters(len(running))
+                if not running:
                     break
 
-        total = len(self.hosts)
-        summary = {
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    host, slot = running.pop(future)
+                    heapq.heappush(slots, slot)
+                    status, duration, phases, stats, usage = future.result()
+                    if self.trace is not None:
+                        self.trace.host(slot, host.hostname, status, phases)
+                        self.trace.counters(len(running))
+                    if status == "BUSY":
+                        log.info(
+                            "lock %s busy, backup of %s re-queued",
+                            host.lock,
+                            host.hostname,
+                        )
+                        requeued.append((host, time.monotonic_ns()))
+                        continue
+                    if status == "SUCCEEDED":
+                        succeeded += 1
+                    elif status == "OPEN":
+                        streak = self.breaker.streak(host)
+                        circuits.append(dict(streak, hostname=host.hostname))
+                    else:
+                        failed += 1
+                        rc = 1
+                    stats = stats.metrics(duration)
+                    if status == "SUCCEEDED":
+                        regressions.extend(self.compare(host, duration, stats))
+                    self.record(
+                        run_id, host, status, duration, phases.seconds(), stats, usage
+                    )
+                    if "throughput" in stats:
+                        log_progress.info(
+                            "%-20s: %s original, %s deduplicated, %.1f MB/s",
+                            host.hostname,
+                            format_size(stats["original_size"]),
+                            format_size(stats["deduplicated_size"]),
+                            stats["throughput"],
+                        )
+                    if usage:
+                        log_progress.info(
+                            "%-20s: %s", host.hostname, format_usage(usage)
+                        )
+                    if self.on_done is not None:
+                        self.on_done(host)
+
+        try:
+            total = len(self.hosts)
+        except TypeError:
+            # Hosts are lazily provided, e.g. claimed from a WorkQueue
+            total = handled
+        self.summary = summary = {
             "SUCCEEDED": succeeded,
             "FAILED": failed,
-            "SKIPPED": total - succeeded - failed,
+            "SKIPPED": total - succeeded - failed - len(circuits),
             "TOTAL": total,
             "RUNTIME": timer.in_seconds(),
             "STATUS": "success" if rc == 0 else "failure",
+            "PHASES": Phases.aggregate(r["phases"] for r in self.results),
+            "BYTES": sum(r["stats"].get("original_size", 0) for r in self.results),
+            "THROUGHPUT": throughput(self.results),
+            "REGRESSIONS": regressions,
+            "REGRESSED": len({r["hostname"] for r in regressions}),
+            "RESOURCES": resources(self.results),
+            "OPEN": len(circuits),
+            "CIRCUITS": circuits,
         }
 
         # Add extra info for mail handler
         log_progress.log(META, "", summary)
 
+        if regressions:
+            log_progress.info(
+                "{:<20}: %d hosts regressed against their last %d backups".format(
+                    "Regressions"
+                ),
+                summary["REGRESSED"],
+                self.baseline,
+            )
+            for r in regressions:
+                log_progress.info(*describe(r))
+
+        if circuits:
+            log_progress.info(
+                "{:<20}: %d hosts not backuped, their backups keep failing".format(
+                    "Circuits"
+                ),
+                len(circuits),
+            )
+            for c in circuits:
+                log_progress.info(*open_circuit(c))
+
         log_progress.info("{:<20}: RUNTIME %s".format("Summary"), timer.in_seconds())
         log_progress.info(
             "{:<20}: ".format("Summary")
@@ -75,40 +284,207 @@ class Backuper:
             "SKIPPED %(SKIPPED)3d/%(TOTAL)-3d",
             summary,
         )
+        for phase, d in summary["PHASES"].items():
+            log_progress.info(
+                "{:<20}: %-9s min %9.3fs  median %9.3fs  p95 %9.3fs".format("Phases"),
+                phase,
+                d["min"],
+                d["median"],
+                d["p95"],
+            )
+        if summary["THROUGHPUT"]:
+            log_progress.info(
+                "{:<20}: %s original  min %.1f MB/s  median %.1f MB/s  "
+                "p95 %.1f MB/s".format("Transfer"),
+                format_size(summary["BYTES"]),
+                summary["THROUGHPUT"]["min"],
+                summary["THROUGHPUT"]["median"],
+                summary["THROUGHPUT"]["p95"],
+            )
+        if summary["RESOURCES"]:
+            log_progress.info(
+                "{:<20}: %s".format("Resources"), format_usage(summary["RESOURCES"])
+            )
         return rc
 
-    def backup(self, host):
-        """ Perform the backup of an host.
+    def attempt(self, host, retry=False, ready=None):
+        """ Backup a host and handle its errors. Run by the workers.
+
         :param host: Host to backup.
+        :param retry: whether the lock of the host was busy on a previous attempt,
+            if so wait for it at most lock_timeout seconds.
+        :param ready: time.monotonic_ns() since which the host waits for a worker
+        :returns: (status, duration in seconds, phases, stats, usage), status
+            being "SUCCEEDED", "FAILED", "BUSY" if the lock is busy and the host
+            must be tried again, or "OPEN" if its circuit is open, phases the
+            Phases of the attempt, stats the BorgStats parsed from its output and
+            usage the resources used by its cgroup, see backup()
+
+        """
+        status = "FAILED"
+        start = time.monotonic_ns()
+        phases = Phases("queue", since=ready if ready is not None else start)
+        stats = BorgStats()
+        usage = {}
+        if self.breaker is not None and not self.breaker.allow(host, self.masters):
+            # The master may have been opened by a failed probe
+            host.transport.release(host, self.masters)
+            phases.stop()
+            duration = (time.monotonic_ns() - start) / 1e9
+            return "OPEN", duration, phases, stats, usage
+        if self.slots is not None:
+            # Waiting for a slot is part of the queue phase
+            self.slots.acquire(self.name)
+        try:
+            self.backup(host, self.lock_timeout if retry else 0, phases, stats, usage)
+            status = "SUCCEEDED"
+        except subprocess.TimeoutExpired as e:
+            log.error("backup of %s timed out (%ds)", host.hostname, e.timeout)
+            handle_SubprocessError(e, host.hostname)
+        except subprocess.CalledProcessError as e:
+            log.error("backup of %s returned %d", host.hostname, e.returncode)
+            handle_SubprocessError(e, host.hostname)
+        except FLockBusyError as e:
+            if not retry:
+                status = "BUSY"
+            else:
+                log.warning("failed to take lock on file %s: %s", host.lock, e)
+                log.warning("backup of host %s aborted", host.hostname)
+        except FLockError as e:
+            log.warning("failed to take lock on file %s: %s", host.lock, e)
+            log.warning("backup of host %s aborted", host.hostname)
+        except OSError as e:
+            # e.g. the executable of a local transport is missing
+            log.error("backup of %s failed to start: %s", host.hostname, e)
+        finally:
+            if self.slots is not None:
+                self.slots.release()
+        phases.stop()
+        return status, (time.monotonic_ns() - start) / 1e9, phases, stats, usage
+
+    def compare(self, host, duration, stats):
+        """ Compare a successful backup with the previous ones of the host in
+            history, see regression.detect().
+
+        :returns: a list of regressions, dicts with keys "hostname", "metric",
+            "value", "median", "mad" and "score"
+        """
+        if self.history is None:
+            return []
+        try:
+            samples = self.history.results(
+                host.hostname, last=self.baseline, status="SUCCEEDED"
+            )
+        except sqlite3.Error as e:
+            log.warning("cannot read history of %s: %s", host.hostname, e)
+            return []
+        result = dict(stats, duration=duration)
+        return [
+            dict(r, hostname=host.hostname)
+            for r in regression.detect(result, samples)
+        ]
+
+    def record(
+        self, run_id, host, status, duration, phases=None, stats=None, usage=None
+    ):
+        """ Record the result of a host backup in results and history, if any.
+
+        :param phases: durations of the phases, see Phases.seconds()
+        :param stats: statistics of the backup, see BorgStats.metrics()
+        :param usage: resources used by the backup, see Cgroups.usage()
+
+        """
+        self.results.append(
+            {
+                "hostname": host.hostname,
+                "status": status,
+                "duration": duration,
+                "phases": phases or {},
+                "stats": stats or {},
+                "resources": usage or {},
+            }
+        )
+        if self.history is None:
+            return
+        try:
+            self.history.record(
+                run_id, host.hostname, status, duration, **(stats or {})
+            )
+        except sqlite3.Error as e:
+            log.warning("cannot record result of %s in history: %s", host.hostname, e)
+
+    def backup(self, host, lock_timeout=0, phases=None, stats=None, usage=None):
+        """ Perform the backup of an host, with its transport (ssh by default).
+        :param host: Host to backup.
+        :param lock_timeout: maximum time to wait for the lock of the host.
+        :param phases: optional Phases, which enters the phases "lock" (waiting
+            for the lock), "connect" (until the first output of the remote host),
+            "transfer" (until the command exits) and "teardown".
+        :param stats: optional BorgStats, fed with the error output of the host
+        :param usage: optional dict, updated with the resources used by the
+            backup if it runs in a cgroup, see Cgroups.usage(); the bytes read
+            and written only for the transports without tunnel, whose borg runs
+            in the group
         :raises subprocess.TimeoutExpired:
         :raises subprocess.CalledProcessError:
+        :raises FLockBusyError: if the lock of the host is busy
         :raises FLockError:
+        :raises OSError: if the command cannot be started
 
         """
         log_progress.info("%-20s: starting backup", host.hostname)
-        # fmt: off
-        cmd = [
-            "ssh",
-            "-o", "ServerAliveInterval=10",
-            "-o", "ServerAliveCountMax=30",
-            "-o", "BatchMode=yes",
-            "-o", "StrictHostKeyChecking=no",
-            "-p", host.port,
-            "-R", "64064:localhost:22",
-            "-l", "root",
-            host.hostname,
-        ]
-        # fmt: on
-
-        log.debug("run command: %r", cmd)
-        with FLock(host.lock):
-            p = subprocess.run(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                timeout=23 * 3600 + 600,  # +10min for checkpoints
-                check=True,
-                universal_newlines=True,
-            )
+        phases = phases or Phases()
+        stats = stats or BorgStats()
+        transport = host.transport
+        # Only tunnels to the local sshd need to be ramped up
+        launch = self.launch if transport.tunnel else None
+        refused = False
+
+        def on_line(name, line):
+            nonlocal refused
+            phases.enter("transfer", "connect")
+            # borg prints its statistics on stderr, and so does the remote ssh
+            # client of the tunnel its errors
+            if name == "stderr":
+                stats.feed(line)
+                if launch is not None and not refused and REFUSED.search(line):
+                    refused = True
+                    launch.throttle()
+
+        phases.enter("lock")
+        with self.locks.lock(host.lock, lock_timeout):
+            phases.enter("connect")
+            if launch is not None:
+                launch.acquire()
+            group = None
+            if self.cgroups is not None:
+                group = self.cgroups.create(host)
+
+            def on_start(p):
+                if group is not None:
+                    self.cgroups.attach(group, p.pid)
+
+            try:
+                cmd = transport.command(host, self.masters)
+                if group is not None:
+                    # e.g. the ssh master, carrying the traffic of the backup
+                    for pid in transport.processes(host, self.masters):
+                        self.cgroups.attach(group, pid)
+                log.debug("run command: %r", cmd)
+                p = run_command(
+                    cmd, timeout=self.timeout, on_line=on_line, on_start=on_start
+                )
+            finally:
+                phases.enter("teardown")
+                transport.release(host, self.masters)
+                if group is not None:
+                    if usage is not None:
+                        # The borg of a tunnel runs under sshd, out of the group
+                        usage.update(
+                            self.cgroups.usage(group, io=not transport.tunnel)
+                        )
+                    self.cgroups.remove(group)
+            if launch is not None and not refused:
+                launch.recover()
         log_progress.info("%-20s: backup completed successfully", host.hostname)
         log.info(bound(p.stderr, f"stderr {host.hostname}"))
@@ -0,0 +1,112 @@
+import re
+
+
+# Units of the sizes printed by borg, decimal by default and binary with --iec
+_UNITS = {
+    "B": 1,
+    "kB": 10 ** 3,
+    "MB": 10 ** 6,
+    "GB": 10 ** 9,
+    "TB": 10 ** 12,
+    "PB": 10 ** 15,
+    "KiB": 2 ** 10,
+    "MiB": 2 ** 20,
+    "GiB": 2 ** 30,
+    "TiB": 2 ** 40,
+    "PiB": 2 ** 50,
+}
+_DURATION_UNITS = {"days": 86400, "hours": 3600, "minutes": 60, "seconds": 1}
+
+# Only the units of _UNITS, longest first, so that parse_size cannot fail on them
+_SIZE = re.compile(
+    r"(\d+(?:\.\d+)?) ?({})\b".format(
+        "|".join(sorted(map(re.escape, _UNITS), key=len, reverse=True))
+    )
+)
+_DURATION = re.compile(r"(\d+(?:\.\d+)?) (days|hours|minutes|seconds)\b")
+
+# Lines of the statistics which are parsed, other lines are skipped
+_PREFIXES = ("This archive:", "Number of files:", "Duration:")
+
+
+def parse_size(text):
+    """ Parse a size printed by borg, such as "10.50 GB".
+
+    :returns: the size in bytes
+    :raises: ValueError if badly formatted
+    """
+    m = _SIZE.fullmatch(text.strip())
+    if not m:
+        raise ValueError("bad size {!r}".format(text))
+    return int(float(m.group(1)) * _UNITS[m.group(2)])
+
+
+def format_size(size):
+    """ Format a number of bytes as borg does, e.g. "10.50 GB". """
+    for unit in ("B", "kB", "MB", "GB", "TB"):
+        if abs(size) < 1000:
+            break
+        size /= 1000
+    else:
+        unit = "PB"
+    return "{:.2f} {}".format(size, unit)
+
+
+class BorgStats:
+    """ Incremental parser of the statistics printed by `borg create --stats`,
+        fed with the lines of the output of a backup while they are read.
+
+        >>> stats = BorgStats()
+        >>> stats.feed("This archive:   10.50 GB    5.20 GB    120.34 MB\\n")
+        >>> stats.feed("Duration: 1 hours 10.00 seconds\\n")
+        >>> stats.metrics()["throughput"]  # MB/s
+        2.908...
+
+    Lines which are not statistics are skipped by a single prefix test, so that
+    reading the output is not slowed down. Malformed statistics are ignored.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def feed(self, line):
+        """ Parse a line of output. """
+        line = line.lstrip()
+        if not line.startswith(_PREFIXES):
+            return
+        name, _, value = line.partition(":")
+        try:
+            if name == "This archive":
+                sizes = [parse_size(m.group(0)) for m in _SIZE.finditer(value)]
+                if len(sizes) != 3:
+                    return
+                (
+                    self.values["original_size"],
+                    self.values["compressed_size"],
+                    self.values["deduplicated_size"],
+                ) = sizes
+            elif name == "Number of files":
+                self.values["files"] = int(value)
+            elif name == "Duration":
+                parts = _DURATION.findall(value)
+                if parts:
+                    self.values["duration"] = sum(
+                        float(n) * _DURATION_UNITS[unit] for n, unit in parts
+                    )
+        except ValueError:
+            pass
+
+    def metrics(self, duration=None):
+        """ Statistics of the backup, as recorded in history.
+
+        :param duration: duration of the backup in seconds, used to compute the
+            throughput if borg did not print its own
+        :returns: a dict with the keys found among "original_size",
+            "compressed_size", "deduplicated_size" (bytes), "files" and
+            "throughput" (original size processed per second, in MB/s)
+        """
+        metrics = {k: v for k, v in self.values.items() if k != "duration"}
+        duration = self.values.get("duration", duration)
+        if "original_size" in metrics and duration:
+            metrics["throughput"] = metrics["original_size"] / 1e6 / duration
+        return metrics
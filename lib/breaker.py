@@ -0,0 +1,128 @@
+import collections.abc
+import logging
+import sqlite3
+import subprocess
+import threading
+
+
+log = logging.getLogger("qb.backup")
+
+
+class BreakerError(ValueError):
+    pass
+
+
+class CircuitBreaker:
+    """ Circuit breakers of the hosts whose backups keep failing, so that they do
+        not take a worker for a full backup attempt every run.
+
+        The circuit of a host opens once its last `failures` backups failed, as
+        recorded in history. The backup of such a host is skipped, and recorded
+        with status "OPEN", except every `retry_every` runs or, if enabled, when
+        the probe of its transport succeeds (connecting to it with ssh for most
+        hosts). A successful backup closes the circuit.
+
+        >>> breaker = CircuitBreaker(failures=7, retry_every=7)
+        >>> breaker.load(history)  # once per run
+        >>> if breaker.allow(host):
+        ...     backup(host)
+    """
+
+    def __init__(self, failures=7, retry_every=7, probe=False, probe_timeout=30):
+        """
+        :param failures: consecutive failures opening the circuit of a host
+        :param retry_every: backup of an open host is attempted every
+            retry_every runs, never if 0
+        :param probe: whether open hosts are probed, and attempted if the probe
+            succeeds
+        :param probe_timeout: maximum duration of a probe, in seconds
+        :raises: BreakerError if a parameter is out of range
+
+        """
+        if not isinstance(failures, int) or failures < 1:
+            raise BreakerError(
+                "breaker failures must be a positive integer, not {!r}".format(failures)
+            )
+        if not isinstance(retry_every, int) or retry_every < 0:
+            raise BreakerError(
+                "breaker retry_every must be a non-negative integer, not {!r}".format(
+                    retry_every
+                )
+            )
+        self.failures = failures
+        self.retry_every = retry_every
+        self.probe = bool(probe)
+        self.probe_timeout = probe_timeout
+        # hostname -> streak of the hosts whose last backup failed, see
+        # History.streaks()
+        self.streaks = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def parse(cls, conf):
+        """ Build from the breaker section of a configuration.
+
+        :raises: BreakerError if badly formatted
+        """
+        if not isinstance(conf, collections.abc.Mapping):
+            raise BreakerError("breaker must be a mapping")
+        unknown = set(conf) - {"failures", "retry_every", "probe", "probe_timeout"}
+        if unknown:
+            unknown = ", ".join(sorted(map(str, unknown)))
+            raise BreakerError("unknown breaker settings: {}".format(unknown))
+        return cls(**conf)
+
+    def load(self, history):
+        """ Read the failure streaks of the hosts from history, at the start of a
+            run. Circuits stay closed if it cannot be read.
+        """
+        try:
+            streaks = history.streaks()
+        except sqlite3.Error as e:
+            log.warning("cannot read failures from history: %s", e)
+            streaks = {}
+        with self._lock:
+            self.streaks = streaks
+
+    def streak(self, host):
+        """ Failure streak of host if its circuit is open, None otherwise. """
+        with self._lock:
+            streak = self.streaks.get(host.hostname)
+        if streak is None or streak["failures"] < self.failures:
+            return None
+        return streak
+
+    def allow(self, host, masters=None):
+        """ Whether the backup of host is attempted. Open hosts may be probed.
+
+        :param masters: optional ssh.ControlMasters, see SshTransport.probe()
+        """
+        streak = self.streak(host)
+        if streak is None:
+            return True
+        if self.retry_every and (streak["skipped"] + 1) % self.retry_every == 0:
+            log.info("circuit of %s open, backup attempted again", host.hostname)
+            return True
+        if self.probe and self._probe(host, masters):
+            log.info("circuit of %s open, probe succeeded", host.hostname)
+            return True
+        return False
+
+    def _probe(self, host, masters=None):
+        cmd = host.transport.probe(host, masters)
+        if cmd is None:
+            # Nothing to probe, the host is attempted every retry_every runs
+            return False
+        try:
+            subprocess.run(
+                cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=self.probe_timeout,
+                check=True,
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            log.debug("probe of %s failed: %s", host.hostname, e)
+            return False
+        return True
@@ -0,0 +1,229 @@
+import collections.abc
+import logging
+from pathlib import Path
+import threading
+
+from .borg import format_size
+
+
+log = logging.getLogger("qb.backup")
+
+# Settings of a group which can be configured, and the controller of each
+LIMITS = {
+    "cpu.weight": "cpu",
+    "io.weight": "io",
+    "io.max": "io",
+    "memory.max": "memory",
+}
+# Controllers enabled for the groups of the hosts when available, io being
+# required to account for the bytes read and written
+CONTROLLERS = ("cpu", "io", "memory")
+
+
+class CgroupError(ValueError):
+    pass
+
+
+def _check_limits(limits, where):
+    if not isinstance(limits, collections.abc.Mapping):
+        raise CgroupError("{} must be a mapping of limits".format(where))
+    unknown = set(limits) - set(LIMITS)
+    if unknown:
+        unknown = ", ".join(sorted(map(str, unknown)))
+        raise CgroupError("unknown limits of {}: {}".format(where, unknown))
+    return {k: str(v) for k, v in limits.items()}
+
+
+def resources(results):
+    """ Total resources used by the hosts whose usage was read, see Cgroups.usage().
+    """
+    usages = [r["resources"] for r in results if r.get("resources")]
+    return {
+        key: sum(u.get(key, 0) for u in usages)
+        for key in ("cpu_seconds", "read_bytes", "written_bytes")
+        if any(key in u for u in usages)
+    }
+
+
+def format_usage(usage):
+    """ Describe resources, e.g. "cpu 1.5s, 10.00 MB read, 2.00 MB written", the
+        bytes only if they were read, see Cgroups.usage().
+    """
+    text = "cpu {:.1f}s".format(usage.get("cpu_seconds", 0))
+    if "read_bytes" in usage or "written_bytes" in usage:
+        text += ", {} read, {} written".format(
+            format_size(usage.get("read_bytes", 0)),
+            format_size(usage.get("written_bytes", 0)),
+        )
+    return text
+
+
+class Cgroups:
+    """ cgroup v2 groups isolating the backups of the hosts from each other.
+
+        The processes of the backup of a host are placed in a group of their own,
+        root/<hostname>, whose limits are set from the configuration, and which
+        is removed once the backup is over. root must be a cgroup v2 directory
+        delegated to the user running the backups, without processes of its own.
+
+        The reading and writing of the files is done by the processes of the
+        transport: for local transports they are in the group, and the io limits
+        and accounting apply to them. For ssh, only the client and its master
+        are, borg runs under the local sshd: only the cpu spent on the traffic is
+        accounted for, and the io limits have no effect.
+
+        >>> cgroups = Cgroups.parse({"root": "/sys/fs/cgroup/backup"})
+        >>> group = cgroups.create(host)
+        >>> cgroups.attach(group, pid)
+        >>> usage = cgroups.usage(group)
+        >>> cgroups.remove(group)
+
+    """
+
+    def __init__(self, root, default=None, tags=None, hosts=None):
+        """
+        :param root: path of the delegated group under which groups are created
+        :param default: limits of all the hosts, a mapping of LIMITS to values
+            written as is in the files of the group, e.g. {"io.weight": 50}
+        :param tags: mapping tag -> limits of the hosts with the tag, overriding
+            the default ones, in the order of the tags
+        :param hosts: mapping hostname -> limits of the host, overriding the
+            ones of its tags
+        :raises: CgroupError if the limits are badly formatted
+
+        """
+        self.root = Path(root)
+        self.default = _check_limits(default or {}, "default")
+        for name, mapping in (("tags", tags), ("hosts", hosts)):
+            if mapping is not None and not isinstance(mapping, collections.abc.Mapping):
+                raise CgroupError("{} must be a mapping".format(name))
+        self.tags = {
+            tag: _check_limits(limits, "tag " + str(tag))
+            for tag, limits in (tags or {}).items()
+        }
+        self.hosts = {
+            hostname: _check_limits(limits, "host " + str(hostname))
+            for hostname, limits in (hosts or {}).items()
+        }
+        self._enabled = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def parse(cls, conf):
+        """ Build from the cgroup section of a configuration.
+
+        :raises: CgroupError if badly formatted
+        """
+        if not isinstance(conf, collections.abc.Mapping) or "root" not in conf:
+            raise CgroupError("cgroup must be a mapping with a root")
+        unknown = set(conf) - {"root", "default", "tags", "hosts"}
+        if unknown:
+            unknown = ", ".join(sorted(map(str, unknown)))
+            raise CgroupError("unknown cgroup settings: {}".format(unknown))
+        return cls(**conf)
+
+    def limits(self, host):
+        """ Limits of the group of host: the default ones, overridden by the ones
+            of its tags and then by its own.
+        """
+        limits = dict(self.default)
+        for tag, values in self.tags.items():
+            if tag in host.tags:
+                limits.update(values)
+        limits.update(self.hosts.get(host.hostname, {}))
+        return limits
+
+    def enable(self):
+        """ Enable the available controllers for the groups created under root,
+            once.
+
+        :returns: the set of enabled controllers
+        :raises: OSError if root is not a writable cgroup v2 directory
+        """
+        with self._lock:
+            if self._enabled is None:
+                available = (self.root / "cgroup.controllers").read_text().split()
+                enabled = [c for c in CONTROLLERS if c in available]
+                if enabled:
+                    (self.root / "cgroup.subtree_control").write_text(
+                        " ".join("+" + c for c in enabled)
+                    )
+                self._enabled = set(enabled)
+            return self._enabled
+
+    def create(self, host):
+        """ Create the group of host and set its limits.
+
+        :returns: path of the group, or None if it cannot be created, the backup
+            of the host then running without isolation
+        """
+        try:
+            enabled = self.enable()
+            group = self.root / host.hostname
+            group.mkdir(exist_ok=True)
+        except OSError as e:
+            log.warning("cannot create cgroup of %s: %s", host.hostname, e)
+            return None
+        for name, value in self.limits(host).items():
+            if LIMITS[name] not in enabled:
+                log.warning(
+                    "controller %s unavailable, %s of %s not set",
+                    LIMITS[name],
+                    name,
+                    host.hostname,
+                )
+                continue
+            try:
+                (group / name).write_text(value)
+            except OSError as e:
+                log.warning("cannot set %s of %s: %s", name, host.hostname, e)
+        return group
+
+    def attach(self, group, pid):
+        """ Move a process into group. Processes it starts afterwards belong to
+            the group as well.
+        """
+        try:
+            (group / "cgroup.procs").write_text(str(pid))
+        except OSError as e:
+            log.warning("cannot move process %d to %s: %s", pid, group, e)
+
+    def usage(self, group, io=True):
+        """ Resources used by the processes of group since it was created.
+
+        :param io: whether to read the bytes read and written, which are only
+            meaningful if the processes doing the I/O of the backup are in group
+        :returns: a dict with the keys which could be read among "cpu_seconds",
+            "read_bytes" and "written_bytes"
+        """
+        usage = {}
+        try:
+            for line in (group / "cpu.stat").read_text().splitlines():
+                key, _, value = line.partition(" ")
+                if key == "usage_usec":
+                    usage["cpu_seconds"] = int(value) / 1e6
+        except (OSError, ValueError) as e:
+            log.debug("cannot read cpu usage of %s: %s", group, e)
+        if not io:
+            return usage
+        try:
+            read = written = 0
+            # One line per device: "8:0 rbytes=1 wbytes=2 rios=3 wios=4 ..."
+            for line in (group / "io.stat").read_text().splitlines():
+                for field in line.split()[1:]:
+                    key, _, value = field.partition("=")
+                    if key == "rbytes":
+                        read += int(value)
+                    elif key == "wbytes":
+                        written += int(value)
+            usage["read_bytes"], usage["written_bytes"] = read, written
+        except (OSError, ValueError) as e:
+            log.debug("cannot read io usage of %s: %s", group, e)
+        return usage
+
+    def remove(self, group):
+        """ Remove group, which fails if processes of the backup are left. """
+        try:
+            group.rmdir()
+        except OSError as e:
+            log.warning("cannot remove cgroup %s: %s", group, e)
@@ -0,0 +1,102 @@
+import logging
+import os
+from pathlib import Path
+import pickle
+
+from .parser import IncludeLoader
+
+
+log = logging.getLogger("qb.backup")
+
+
+def changed(sources, patterns):
+    """ Whether files changed since they were recorded by an IncludeLoader session.
+
+    :param sources: dict path -> (mtime, size) of the files read
+    :param patterns: set of (directory, pattern) of the `!include` constructors
+    :returns: True if one of the sources was modified or deleted, or if a new
+        file matches one of the patterns
+
+    """
+    included = {str(p) for wd, pattern in patterns for p in wd.glob(pattern)}
+    for path in included | set(sources):
+        try:
+            if IncludeLoader.stat(path) != sources[path]:
+                return True
+        except (OSError, KeyError):
+            # Deleted or newly included file
+            return True
+    return False
+
+
+class CompiledCache:
+    """ File storing a fully resolved configuration document in binary form
+        (pickle), along with the files it was loaded from, so that the YAML files
+        are not parsed again as long as none of them changed.
+
+        >>> compiled = CompiledCache("/var/cache/backup/config.cache")
+        >>> conf = compiled.get("/etc/backup/config.yml")
+        >>> if conf is None:
+        ...     conf = parse_again()
+        ...     compiled.put("/etc/backup/config.yml", conf, sources, patterns)
+
+        WARNING: the file is unpickled, it must be writable by trusted users only.
+    """
+
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def get(self, config_path, strict=False):
+        """ Read the document compiled from config_path.
+
+        :param strict: whether the document must have been loaded in strict mode
+
+        :returns: a tuple (document, sources, patterns), None if the cache is
+            missing, unreadable, or if one of the files changed since
+
+        """
+        try:
+            with open(self.path, "rb") as fd:
+                data = pickle.load(fd)
+            if (data["version"], data["path"], data["strict"]) != (
+                self.VERSION,
+                str(config_path),
+                strict,
+            ):
+                return None
+            sources, patterns = data["sources"], data["patterns"]
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            # Unpickling may raise about anything on a corrupted file
+            log.debug("ignoring unreadable compiled config %s: %s", self.path, e)
+            return None
+        if changed(sources, patterns):
+            return None
+        return data["document"], sources, patterns
+
+    def put(self, config_path, document, sources, patterns, strict=False):
+        """ Store a resolved document, see IncludeLoader.materialize(). Failures
+            are only logged, the cache being an optimization.
+        """
+        data = {
+            "version": self.VERSION,
+            "path": str(config_path),
+            "strict": strict,
+            "sources": sources,
+            "patterns": patterns,
+            "document": document,
+        }
+        tmp = self.path.with_name(".{}.{}".format(self.path.name, os.getpid()))
+        try:
+            with open(tmp, "wb") as fd:
+                pickle.dump(data, fd, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path)
+        except (OSError, pickle.PicklingError) as e:
+            log.warning("cannot write compiled config %s: %s", self.path, e)
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
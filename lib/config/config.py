@@ -1,8 +1,17 @@
+import collections
 import logging
 from pathlib import Path
+import sys
 import yaml
 
 from . import IncludeLoader
+from .compiled import CompiledCache, changed
+from ..breaker import BreakerError, CircuitBreaker
+from ..cgroup import CgroupError, Cgroups
+from ..ramp import LaunchRamp, RampError
+from ..schedule import Cron, ScheduleError, parse_interval
+from ..sharding import Shard, ShardError
+from .. import transport as transport_
 
 
 log = logging.getLogger("qb.backup")
@@ -17,52 +26,202 @@ class Config:
     CONF_LOGGING = Path(__file__).with_name("default.yml").read_text()
 
     class MetaHost(type):
-        def __new__(_, lock=None, port=22):
+        def __new__(
+            _, lock=None, port=22, schedule=None, interval=None, transport=None
+        ):
+            # Host.lock shadows lock in the class body
+            default_lock = lock
+            # Parsed once for all hosts, raises ScheduleError
+            default_schedule = Cron.parse(schedule) if schedule else None
+            default_interval = parse_interval(interval) if interval else None
+            # Raises TransportError
+            default_transport = transport_.parse(transport)
+
             class Host:
-                _lock = lock
-                _port = port
-
-                def __init__(self, hostname, port=None, lock=None):
-                    self.hostname = hostname
-                    try:
-                        self.lock = (
-                            Path(lock)
-                            if lock
-                            else Path(self._lock.format(self.hostname))
-                        )
-                    except AttributeError:
+                """ A host of the configuration. The lock path is only built when
+                    used, and strings shared by many hosts are interned.
+                """
+
+                # fmt: off
+                __slots__ = (
+                    "hostname", "port", "tags", "schedule", "interval", "_lock",
+                    "transport",
+                )
+
+                # Keys accepted by the hosts of a configuration file
+                FIELDS = (
+                    "hostname", "port", "lock", "tags", "schedule", "interval",
+                    "transport",
+                )
+                # fmt: on
+
+                _default_lock = default_lock
+                _default_port = sys.intern(str(port))
+                _default_schedule = default_schedule
+                _default_interval = default_interval
+                _default_transport = default_transport
+                _tags = {}
+
+                def __init__(
+                    self,
+                    hostname,
+                    port=None,
+                    lock=None,
+                    tags=(),
+                    schedule=None,
+                    interval=None,
+                    transport=None,
+                ):
+                    self.hostname = sys.intern(hostname)
+                    self.tags = self._intern_tags(tags)
+                    if schedule is None and interval is None:
+                        self.schedule = self._default_schedule
+                        self.interval = self._default_interval
+                    else:
+                        self.schedule = Cron.parse(schedule) if schedule else None
+                        self.interval = parse_interval(interval) if interval else None
+                    if not lock and self._default_lock is None:
                         log.error(
                             "Either %s lock or default lock MUST be provided",
                             self.hostname,
                         )
-                    self.port = str(port or self._port)
+                    self._lock = lock
+                    self.port = sys.intern(str(port)) if port else self._default_port
+                    # Parsed transports are shared by the hosts
+                    self.transport = (
+                        transport_.parse(transport)
+                        if transport
+                        else self._default_transport
+                    )
+
+                @classmethod
+                def from_entry(cls, entry):
+                    """ Build a host from an item of the hosts of a config file. """
+                    return cls(entry) if isinstance(entry, str) else cls(**entry)
+
+                @classmethod
+                def _intern_tags(cls, tags):
+                    # Hosts share few distinct sets of tags
+                    tags = frozenset(tags)
+                    return cls._tags.setdefault(tags, tags)
+
+                @property
+                def lock(self):
+                    """ Path of the lock file, default one if the host has none.
+
+                    :raises: AttributeError if there is no default lock either
+                    """
+                    lock = self._lock
+                    if not isinstance(lock, Path):
+                        if lock:
+                            lock = Path(lock)
+                        else:
+                            lock = Path(self._default_lock.format(self.hostname))
+                        self._lock = lock
+                    return lock
+
+                def __repr__(self):
+                    return "<Host {}>".format(self.hostname)
 
             return Host
 
+    class Inventory:
+        """ Hosts of a configuration, built only while iterating, so that they can
+            be consumed one by one, e.g. by Backuper, without building them all.
+        """
+
+        __slots__ = ("Host", "entries")
+
+        def __init__(self, Host, entries):
+            self.Host = Host
+            self.entries = entries
+
+        def __len__(self):
+            return len(self.entries)
+
+        def __iter__(self):
+            return map(self.Host.from_entry, self.entries)
+
     @classmethod
-    def load(cls, path):
+    def load(cls, path, cache=None, compiled=None, strict=False):
         """ Load a configuration from a config.yml file.
 
         :param path: file to read from
+        :param cache: if not None, a dict in which included files are cached
+            across calls, only the changed ones are parsed again. The files read
+            are then recorded, see stale().
+        :param compiled: optional path of a file where the resolved configuration
+            is stored, and loaded from instead of parsing the YAML files again as
+            long as none of them changed, see CompiledCache.
+        :param strict: if True, keys shared by several included mappings are an
+            error, see IncludeLoader.
 
         :returns: the configuration read from the file
         :raises: OSError if cannot read path
         :raises: ConfigError if badly formatted configuration file
 
         """
+        compiled = CompiledCache(compiled) if compiled is not None else None
+        if compiled is not None:
+            hit = compiled.get(path, strict)
+            if hit is not None:
+                conf, sources, patterns = hit
+                log.info("Successfully read compiled configuration of %s", path)
+                config = Config(conf)
+                config.sources, config.patterns = sources, patterns
+                return config
+            # Sources must be recorded to validate the compiled configuration
+            cache = {} if cache is None else cache
+
+        loader = IncludeLoader if cache is None else IncludeLoader.session(cache)
+        if strict:
+            loader = type(loader.__name__, (loader,), {"strict": True})
         try:
             with open(path, "r") as fd:
                 log.info("Successfully read configuration from %s", path)
-                return Config(yaml.load(fd, Loader=IncludeLoader))
+                if cache is not None:
+                    loader.sources[str(path)] = loader.stat(fd.fileno())
+                conf = yaml.load(fd, Loader=loader)
+                if compiled is not None:
+                    conf = loader.materialize(conf)
+                config = Config(conf)
         except yaml.YAMLError as e:
             raise ConfigError(e)
+        if cache is not None:
+            for p in set(cache) - set(loader.sources):
+                del cache[p]
+            config.sources = loader.sources
+            config.patterns = loader.patterns
+        if compiled is not None:
+            compiled.put(path, conf, loader.sources, loader.patterns, strict)
+        return config
+
+    def stale(self):
+        """ Whether the files the configuration was loaded from changed since.
+
+        Always False if the configuration was not loaded with a cache.
+        """
+        if self.sources is None:
+            return False
+        return changed(self.sources, self.patterns)
 
     def __init__(self, conf: dict = {}):
+        # Set by load() when files are tracked
+        self.sources = None
+        self.patterns = None
+
         self._init_logging(conf)
         if "logging" not in conf:
             log.warning("No logging configuration given, default is applied")
 
         self._init_hosts(conf)
+        self._init_shard(conf)
+        self._init_cgroup(conf)
+        self._init_launch(conf)
+        self.history = conf.get("history")
+        self.queue = conf.get("queue")
+        self._init_workers(conf)
+        self._init_breaker(conf)
 
     def _init_logging(self, conf: dict = {}):
         conf = conf.get("logging", {})
@@ -73,12 +232,14 @@ class Config:
             # conf["filename"] does not exist
             pass
         try:
-            subject_error = conf["mail"].pop("subject_error", None)
-            subject_status = conf["mail"].pop("subject_status", None)
-            self.logging["handlers"]["mail_error"].update(conf["mail"])
+            # Do not alter conf, which may be cached
+            mail = dict(conf["mail"])
+            subject_error = mail.pop("subject_error", None)
+            subject_status = mail.pop("subject_status", None)
+            self.logging["handlers"]["mail_error"].update(mail)
             if subject_error:
                 self.logging["handlers"]["mail_error"]["subject"] = subject_error
-            self.logging["handlers"]["mail_status"].update(conf["mail"])
+            self.logging["handlers"]["mail_status"].update(mail)
             if subject_status:
                 self.logging["handlers"]["mail_status"]["subject"] = subject_status
         except KeyError:
@@ -91,9 +252,124 @@ class Config:
             del self.logging["handlers"]["mail_status"]
 
     def _init_hosts(self, conf: dict = {}):
-        self.Host = Config.MetaHost(**conf.get("default", {}))
+        try:
+            self.Host = Config.MetaHost(**conf.get("default", {}))
+        except (ScheduleError, transport_.TransportError) as e:
+            raise ConfigError(e)
+
+        # Check the hosts without building them, see the hosts property
+        entries = list(conf.get("hosts", []))
+        fields = set(self.Host.FIELDS)
+        seen, duplicates = set(), set()
+        for entry in entries:
+            if isinstance(entry, str):
+                hostname = entry
+            elif isinstance(entry, collections.abc.Mapping) and "hostname" in entry:
+                hostname = entry["hostname"]
+                unknown = set(entry) - fields
+                if unknown:
+                    raise ConfigError(
+                        "unknown settings of host {}: {}".format(
+                            hostname, ", ".join(sorted(map(str, unknown)))
+                        )
+                    )
+                tags = entry.get("tags", ())
+                if (
+                    not isinstance(tags, collections.abc.Sequence)
+                    or isinstance(tags, str)
+                    or not all(isinstance(tag, str) for tag in tags)
+                ):
+                    raise ConfigError(
+                        "tags of host {} must be a list of strings, not {!r}".format(
+                            hostname, tags
+                        )
+                    )
+                try:
+                    # Both are cached, there are usually few distinct values
+                    if entry.get("schedule"):
+                        Cron.parse(entry["schedule"])
+                    if entry.get("interval"):
+                        parse_interval(entry["interval"])
+                    if entry.get("transport"):
+                        transport_.parse(entry["transport"])
+                except (ScheduleError, transport_.TransportError) as e:
+                    raise ConfigError(e)
+            else:
+                raise ConfigError("host without hostname: {!r}".format(entry))
+            if not isinstance(hostname, str):
+                raise ConfigError(
+                    "hostname must be a string, not {!r}".format(hostname)
+                )
+            if hostname in seen:
+                duplicates.add(hostname)
+            seen.add(hostname)
+        if duplicates:
+            raise ConfigError(
+                "hosts defined several times: {}".format(", ".join(sorted(duplicates)))
+            )
+        self.inventory = Config.Inventory(self.Host, entries)
+        self._hosts = None
+
+    @property
+    def hosts(self):
+        """ List of the hosts, built on first use. Use inventory to iterate over the
+            hosts without building them all at once.
+        """
+        if self._hosts is None:
+            self._hosts = list(self.inventory)
+        return self._hosts
+
+    @hosts.setter
+    def hosts(self, hosts):
+        self._hosts = hosts
+
+    def _init_shard(self, conf: dict = {}):
+        try:
+            self.shard = Shard.parse(conf["shard"]) if "shard" in conf else None
+        except ShardError as e:
+            raise ConfigError(e)
 
-        self.hosts = [
-            self.Host(host) if isinstance(host, str) else self.Host(**host)
-            for host in conf.get("hosts", [])
-        ]
+    def _init_cgroup(self, conf: dict = {}):
+        try:
+            self.cgroup = Cgroups.parse(conf["cgroup"]) if "cgroup" in conf else None
+        except CgroupError as e:
+            raise ConfigError(e)
+
+    def _init_launch(self, conf: dict = {}):
+        try:
+            self.launch = LaunchRamp.parse(conf["launch"]) if "launch" in conf else None
+        except RampError as e:
+            raise ConfigError(e)
+
+    def _init_workers(self, conf: dict = {}):
+        self.workers = conf.get("workers", 1)
+        if (
+            isinstance(self.workers, bool)
+            or not isinstance(self.workers, int)
+            or self.workers < 1
+        ):
+            raise ConfigError(
+                "workers must be a positive integer, not {!r}".format(self.workers)
+            )
+        self.lock_timeout = conf.get("lock_timeout", 0)
+        if (
+            isinstance(self.lock_timeout, bool)
+            or not isinstance(self.lock_timeout, (int, float))
+            or not self.lock_timeout >= 0
+        ):
+            raise ConfigError(
+                "lock_timeout must be a non-negative number, not {!r}".format(
+                    self.lock_timeout
+                )
+            )
+
+    def _init_breaker(self, conf: dict = {}):
+        if "breaker" not in conf:
+            self.breaker = None
+            return
+        if not self.history:
+            raise ConfigError("breaker requires a history")
+        try:
+            self.breaker = CircuitBreaker.parse(conf["breaker"])
+        except BreakerError as e:
+            raise ConfigError(e)
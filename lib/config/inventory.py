@@ -0,0 +1,108 @@
+import csv
+import json
+from pathlib import Path
+import sqlite3
+from urllib.parse import parse_qs, urlsplit
+
+
+# Suffixes of the files whose format is not given in the inventory URL
+SUFFIXES = {
+    ".json": "json",
+    ".csv": "csv",
+    ".db": "sqlite",
+    ".sqlite": "sqlite",
+    ".sqlite3": "sqlite",
+}
+
+
+def parse_url(url, cwd):
+    """ Parse the URL of an inventory: "[json:|csv:|sqlite://]path[?options]".
+
+    The format defaults to the one given by the suffix of the path, relative paths
+    are relative to cwd. Options are `table` or `query` for sqlite, and
+    `delimiter` for csv.
+
+    :returns: a tuple (format, path, options)
+    :raises: ValueError if the format is unknown
+
+    """
+    parts = urlsplit(url)
+    if len(parts.scheme) > 1:
+        # Not a drive letter
+        fmt = parts.scheme
+        path = parts.netloc + parts.path
+    else:
+        fmt = None
+        path = url.split("?", 1)[0]
+    path = cwd / Path(path)
+    fmt = fmt or SUFFIXES.get(path.suffix)
+    if fmt not in LOADERS:
+        raise ValueError("unknown inventory format of {!r}".format(url))
+    options = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+    return fmt, path, options
+
+
+def _entry(row):
+    """ Turn a row of a table into a host entry, as found in config files.
+
+    Empty cells are left out, so that defaults apply, and tags are separated by
+    spaces or commas.
+    """
+    entry = {k: v for k, v in row.items() if v not in (None, "")}
+    tags = entry.get("tags")
+    if isinstance(tags, str):
+        entry["tags"] = tags.replace(",", " ").split()
+    return entry
+
+
+def load_json(path, options):
+    """ A JSON list of hosts, with the same format as in config files. """
+    with open(path, "rb") as fd:
+        hosts = json.load(fd)
+    if not isinstance(hosts, list):
+        raise ValueError("{} must contain a list of hosts".format(path))
+    return hosts
+
+
+def load_csv(path, options):
+    """ A CSV file with a header row, whose columns are host settings. """
+    with open(path, newline="") as fd:
+        reader = csv.DictReader(fd, delimiter=options.get("delimiter", ","))
+        return [_entry(row) for row in reader]
+
+
+def load_sqlite(path, options):
+    """ A table or a query of a SQLite database, whose columns are host settings.
+    """
+    query = options.get("query")
+    if query is None:
+        table = options.get("table", "hosts").replace('"', '""')
+        query = 'SELECT * FROM "{}"'.format(table)
+    # Read-only, do not create a missing database
+    db = sqlite3.connect("{}?mode=ro".format(path.absolute().as_uri()), uri=True)
+    try:
+        db.row_factory = sqlite3.Row
+        return [_entry(dict(row)) for row in db.execute(query)]
+    finally:
+        db.close()
+
+
+LOADERS = {
+    "json": load_json,
+    "csv": load_csv,
+    "sqlite": load_sqlite,
+}
+
+
+def load(fmt, path, options):
+    """ Load the hosts of an inventory.
+
+    :returns: a list of host entries, strings or dicts
+    :raises: OSError if path cannot be read
+    :raises: ValueError if the inventory is badly formatted
+
+    """
+    try:
+        return LOADERS[fmt](path, options)
+    except (csv.Error, sqlite3.Error) as e:
+        raise ValueError("cannot load {}: {}".format(path, e))
@@ -1,21 +1,73 @@
 import collections
+from concurrent.futures import ProcessPoolExecutor
 import itertools
+import os
 from pathlib import Path
 import yaml
 
+from . import inventory
 
-class IncludeLoader(yaml.SafeLoader):
+
+class IncludeLoaderMixin:
     """ Loader that allows `!include` constructor. Include a yaml file under the given
         key. Wildcards in the filename are allowed but the behavior is undefined in case
         of recursive includes or in case of heterogeneous files.
 
-        WARNING: When loading a collection of mappings thanks to a wildcard, if two of more
-        mappings share the same key the behavior for this key is undefined.
+        Files matched by a wildcard are merged in sorted order: when loading a
+        collection of mappings, if two or more mappings share the same key, the
+        value of the last file is kept, unless `strict` is set in which case the
+        conflicting keys are reported as an error. When more than `parallel` files
+        are matched, they are parsed in a pool of `processes` processes.
+
+        Mixed with either the pure python yaml.SafeLoader (PyIncludeLoader) or the
+        libyaml based yaml.CSafeLoader (CIncludeLoader), IncludeLoader being the
+        fastest one available.
     """
 
+    # Minimum number of files matched by a wildcard to parse them in a process
+    # pool, 0 to never use one
+    parallel = 64
+    processes = None
+    # Whether keys shared by included mappings are an error
+    strict = False
+
+    # Set on loader classes created by session()
+    cache = None
+    sources = None
+    patterns = None
+    # Number of files or inventories included so far by the session
+    includes = 0
+
+    @classmethod
+    def session(cls, cache=None):
+        """ Create a loader class which records the files it includes, so that
+            changes can be detected, and which reuses the documents of unchanged
+            included files from cache.
+
+        :param cache: dict shared among sessions, updated with the included files
+        :returns: a subclass of this loader
+
+        """
+        attrs = {
+            "cache": {} if cache is None else cache,
+            # path -> (mtime, size) of included files
+            "sources": {},
+            # (directory, pattern) of !include constructors
+            "patterns": set(),
+            "includes": 0,
+        }
+        return type(cls.__name__, (cls,), attrs)
+
+    @staticmethod
+    def stat(path):
+        """ Key identifying the version of a file. """
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+
     def __init__(self, stream):
         super().__init__(stream)
         self.add_constructor("!include", type(self).include)
+        self.add_constructor("!inventory", type(self).inventory)
         try:
             self.cwd = Path(stream.name).parent
         except AttributeError:
@@ -26,31 +78,143 @@ class IncludeLoader(yaml.SafeLoader):
         if pattern.startswith("/"):
             wd = Path("/")
             pattern = Path(pattern).relative_to(wd).as_posix()
-            files = wd.glob(pattern)
         else:
-            files = self.cwd.glob(pattern)
-        return IncludeLoader.merge(IncludeLoader._load_paths(files))
+            wd = self.cwd
+        if self.patterns is not None:
+            self.patterns.add((wd, pattern))
+            type(self).includes += 1
+        paths = sorted(wd.glob(pattern))
+        try:
+            return self.merge(type(self)._load_paths(paths), paths, self.strict)
+        except ValueError as e:
+            raise yaml.constructor.ConstructorError(
+                "while including {!r}".format(pattern), node.start_mark, str(e)
+            )
 
-    @staticmethod
-    def _load_paths(paths):
-        """ Load several yaml files from an iterable of paths
+    def inventory(self, node):
+        """ Load a list of hosts from a JSON, CSV or SQLite inventory, e.g.
+            `hosts: !inventory sqlite:///etc/backup/hosts.db?table=hosts`, see
+            inventory.parse_url().
+        """
+        url = self.construct_scalar(node)
+        try:
+            fmt, path, options = inventory.parse_url(url, self.cwd)
+            if self.sources is None:
+                return inventory.load(fmt, path, options)
+            self.sources[str(path)] = self.stat(path)
+            type(self).includes += 1
+            # The same file may be queried with other options
+            key = self.sources[str(path)], fmt, sorted(options.items())
+            cached_key, hosts = self.cache.get(str(path), (None, None))
+            if cached_key != key:
+                hosts = inventory.load(fmt, path, options)
+                self.cache[str(path)] = key, hosts
+            return hosts
+        except (OSError, ValueError) as e:
+            raise yaml.constructor.ConstructorError(
+                "while loading inventory {!r}".format(url), node.start_mark, str(e)
+            )
+
+    @classmethod
+    def _load_paths(cls, paths):
+        """ Load several yaml files from a list of paths
 
-        :param paths: an iterable of paths
-        :returns: a generator of loaded yaml
+        :param paths: a list of paths
+        :returns: a generator of loaded yaml, in the order of paths
 
         """
+        if cls.parallel and len(paths) >= cls.parallel:
+            yield from cls._load_paths_parallel(paths)
+            return
         for p in paths:
+            if cls.sources is None:
+                with open(p, "rb") as fd:
+                    yield yaml.load(fd, Loader=cls)
+                continue
+            key = cls.sources[str(p)] = cls.stat(p)
+            try:
+                cached_key, document = cls.cache[str(p)]
+                if cached_key == key:
+                    yield document
+                    continue
+            except KeyError:
+                pass
+            includes = cls.includes
             with open(p, "rb") as fd:
-                yield yaml.load(fd, Loader=IncludeLoader)
+                document = yaml.load(fd, Loader=cls)
+            # The results of !include are lazy and can only be read once, and
+            # changes of the files it includes would not be detected
+            if cls.includes == includes:
+                cls.cache[str(p)] = key, document
+            yield document
+
+    @classmethod
+    def _load_paths_parallel(cls, paths):
+        """ Same as _load_paths, but parse the files in a process pool. """
+        documents = [None] * len(paths)
+        todo = []
+        for i, p in enumerate(paths):
+            if cls.sources is not None:
+                key = cls.sources[str(p)] = cls.stat(p)
+                cached = cls.cache.get(str(p))
+                if cached is not None and cached[0] == key:
+                    documents[i] = cached[1]
+                    continue
+            todo.append(i)
+
+        # Session classes cannot be pickled, the module level one is used instead
+        base = PyIncludeLoader
+        if CIncludeLoader is not None and issubclass(cls, CIncludeLoader):
+            base = CIncludeLoader
+        processes = cls.processes or os.cpu_count() or 1
+        chunksize = max(1, len(todo) // (4 * processes))
+        with ProcessPoolExecutor(processes) as executor:
+            loaded = executor.map(
+                _load_file,
+                itertools.repeat(base),
+                (paths[i] for i in todo),
+                itertools.repeat(cls.strict),
+                chunksize=chunksize,
+            )
+            for i, (document, sources, patterns) in zip(todo, loaded):
+                documents[i] = document
+                if cls.sources is None:
+                    continue
+                cls.sources.update(sources)
+                cls.patterns.update(patterns)
+                # Changes of the files it includes would not be detected
+                if not patterns and not sources:
+                    cls.cache[str(paths[i])] = cls.sources[str(paths[i])], document
+        return documents
+
+    @staticmethod
+    def materialize(document):
+        """ Turn the lazy results of `!include` (ChainMap and iterators) of a loaded
+            document into plain dicts and lists, so that it can be pickled and
+            used several times.
+        """
+        materialize = IncludeLoaderMixin.materialize
+        if isinstance(document, collections.abc.Mapping):
+            return {k: materialize(v) for k, v in document.items()}
+        if isinstance(document, (list, tuple, itertools.chain)):
+            return [materialize(v) for v in document]
+        return document
 
     @staticmethod
-    def merge(iterable):
-        """ Merge elements of an iterable of Mappings or Sequences into either a Mapping
+    def merge(iterable, paths=None, strict=False):
+        """ Merge elements of an iterable of Mappings or Sequences into either a dict
             or a Sequence. UB if iterable is heterogeneous.
 
+        Mappings are flattened into a single dict, a key of a mapping overriding
+        the same key of the previous mappings.
+
         :param iterable: iterable of Mapping or Sequence
-        :returns: A Mapping containing all Mappings or a Sequence containing all
+        :param paths: optional paths the elements were loaded from, used to report
+            conflicting keys
+        :param strict: if True, keys shared by several mappings are an error
+        :returns: A dict containing all Mappings or a Sequence containing all
             Sequences
+        :raises: ValueError if strict and mappings share keys
 
         """
         try:
@@ -59,9 +223,64 @@ class IncludeLoader(yaml.SafeLoader):
         except StopIteration:
             return []
 
-        if isinstance(first, collections.abc.Mapping):
-            mapping = collections.ChainMap(first, *it)
-            mapping.maps.reverse()
-            return mapping
-        else:
+        if not isinstance(first, collections.abc.Mapping):
             return itertools.chain.from_iterable(itertools.chain(iter((first,)), it))
+
+        mapping = dict(first)
+        if not strict:
+            for m in it:
+                mapping.update(m)
+            return mapping
+
+        # Index of the element defining each key, to report conflicts
+        origins = dict.fromkeys(first, 0)
+        conflicts = []
+        for i, m in enumerate(it, 1):
+            for key, value in m.items():
+                if key in origins:
+                    conflicts.append((key, origins[key], i))
+                origins[key] = i
+                mapping[key] = value
+        if conflicts:
+            name = (lambda i: str(paths[i])) if paths is not None else str
+            raise ValueError(
+                "keys defined several times: "
+                + ", ".join(
+                    "{!r} in {} and {}".format(key, name(i), name(j))
+                    for key, i, j in conflicts
+                )
+            )
+        return mapping
+
+
+class PyIncludeLoader(IncludeLoaderMixin, yaml.SafeLoader):
+    pass
+
+
+try:
+
+    class CIncludeLoader(IncludeLoaderMixin, yaml.CSafeLoader):
+        pass
+
+except AttributeError:
+    # PyYAML built without libyaml
+    CIncludeLoader = None
+
+
+IncludeLoader = CIncludeLoader or PyIncludeLoader
+
+
+def _load_file(loader, path, strict):
+    """ Load a yaml file in a worker process of IncludeLoader._load_paths_parallel.
+
+    :returns: a tuple (document, sources, patterns), sources and patterns being
+        the ones of the files included by path
+
+    """
+    session = loader.session()
+    # Never start a pool from a worker process
+    session.parallel = 0
+    session.strict = strict
+    with open(path, "rb") as fd:
+        document = loader.materialize(yaml.load(fd, Loader=session))
+    return document, session.sources, session.patterns
@@ -0,0 +1,244 @@
+from datetime import datetime
+import itertools
+import logging
+import logging.config
+import signal
+import threading
+import time
+
+from .backup import Backuper
+from .config import Config
+from .history import History
+from .schedule import Schedule
+from ._utils import FairSlots
+
+
+log = logging.getLogger("qb.backup")
+log_progress = logging.getLogger("qb.backup.progress")
+
+
+def flush_handlers():
+    """ Flush the handlers of qb.backup loggers, e.g. to send buffered mails. """
+    for logger in (log, log_progress):
+        for handler in logger.handlers:
+            handler.flush()
+
+
+class Daemon:
+    """ Keep a configuration in memory and backup hosts when they are due,
+        according to their schedule or interval.
+
+        Hosts due together are backuped by a run of their own, started in a
+        thread while the ones of hosts due earlier may still be going on; the
+        runs share the workers of the configuration, and each host is scheduled
+        again once its own backup is over. Meanwhile, the configuration is
+        reloaded on SIGHUP, or when one of its files changed if poll is set; only
+        changed included files are parsed again. SIGTERM and SIGINT stop the
+        daemon once the running backups are over.
+
+        >>> cache = {}
+        >>> daemon = Daemon(path, Config.load(path, cache=cache), cache=cache)
+        >>> daemon.run_forever()
+
+    """
+
+    def __init__(
+        self,
+        path,
+        config,
+        cache=None,
+        compiled=None,
+        strict=False,
+        select=None,
+        poll=60,
+    ):
+        """
+        :param path: path of the configuration file
+        :param config: configuration loaded from path, with logging not applied
+        :param cache: cache used to load config, see Config.load
+        :param compiled: compiled configuration file, see Config.load
+        :param strict: whether included mappings must not share keys, see
+            Config.load
+        :param select: function returning the hosts to backup from a config,
+            defaults to all the hosts of the config
+        :param poll: interval in seconds between checks for configuration
+            changes, 0 to only reload on SIGHUP
+
+        """
+        self.path = path
+        self.cache = {} if cache is None else cache
+        self.compiled = compiled
+        self.strict = strict
+        self.select = select or (lambda config: config.hosts)
+        self.poll = poll
+        self.config = None
+        self.schedule = Schedule()
+        # Guards schedule, rescheduled by the threads of the runs
+        self._lock = threading.Lock()
+        self.slots = None
+        # Threads of the runs started, see run_due()
+        self.runs = []
+        self._names = itertools.count(1)
+        self.wakeup = threading.Event()
+        self.reload_requested = False
+        self.stopping = False
+        self.apply(config)
+
+    def apply(self, config):
+        """ Start using a configuration.
+
+        :raises: ValueError if the hosts cannot be selected, or if logging cannot
+            be configured
+        """
+        if self.config is None or config.logging != self.config.logging:
+            logging.config.dictConfig(config.logging)
+        hosts = self.select(config)
+        last_runs = self.last_runs(config) if self.config is None else None
+        if self.config is None or config.workers != self.config.workers:
+            # The runs going on keep the slots they were started with
+            self.slots = FairSlots(config.workers)
+        with self._lock:
+            self.schedule.update(hosts, datetime.now(), last_runs)
+            scheduled = len(self.schedule)
+        self.config = config
+        ignored = len(hosts) - scheduled
+        if ignored:
+            log.warning("%d hosts without schedule nor interval are ignored", ignored)
+        log.info("%d hosts scheduled", scheduled)
+
+    @staticmethod
+    def last_runs(config):
+        """ Local datetime of the last run of each host, from history. """
+        if not config.history:
+            return {}
+        with History(config.history) as history:
+            runs = history.last_runs()
+        return {
+            hostname: datetime.fromisoformat(run).astimezone().replace(tzinfo=None)
+            for hostname, run in runs.items()
+        }
+
+    def reload(self):
+        """ Reload the configuration, keep the current one if it is invalid. """
+        self.reload_requested = False
+        try:
+            self.apply(
+                Config.load(
+                    self.path,
+                    cache=self.cache,
+                    compiled=self.compiled,
+                    strict=self.strict,
+                )
+            )
+        except (OSError, ValueError) as e:
+            log.error("cannot reload %s, configuration unchanged: %s", self.path, e)
+
+    def run_due(self, now):
+        """ Start backuping the hosts due at now, in a thread of their own.
+
+        :returns: the started thread, None if no host is due
+        """
+        with self._lock:
+            hosts = self.schedule.due(now)
+        if not hosts:
+            return None
+        name = "run{}".format(next(self._names))
+        thread = threading.Thread(target=self._run, args=(hosts, now, name), name=name)
+        thread.start()
+        self.runs = [run for run in self.runs if run.is_alive()]
+        self.runs.append(thread)
+        return thread
+
+    def _run(self, hosts, started, name):
+        try:
+            self.backup(hosts, started, name)
+        except Exception as e:
+            log.exception(e)
+            flush_handlers()
+
+    def backup(self, hosts, started, name=None):
+        """ Backup hosts due at started with the current configuration, each host
+            being rescheduled once its backup is over.
+
+        :param name: name of the run, see Backuper
+        :returns: the return code of the run
+        """
+        config, slots = self.config, self.slots
+        # Hosts whose backup is not over, rescheduled anyway if the run fails
+        pending = {host.hostname: host for host in hosts}
+
+        def on_done(host):
+            pending.pop(host.hostname, None)
+            self.reschedule([host], started)
+
+        history = History(config.history) if config.history else None
+        try:
+            return Backuper(
+                hosts,
+                history=history,
+                workers=config.workers,
+                lock_timeout=config.lock_timeout,
+                on_done=on_done,
+                name=name,
+                slots=slots,
+                cgroups=config.cgroup,
+                launch=config.launch,
+                breaker=config.breaker,
+            ).run()
+        finally:
+            if history is not None:
+                history.close()
+            self.reschedule(pending.values(), started)
+            flush_handlers()
+
+    def reschedule(self, hosts, started):
+        """ Schedule hosts again after their backup, see Schedule.reschedule. """
+        with self._lock:
+            self.schedule.reschedule(hosts, started, datetime.now())
+        # Their next due time may be the earliest one
+        self.wakeup.set()
+
+    def _on_reload(self, signum, frame):
+        self.reload_requested = True
+        self.wakeup.set()
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+        self.wakeup.set()
+
+    def run_forever(self):
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        log.info("daemon started")
+        polled = time.monotonic()
+        while not self.stopping:
+            if self.reload_requested:
+                self.reload()
+            elif self.poll and time.monotonic() - polled >= self.poll:
+                polled = time.monotonic()
+                if self.config.stale():
+                    log.info("configuration changed, reloading")
+                    self.reload()
+
+            try:
+                self.run_due(datetime.now())
+            except Exception as e:
+                log.exception(e)
+                flush_handlers()
+
+            timeout = self.poll or None
+            with self._lock:
+                next_due = self.schedule.next_due()
+            if next_due is not None:
+                until = max((next_due - datetime.now()).total_seconds(), 0)
+                timeout = min(timeout, until) if timeout else until
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+        runs = [run for run in self.runs if run.is_alive()]
+        if runs:
+            log.info("waiting for %d runs to be over", len(runs))
+        for run in runs:
+            run.join()
+        log.info("daemon stopped")
+        return 0
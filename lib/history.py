@@ -0,0 +1,196 @@
+import sqlite3
+import statistics
+
+
+class History:
+    """ Persistent record of per-host backup results, stored in a SQLite database.
+
+    >>> history = History("/var/lib/backup/history.db")
+    >>> history.record("2020-02-01T03:00:00", "foo.example.com", "SUCCEEDED", 3600.0)
+    >>> history.durations()
+    {'foo.example.com': 3600.0}
+
+    """
+
+    # Columns of the results table. New columns can be appended, they are added
+    # to existing databases when opened.
+    _COLUMNS = (
+        ("run", "TEXT NOT NULL"),
+        ("hostname", "TEXT NOT NULL"),
+        ("status", "TEXT NOT NULL"),
+        ("duration", "REAL"),
+        # Statistics of borg, see BorgStats.metrics()
+        ("original_size", "INTEGER"),
+        ("compressed_size", "INTEGER"),
+        ("deduplicated_size", "INTEGER"),
+        ("files", "INTEGER"),
+        ("throughput", "REAL"),
+    )
+
+    def __init__(self, path):
+        self.path = path
+        # Autocommit mode, every record is written as soon as possible
+        self.db = sqlite3.connect(str(path), isolation_level=None, timeout=60)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results ({})".format(
+                ", ".join(" ".join(c) for c in self._COLUMNS)
+            )
+        )
+        existing = {row[1] for row in self.db.execute("PRAGMA table_info(results)")}
+        for name, decl in self._COLUMNS:
+            if name not in existing:
+                self.db.execute(
+                    "ALTER TABLE results ADD COLUMN {} {}".format(
+                        name, decl.replace(" NOT NULL", "")
+                    )
+                )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS results_hostname ON results (hostname, run)"
+        )
+        self._init_streaks()
+
+    def _init_streaks(self):
+        # Current failure streaks, kept up to date by record() so that they can
+        # be read without scanning the whole results table. Databases created
+        # before the table existed are replayed once.
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            exists = self.db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'streaks'"
+            ).fetchone()
+            if not exists:
+                self.db.execute(
+                    "CREATE TABLE streaks (hostname TEXT PRIMARY KEY,"
+                    " failures INTEGER NOT NULL, since TEXT, skipped INTEGER NOT NULL)"
+                )
+                rows = self.db.execute(
+                    "SELECT run, hostname, status FROM results ORDER BY hostname, run"
+                ).fetchall()
+                for row in rows:
+                    self._update_streak(*row)
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def record(self, run, hostname, status, duration=None, **extra):
+        """ Record the result of the backup of a host.
+
+        :param run: identifier of the run, runs are ordered by identifier
+        :param hostname: hostname of the backuped host
+        :param status: "SUCCEEDED", "FAILED" or "OPEN" (skipped by the circuit
+            breaker)
+        :param duration: duration of the backup in seconds
+        :param extra: values of other columns
+
+        """
+        values = dict(
+            extra, run=run, hostname=hostname, status=status, duration=duration
+        )
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.execute(
+                "INSERT INTO results ({}) VALUES ({})".format(
+                    ", ".join(values), ", ".join("?" * len(values))
+                ),
+                tuple(values.values()),
+            )
+            self._update_streak(run, hostname, status)
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def _update_streak(self, run, hostname, status):
+        if status == "FAILED":
+            self.db.execute(
+                "INSERT OR REPLACE INTO streaks (hostname, failures, since, skipped)"
+                " SELECT ?, COALESCE(MAX(failures), 0) + 1, COALESCE(MIN(since), ?), 0"
+                " FROM streaks WHERE hostname = ?",
+                (hostname, run, hostname),
+            )
+        elif status == "OPEN":
+            # Skipped runs do not break the streak
+            self.db.execute(
+                "UPDATE streaks SET skipped = skipped + 1 WHERE hostname = ?",
+                (hostname,),
+            )
+        else:
+            self.db.execute("DELETE FROM streaks WHERE hostname = ?", (hostname,))
+
+    def results(self, hostname, last=None, status=None):
+        """ Most recent results of a host, newest first.
+
+        :param hostname: hostname of the host
+        :param last: maximum number of results returned
+        :param status: only return results with this status
+        :returns: a list of dicts mapping column names to values
+
+        """
+        query = "SELECT * FROM results WHERE hostname = ?"
+        params = [hostname]
+        if status is not None:
+            query += " AND status = ?"
+            params.append(status)
+        query += " ORDER BY run DESC"
+        if last is not None:
+            query += " LIMIT ?"
+            params.append(last)
+        cursor = self.db.execute(query, params)
+        names = [d[0] for d in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+
+    def last_runs(self):
+        """ Identifier of the last run of each host.
+
+        :returns: a dict mapping hostnames to run identifiers
+        """
+        rows = self.db.execute(
+            "SELECT hostname, MAX(run) FROM results GROUP BY hostname"
+        )
+        return dict(rows)
+
+    def streaks(self):
+        """ Current failure streak of each host, its backups skipped while its
+            circuit was open (status "OPEN", see CircuitBreaker) not breaking it.
+
+        :returns: a dict mapping the hostnames whose last backup failed to dicts
+            with keys "failures" (number of consecutive failed backups), "since"
+            (run of the first of them) and "skipped" (number of runs the host was
+            skipped since its last backup)
+
+        """
+        rows = self.db.execute("SELECT hostname, failures, since, skipped FROM streaks")
+        return {
+            hostname: {"failures": failures, "since": since, "skipped": skipped}
+            for hostname, failures, since, skipped in rows
+        }
+
+    def durations(self, last=5):
+        """ Expected duration of each host backup.
+
+        :param last: number of recent successful runs to consider per host
+        :returns: a dict mapping hostnames to the median duration of their last
+            successful backups, in seconds
+
+        """
+        rows = self.db.execute(
+            "SELECT hostname, duration FROM results"
+            " WHERE status = 'SUCCEEDED' AND duration IS NOT NULL"
+            " ORDER BY hostname, run DESC"
+        )
+        samples = {}
+        for hostname, duration in rows:
+            durations = samples.setdefault(hostname, [])
+            if len(durations) < last:
+                durations.append(duration)
+        return {h: statistics.median(d) for h, d in samples.items()}
@@ -1,5 +1,6 @@
 import collections
-from logging import CRITICAL
+import copy
+from logging import CRITICAL, Filter
 from logging.handlers import BufferingHandler
 from smtplib import SMTP, SMTPException
 import sys
@@ -10,7 +11,12 @@ META = CRITICAL + 10
 
 class BufferingSMTPHandler(BufferingHandler):
 
-    _SUBSTITUTE_WORDS = ["SUCCEEDED", "FAILED", "SKIPPED", "TOTAL", "RUNTIME", "STATUS"]
+    # fmt: off
+    _SUBSTITUTE_WORDS = [
+        "SUCCEEDED", "FAILED", "SKIPPED", "TOTAL", "RUNTIME", "STATUS", "REGRESSED",
+        "OPEN",
+    ]
+    # fmt: on
 
     def __init__(self, capacity, mailhost, fromaddr, toaddrs, subject):
         super().__init__(capacity)
@@ -67,3 +73,69 @@ class BufferingSMTPHandler(BufferingHandler):
         except Exception as e:
             print("Unknown Exception when sending email: {}".format(e), file=sys.stderr)
             self.handleError(None)
+
+
+class ThreadFilter(Filter):
+    """ Only let through the records of the threads of a configuration, or of
+        threads which belong to none, when several configurations are run in one
+        process. Threads are named after their configuration, the workers of a
+        Backuper being named "<name>_<number>".
+    """
+
+    def __init__(self, tag, tags):
+        super().__init__()
+        self.tag = tag
+        self.tags = set(tags)
+
+    def filter(self, record):
+        owner = record.threadName.split("_")[0]
+        return owner == self.tag or owner not in self.tags
+
+
+def combine(confs, tags):
+    """ Combine the logging configurations of several configurations run in one
+        process, see Config.logging.
+
+    The handlers of each configuration are kept, and only handle the records of
+    the threads of the configuration, see ThreadFilter. The console handler of
+    the first configuration is shared by all of them.
+
+    :param confs: logging configurations, as given to logging.config.dictConfig
+    :param tags: names of the threads of each configuration
+    :returns: a configuration for logging.config.dictConfig
+
+    """
+    combined = {
+        "version": 1,
+        "formatters": {},
+        "filters": {},
+        "handlers": {},
+        "loggers": {},
+    }
+    for conf, tag in zip(confs, tags):
+        combined["filters"][tag] = {"()": ThreadFilter, "tag": tag, "tags": tags}
+        for name, formatter in conf.get("formatters", {}).items():
+            combined["formatters"]["{}.{}".format(tag, name)] = formatter
+        names = {}
+        for name, handler in conf.get("handlers", {}).items():
+            if name == "console":
+                if name not in combined["handlers"]:
+                    combined["handlers"][name] = dict(
+                        handler, formatter="{}.{}".format(tag, handler["formatter"])
+                    )
+                names[name] = name
+                continue
+            handler = copy.deepcopy(handler)
+            if "formatter" in handler:
+                handler["formatter"] = "{}.{}".format(tag, handler["formatter"])
+            handler["filters"] = [tag]
+            names[name] = "{}.{}".format(tag, name)
+            combined["handlers"][names[name]] = handler
+        for name, logger in conf.get("loggers", {}).items():
+            combined_logger = combined["loggers"].setdefault(
+                name, dict(logger, handlers=[])
+            )
+            for handler in logger.get("handlers", []):
+                if names[handler] not in combined_logger["handlers"]:
+                    combined_logger["handlers"].append(names[handler])
+    return combined
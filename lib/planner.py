@@ -0,0 +1,74 @@
+import collections
+import heapq
+import statistics
+
+
+def simulate(hosts, durations=None, workers=1, lock_timeout=0):
+    """ Simulate a run of Backuper with a discrete-event model, without running
+        any backup.
+
+    Hosts are started in order as soon as a worker is free, on the free worker
+    with the lowest number. As in Backuper.run(), a host whose lock is held by a
+    running backup is re-queued, tried again once the other hosts are started,
+    and then waits at most lock_timeout seconds for its lock before failing.
+
+    :param hosts: iterable of hosts, in the order of the run
+    :param durations: optional mapping hostname -> expected duration in seconds,
+        see History.durations(). Hosts without known duration are given the
+        median of known ones.
+    :param workers: number of backups run concurrently
+    :param lock_timeout: see Backuper
+    :returns: a dict with keys
+        "makespan": predicted duration of the run, in seconds
+        "busy": time each worker slot is busy, in seconds
+        "hosts": list of the planned backups, in order of start, as dicts with
+            keys "hostname", "slot", "start", "end", "estimated" (whether the
+            duration is not known from history) and "status" ("SUCCEEDED", or
+            "FAILED" if the lock is never acquired)
+
+    """
+    durations = durations or {}
+    default = statistics.median(durations.values()) if durations else 0.0
+    pending = collections.deque(hosts)
+    requeued = collections.deque()
+    slots = list(range(workers))
+    busy = [0.0] * workers
+    # (end, slot) of the running backups
+    running = []
+    # Time at which each lock is released by the backups holding or awaiting it
+    released = {}
+    planned = []
+    now = 0.0
+    while True:
+        while slots and (pending or requeued):
+            retry = not pending
+            host = requeued.popleft() if retry else pending.popleft()
+            lock = str(host.lock)
+            wait = max(0.0, released.get(lock, 0.0) - now)
+            if wait and not retry:
+                requeued.append(host)
+                continue
+            slot = heapq.heappop(slots)
+            duration = durations.get(host.hostname, default)
+            if wait > lock_timeout:
+                status, start, end = "FAILED", now + lock_timeout, now + lock_timeout
+            else:
+                status, start, end = "SUCCEEDED", now + wait, now + wait + duration
+                released[lock] = end
+            heapq.heappush(running, (end, slot))
+            busy[slot] += end - now
+            planned.append(
+                {
+                    "hostname": host.hostname,
+                    "slot": slot,
+                    "start": start,
+                    "end": end,
+                    "estimated": host.hostname not in durations,
+                    "status": status,
+                }
+            )
+        if not running:
+            break
+        now, slot = heapq.heappop(running)
+        heapq.heappush(slots, slot)
+    return {"makespan": now, "busy": busy, "hosts": planned}
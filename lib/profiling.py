@@ -0,0 +1,172 @@
+import cProfile
+import io
+import logging
+from pathlib import Path
+import pstats
+import sys
+import threading
+import tracemalloc
+
+
+log = logging.getLogger("qb.backup")
+
+# Frames of the allocations which are not the ones of the profiled process
+_IGNORED = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def buffered_records(loggers=("qb.backup", "qb.backup.progress")):
+    """ Number of records buffered by each handler of loggers holding a buffer,
+        e.g. BufferingSMTPHandler until the mails are sent.
+    """
+    counts = {}
+    for name in loggers:
+        for handler in logging.getLogger(name).handlers:
+            buffer = getattr(handler, "buffer", None)
+            if buffer is not None:
+                counts[handler.get_name() or repr(handler)] = len(buffer)
+    return counts
+
+
+class Profiler:
+    """ Profile the CPU and memory usage of the process running the backups, and
+        write the reports to a directory.
+
+        >>> with Profiler("/tmp/profile") as profiler:
+        ...     config = Config.load(path)
+        ...     profiler.snapshot("config")
+        ...     Backuper(hosts, on_done=profiler.on_done()).run()
+
+        cProfile follows all the threads, each of them being profiled on its own
+        before python 3.12, and is written as cpu.prof (see pstats) and cpu.txt,
+        the functions taking the most time. tracemalloc snapshots are written as
+        memory-<number>-<label>.txt, with the top allocating lines and their
+        growth since the previous snapshot. A snapshot is taken every `every`
+        hosts and when the profiler stops.
+    """
+
+    def __init__(self, directory, every=100, frames=5, top=40):
+        """
+        :param directory: directory of the reports, created if needed
+        :param every: number of hosts between snapshots, see on_done()
+        :param frames: number of frames stored for each allocation
+        :param top: number of functions and lines in the reports
+
+        """
+        self.directory = Path(directory)
+        self.every = every
+        self.frames = frames
+        self.top = top
+        self.snapshots = 0
+        self.hosts = 0
+        self._previous = None
+        self._profiles = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """ Start profiling the process.
+
+        :raises: OSError if the directory cannot be created
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tracemalloc.start(self.frames)
+        profile = cProfile.Profile()
+        self._profiles.append(profile)
+        # Since python 3.12, cProfile relies on sys.monitoring and follows every
+        # thread; before, each thread started from now on gets its own profile.
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._profile_thread)
+        profile.enable()
+
+    def _profile_thread(self, frame, event, arg):
+        # Called once by each new thread, the profile replaces this function
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def on_done(self, callback=None):
+        """ Function to be called with each host once its backup is over, taking a
+            snapshot every `every` hosts, and calling callback if given.
+        """
+
+        def on_done(host):
+            if callback is not None:
+                callback(host)
+            with self._lock:
+                self.hosts += 1
+                due = self.every and self.hosts % self.every == 0
+            if due:
+                self.snapshot("hosts-{}".format(self.hosts))
+
+        return on_done
+
+    def snapshot(self, label):
+        """ Take a tracemalloc snapshot and write its report. """
+        snapshot = tracemalloc.take_snapshot().filter_traces(_IGNORED)
+        current, peak = tracemalloc.get_traced_memory()
+        with self._lock:
+            self.snapshots += 1
+            previous, self._previous = self._previous, snapshot
+            path = self.directory / "memory-{:02d}-{}.txt".format(self.snapshots, label)
+        lines = [
+            "Snapshot {}: {} hosts done".format(label, self.hosts),
+            "Traced memory: current {:.1f} MiB, peak {:.1f} MiB".format(
+                current / 2 ** 20, peak / 2 ** 20
+            ),
+        ]
+        for name, count in buffered_records().items():
+            lines.append("Buffered log records: {} {}".format(name, count))
+        lines.append("")
+        lines.append("Top {} allocating lines:".format(self.top))
+        lines.extend(map(str, snapshot.statistics("lineno")[: self.top]))
+        if previous is not None:
+            lines.append("")
+            lines.append("Top {} growths since the previous snapshot:".format(self.top))
+            lines.extend(map(str, snapshot.compare_to(previous, "lineno")[: self.top]))
+        path.write_text("\n".join(lines) + "\n")
+        log.debug("memory snapshot written to %s", path)
+
+    def stop(self):
+        """ Take a last snapshot, stop profiling and write the CPU report. """
+        if sys.version_info < (3, 12):
+            threading.setprofile(None)
+        main = self._profiles[0]
+        main.disable()
+        try:
+            self.snapshot("end")
+        finally:
+            tracemalloc.stop()
+        stats = None
+        with self._lock:
+            profiles = list(self._profiles)
+        for profile in profiles:
+            # Stats of the profiles of threads still running are taken as is
+            profile.create_stats()
+            if not profile.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        if stats is None:
+            return
+        stats.dump_stats(str(self.directory / "cpu.prof"))
+        out = io.StringIO()
+        stats.stream = out
+        for key in ("cumulative", "tottime"):
+            print("Top {} functions by {} time:".format(self.top, key), file=out)
+            stats.sort_stats(key).print_stats(self.top)
+        (self.directory / "cpu.txt").write_text(out.getvalue())
+        log.info("profile written to %s", self.directory)
@@ -0,0 +1,140 @@
+import collections.abc
+import logging
+import random
+import re
+import threading
+import time
+
+
+log = logging.getLogger("qb.backup")
+
+# Errors printed by the host when its tunnel to the local sshd, forwarded from
+# port 64064 of the host, is refused, e.g. once MaxStartups unauthenticated
+# connections are pending: "Connection closed by 127.0.0.1 port 64064". Only the
+# loopback address of the tunnel is matched: errors of the connection to the host
+# itself, such as "connect to host foo port 22: Connection refused", and the
+# kex_exchange_identification errors, printed as well when the sshd of the host
+# drops the connection of the backup, are not.
+REFUSED = re.compile(r"\b(?:localhost|127\.0\.0\.1|::1) port 64064\b")
+
+
+class RampError(ValueError):
+    pass
+
+
+class LaunchRamp:
+    """ Token bucket limiting the rate at which backup sessions are started, so
+        that the tunnels of many hosts do not reach the local sshd at once.
+
+        >>> ramp = LaunchRamp(rate=2, burst=5, jitter=1)
+        >>> ramp.acquire()  # before connecting to a host
+        >>> ramp.throttle()  # when the tunnel of a host is refused
+        >>> ramp.recover()  # once a backup is over
+
+        Up to burst sessions start at once, then rate per second, each delayed
+        by a random jitter of up to jitter seconds. Refused tunnels divide the
+        current rate by 1/backoff, at most once per launch interval, down to
+        min_rate; successful backups raise it back by a tenth of rate.
+    """
+
+    def __init__(
+        self,
+        rate,
+        burst=1,
+        jitter=0.0,
+        backoff=0.5,
+        min_rate=None,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        """
+        :param rate: maximum number of sessions started per second
+        :param burst: number of sessions which can be started at once
+        :param jitter: maximum random delay of each start, in seconds
+        :param backoff: factor applied to the rate when tunnels are refused
+        :param min_rate: lowest rate, rate / 10 by default
+        :raises: RampError if a parameter is out of range
+
+        """
+        if not rate > 0:
+            raise RampError("launch rate must be positive, not {!r}".format(rate))
+        if not burst >= 1:
+            raise RampError("launch burst must be at least 1, not {!r}".format(burst))
+        if not jitter >= 0:
+            raise RampError("launch jitter must be >= 0, not {!r}".format(jitter))
+        if not 0 < backoff < 1:
+            raise RampError(
+                "launch backoff must be in ]0, 1[, not {!r}".format(backoff)
+            )
+        self.rate = rate
+        self.burst = burst
+        self.jitter = jitter
+        self.backoff = backoff
+        self.min_rate = min(rate, min_rate) if min_rate else rate / 10
+        self.current = rate
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = burst
+        self._last = clock()
+        self._throttled = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def parse(cls, conf):
+        """ Build from the launch section of a configuration.
+
+        :raises: RampError if badly formatted
+        """
+        if not isinstance(conf, collections.abc.Mapping) or "rate" not in conf:
+            raise RampError("launch must be a mapping with a rate")
+        unknown = set(conf) - {"rate", "burst", "jitter", "backoff", "min_rate"}
+        if unknown:
+            unknown = ", ".join(sorted(map(str, unknown)))
+            raise RampError("unknown launch settings: {}".format(unknown))
+        try:
+            return cls(**{k: float(v) for k, v in conf.items()})
+        except (TypeError, ValueError) as e:
+            raise RampError("bad launch settings: {}".format(e))
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.current)
+        self._last = now
+
+    def acquire(self):
+        """ Wait until a session can be started. Thread-safe, sessions start in
+            the order they called acquire().
+
+        :returns: the time waited, in seconds
+        """
+        with self._lock:
+            self._refill(self.clock())
+            # The token is reserved, later callers waiting after this one
+            self._tokens -= 1
+            wait = -self._tokens / self.current if self._tokens < 0 else 0.0
+        if self.jitter:
+            wait += random.uniform(0, self.jitter)
+        if wait:
+            self.sleep(wait)
+        return wait
+
+    def throttle(self):
+        """ Slow down after a refused tunnel. """
+        with self._lock:
+            now = self.clock()
+            # Sessions started together fail together, they count once
+            if self._throttled is not None and now - self._throttled < 1 / self.current:
+                return
+            self._refill(now)
+            self._throttled = now
+            rate = max(self.min_rate, self.current * self.backoff)
+            if rate == self.current:
+                return
+            self.current = rate
+        log.warning("tunnel refused, launch rate lowered to %.2f/s", rate)
+
+    def recover(self):
+        """ Speed up again after a successful session. """
+        with self._lock:
+            if self.current < self.rate:
+                self._refill(self.clock())
+                self.current = min(self.rate, self.current + self.rate / 10)
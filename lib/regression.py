@@ -0,0 +1,62 @@
+import math
+import statistics
+
+
+# Metrics of a backup compared with the baseline of the host, and what an
+# increase of each of them means
+METRICS = {
+    "duration": "slower",
+    "original_size": "more data",
+    "deduplicated_size": "more new data",
+}
+
+# Scale of the MAD making it an estimator of the standard deviation of normally
+# distributed samples
+MAD_SCALE = 1.4826
+
+
+def baseline(values):
+    """ Median and scaled median absolute deviation of a non-empty list of numbers.
+    """
+    median = statistics.median(values)
+    mad = statistics.median(abs(v - median) for v in values) * MAD_SCALE
+    return median, mad
+
+
+def detect(result, samples, threshold=3.5, min_change=0.2, min_samples=5):
+    """ Compare the metrics of a backup with the previous backups of the host.
+
+    A metric regressed if it exceeds the median of the previous values by more
+    than threshold scaled MADs, and by more than min_change of the median, so
+    that hosts with very stable metrics are not reported for small changes.
+    Decreases are not reported.
+
+    :param result: dict of metrics of the backup, see METRICS
+    :param samples: dicts of metrics of the previous successful backups of the
+        host, such as History.results(hostname, status="SUCCEEDED")
+    :param min_samples: metrics with fewer previous values are not compared
+    :returns: a list of dicts with keys "metric", "value", "median", "mad" and
+        "score" (the number of scaled MADs above the median)
+
+    """
+    regressions = []
+    for metric in METRICS:
+        value = result.get(metric)
+        values = [s[metric] for s in samples if s.get(metric) is not None]
+        if value is None or len(values) < min_samples:
+            continue
+        median, mad = baseline(values)
+        if value <= median * (1 + min_change):
+            continue
+        score = (value - median) / mad if mad else math.inf
+        if score > threshold:
+            regressions.append(
+                {
+                    "metric": metric,
+                    "value": value,
+                    "median": median,
+                    "mad": mad,
+                    "score": score,
+                }
+            )
+    return regressions
@@ -0,0 +1,229 @@
+from datetime import timedelta
+import functools
+import heapq
+import re
+
+
+class ScheduleError(ValueError):
+    pass
+
+
+class Cron:
+    """ A cron-like schedule: "minute hour day-of-month month day-of-week".
+
+    Fields accept `*`, numbers, ranges `a-b`, steps `*/n` or `a-b/n`, and comma
+    separated lists of those. Day of week is 0-7, 0 and 7 being Sunday. As with
+    cron, when both day of month and day of week are restricted, a day matching
+    either of them matches.
+
+    >>> Cron("30 2 * * 1-5").next(datetime(2020, 2, 1, 12, 0))
+    datetime.datetime(2020, 2, 3, 2, 30)
+
+    """
+
+    _BOUNDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expr):
+        self.expr = expr
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ScheduleError("cron expression needs 5 fields: {!r}".format(expr))
+        minutes, hours, doms, months, dows = (
+            self._parse_field(f, *b) for f, b in zip(fields, self._BOUNDS)
+        )
+        self.minutes = sorted(minutes)
+        self.hours = sorted(hours)
+        self.doms = doms
+        self.months = months
+        self.dows = {d % 7 for d in dows}
+        self._any_dom = fields[2] == "*"
+        self._any_dow = fields[4] == "*"
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def parse(cls, expr):
+        """ Parse an expression, sharing instances among identical expressions. """
+        return cls(expr)
+
+    @staticmethod
+    def _parse_field(field, low, high):
+        values = set()
+        for part in field.split(","):
+            m = re.fullmatch(r"(\*|(\d+)(?:-(\d+))?)(?:/(\d+))?", part)
+            if not m:
+                raise ScheduleError("bad cron field {!r}".format(field))
+            star, first, last, step = m.groups()
+            if star == "*":
+                first, last = low, high
+            else:
+                first = int(first)
+                last = int(last) if last is not None else (high if step else first)
+            step = int(step) if step else 1
+            if not low <= first <= last <= high or step < 1:
+                raise ScheduleError("bad cron field {!r}".format(field))
+            values.update(range(first, last + 1, step))
+        return values
+
+    def _match_day(self, day):
+        dom = day.day in self.doms
+        # isoweekday(): Monday is 1, Sunday is 7
+        dow = day.isoweekday() % 7 in self.dows
+        if self._any_dom or self._any_dow:
+            return dom and dow
+        return dom or dow
+
+    def next(self, after):
+        """ First time matching the schedule strictly after a datetime.
+
+        :param after: a datetime
+        :returns: a datetime with the same tzinfo as after
+
+        """
+        start = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.replace(hour=0, minute=0)
+        # 4 years and a day are enough for any day to be reached, e.g. Feb 29
+        for _ in range(4 * 366 + 1):
+            if day.month in self.months and self._match_day(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        t = day.replace(hour=hour, minute=minute)
+                        if t >= start:
+                            return t
+            day += timedelta(days=1)
+        raise ScheduleError("cron expression never matches: {!r}".format(self.expr))
+
+    def __repr__(self):
+        return "Cron({!r})".format(self.expr)
+
+    def __eq__(self, other):
+        return isinstance(other, Cron) and self.expr == other.expr
+
+    def __hash__(self):
+        return hash(self.expr)
+
+
+_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_interval(value):
+    """ Parse an interval, either a number of seconds or a string such as "6h".
+
+    :returns: a timedelta
+    :raises: ScheduleError if badly formatted
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        seconds = value
+    else:
+        m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*", str(value))
+        if not m:
+            raise ScheduleError("bad interval {!r}".format(value))
+        seconds = float(m.group(1)) * _UNITS[m.group(2) or "s"]
+    if seconds <= 0:
+        raise ScheduleError("interval must be positive: {!r}".format(value))
+    return timedelta(seconds=seconds)
+
+
+class Schedule:
+    """ Due times of a set of hosts, each host being scheduled either with a Cron
+        (host.schedule) or every timedelta since its last run (host.interval).
+
+        >>> schedule = Schedule()
+        >>> schedule.update(config.hosts, datetime.now())
+        >>> hosts = schedule.due(datetime.now())
+
+    """
+
+    def __init__(self):
+        self.hosts = {}
+        self.next = {}
+        # Hostnames popped by due() and not rescheduled yet
+        self.running = set()
+        self._heap = []
+
+    def __len__(self):
+        return len(self.hosts)
+
+    @staticmethod
+    def schedulable(host):
+        return (
+            getattr(host, "schedule", None) is not None
+            or getattr(host, "interval", None) is not None
+        )
+
+    def _push(self, host, when):
+        self.next[host.hostname] = when
+        heapq.heappush(self._heap, (when, host.hostname))
+
+    def _next(self, host, last, now):
+        if host.schedule is not None:
+            return host.schedule.next(now)
+        if last is None:
+            return now
+        return max(last + host.interval, now)
+
+    def update(self, hosts, now, last_runs=None):
+        """ Replace the scheduled hosts, keeping the due time of the known hosts
+            whose schedule did not change.
+
+        :param hosts: iterable of hosts, the ones without schedule are ignored
+        :param now: current datetime
+        :param last_runs: optional mapping hostname -> datetime of the last run,
+            used for hosts scheduled with an interval
+
+        """
+        last_runs = last_runs or {}
+        previous, previous_next = self.hosts, self.next
+        self.hosts = {h.hostname: h for h in hosts if self.schedulable(h)}
+        self.next = {}
+        self._heap = []
+        for hostname, host in self.hosts.items():
+            if hostname in self.running:
+                # Scheduled again by reschedule() once its run is over
+                continue
+            old = previous.get(hostname)
+            when = previous_next.get(hostname)
+            if when is None or (old.schedule, old.interval) != (
+                host.schedule,
+                host.interval,
+            ):
+                when = self._next(host, last_runs.get(hostname), now)
+            self._push(host, when)
+
+    def due(self, now):
+        """ Pop the hosts due at now.
+
+        They are not scheduled anymore until reschedule() is called.
+        """
+        hosts = []
+        while self._heap and self._heap[0][0] <= now:
+            when, hostname = heapq.heappop(self._heap)
+            # Skip entries of removed or rescheduled hosts
+            if self.next.get(hostname) != when:
+                continue
+            del self.next[hostname]
+            self.running.add(hostname)
+            hosts.append(self.hosts[hostname])
+        return hosts
+
+    def reschedule(self, hosts, started, now):
+        """ Schedule hosts again after their run, with their current settings if
+            they were updated meanwhile.
+
+        :param hosts: hosts which ran
+        :param started: datetime at which their run started
+        :param now: current datetime
+        """
+        for host in hosts:
+            self.running.discard(host.hostname)
+            host = self.hosts.get(host.hostname)
+            if host is not None:
+                self._push(host, self._next(host, started, now))
+
+    def next_due(self):
+        """ Earliest due time, or None if no host is scheduled. """
+        while self._heap:
+            when, hostname = self._heap[0]
+            if self.next.get(hostname) == when:
+                return when
+            heapq.heappop(self._heap)
+        return None
@@ -0,0 +1,120 @@
+import fnmatch
+import re
+
+
+class SelectorError(ValueError):
+    pass
+
+
+class HostRegistry:
+    """ Index a list of hosts by hostname and by tag, and resolve selectors
+        against it.
+
+        A selector is made of terms separated by `,` (union), each term being
+        made of factors separated by `&` (intersection). A factor is one of:
+
+        - `foo.example.com`: an exact hostname
+        - `*.example.com`: a glob pattern matched against hostnames
+        - `re:^web[0-9]+\\.`: a regular expression searched in hostnames
+        - `tag:web`: hosts tagged with `web` (the tag may be a glob pattern)
+        - `!factor`: every host not matched by factor
+
+        >>> registry = HostRegistry(config.hosts)
+        >>> registry.select(["tag:web&!*.staging.example.com", "db1.example.com"])
+
+        Every factor must match at least one host, otherwise SelectorError is
+        raised: this prevents typos from silently changing the selection.
+
+        NOTE: `,` and `&` are always operators, they cannot be used in regular
+        expressions.
+    """
+
+    _GLOB_CHARS = re.compile(r"[*?[]")
+
+    def __init__(self, hosts):
+        self.hosts = list(hosts)
+        self.by_name = {}
+        self.by_tag = {}
+        for i, host in enumerate(self.hosts):
+            self.by_name[host.hostname] = i
+            for tag in getattr(host, "tags", ()):
+                self.by_tag.setdefault(tag, set()).add(i)
+        self._universe = frozenset(range(len(self.hosts)))
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def __contains__(self, hostname):
+        return hostname in self.by_name
+
+    def __getitem__(self, hostname):
+        return self.hosts[self.by_name[hostname]]
+
+    def select(self, selectors, exclude=False, unmatched=None):
+        """ Resolve selectors against the registry.
+
+        :param selectors: iterable of selector strings, their results are united
+        :param exclude: return the hosts NOT matched by selectors instead
+        :param unmatched: optional set, to which the factors matching no host are
+            added instead of raising SelectorError, e.g. to check them against
+            several registries
+        :returns: the list of matching hosts, in registry order
+        :raises: SelectorError if a factor matches no host or is malformed
+
+        """
+        indices = set()
+        for selector in selectors:
+            indices |= self._resolve(selector, unmatched)
+        if exclude:
+            indices = self._universe - indices
+        return [self.hosts[i] for i in sorted(indices)]
+
+    def _resolve(self, selector, unmatched=None):
+        indices = set()
+        for term in selector.split(","):
+            factors = term.split("&")
+            result = self._factor(factors[0], unmatched)
+            for factor in factors[1:]:
+                result = result & self._factor(factor, unmatched)
+            indices |= result
+        return indices
+
+    def _factor(self, factor, unmatched=None):
+        factor = factor.strip()
+        if factor.startswith("!"):
+            return self._universe - self._factor(factor[1:], unmatched)
+        if not factor:
+            raise SelectorError("empty selector")
+        result = self._atom(factor)
+        if not result:
+            if unmatched is not None:
+                unmatched.add(factor)
+                return result
+            # Avoid typos and prevent unintended behavior
+            raise SelectorError("{!r} not present in config".format(factor))
+        return result
+
+    def _atom(self, atom):
+        if atom.startswith("tag:"):
+            tag = atom[len("tag:") :]
+            if not self._GLOB_CHARS.search(tag):
+                return set(self.by_tag.get(tag, ()))
+            return set().union(
+                *(v for k, v in self.by_tag.items() if fnmatch.fnmatchcase(k, tag))
+            )
+        if atom.startswith("re:"):
+            try:
+                regex = re.compile(atom[len("re:") :])
+            except re.error as e:
+                raise SelectorError("bad regular expression {!r}: {}".format(atom, e))
+            return self._scan(regex.search)
+        if self._GLOB_CHARS.search(atom):
+            return self._scan(re.compile(fnmatch.translate(atom)).match)
+        try:
+            return {self.by_name[atom]}
+        except KeyError:
+            return set()
+
+    def _scan(self, match):
+        """ Apply a regex matching method to every hostname in a single pass. """
+        return {i for name, i in self.by_name.items() if match(name)}
@@ -0,0 +1,103 @@
+import hashlib
+import statistics
+
+
+class ShardError(ValueError):
+    pass
+
+
+def jump_hash(key, buckets):
+    """ Jump consistent hash (Lamping & Veach, https://arxiv.org/abs/1406.2294).
+
+    Map a 64-bit key to a bucket in [0, buckets). When the number of buckets
+    grows from N to N+1, only 1/(N+1) of the keys move, all to the new bucket.
+
+    :param key: unsigned 64-bit integer
+    :param buckets: number of buckets
+    :returns: the bucket of key
+
+    """
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+def host_key(hostname):
+    """ Stable 64-bit key of a hostname (unlike hash(), not salted per process). """
+    digest = hashlib.blake2b(hostname.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+class Shard:
+    """ The K-th share out of N of an inventory, K being 1-based.
+
+    >>> shard = Shard.parse("2/4")
+    >>> hosts = shard.select(config.hosts)
+
+    """
+
+    def __init__(self, number, count):
+        if not 1 <= number <= count:
+            raise ShardError("shard must be in 1..{}, not {}".format(count, number))
+        self.number = number
+        self.count = count
+
+    @classmethod
+    def parse(cls, text):
+        """ Parse a "K/N" string.
+
+        :raises: ShardError if badly formatted
+        """
+        try:
+            number, count = (int(x) for x in str(text).split("/"))
+        except ValueError:
+            raise ShardError("shard must be formatted as K/N, not {!r}".format(text))
+        return cls(number, count)
+
+    def __str__(self):
+        return "{}/{}".format(self.number, self.count)
+
+    def __repr__(self):
+        return "Shard({}, {})".format(self.number, self.count)
+
+    def __eq__(self, other):
+        return (self.number, self.count) == (other.number, other.count)
+
+    def __hash__(self):
+        return hash((self.number, self.count))
+
+    def __contains__(self, host):
+        return shard_of(host.hostname, self.count) == self.number
+
+    def select(self, hosts):
+        return [h for h in hosts if h in self]
+
+
+def shard_of(hostname, count):
+    """ 1-based shard number of hostname among count shards. """
+    return jump_hash(host_key(hostname), count) + 1
+
+
+def plan(hosts, count, durations=None):
+    """ Plan the assignment of hosts over count shards.
+
+    :param hosts: iterable of hosts
+    :param count: number of shards
+    :param durations: optional mapping hostname -> expected duration in seconds.
+        Hosts without known duration are weighted with the median of known ones.
+    :returns: a list of count dicts with keys "shard", "hosts" and "load"
+
+    """
+    durations = durations or {}
+    default = statistics.median(durations.values()) if durations else 1.0
+    shards = [
+        {"shard": Shard(k + 1, count), "hosts": [], "load": 0.0} for k in range(count)
+    ]
+    for host in hosts:
+        shard = shards[shard_of(host.hostname, count) - 1]
+        shard["hosts"].append(host)
+        shard["load"] += durations.get(host.hostname, default)
+    return shards
@@ -0,0 +1,196 @@
+import logging
+from pathlib import Path
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+
+
+log = logging.getLogger("qb.backup")
+
+# Options of every ssh connection to the backuped hosts
+# fmt: off
+OPTIONS = (
+    "-o", "ServerAliveInterval=10",
+    "-o", "ServerAliveCountMax=30",
+    "-o", "BatchMode=yes",
+    "-o", "StrictHostKeyChecking=no",
+)
+# fmt: on
+# Time in seconds to connect to a host before giving up, for short commands
+CONNECT_TIMEOUT = 10
+
+
+def command(host, *args, options=()):
+    """ Command line of ssh running args as root on host.
+
+    :param options: extra options of ssh
+    """
+    # fmt: off
+    return [
+        "ssh", *OPTIONS,
+        "-p", host.port,
+        *options,
+        "-l", "root",
+        host.hostname,
+        *args,
+    ]
+    # fmt: on
+
+
+class ControlMasters:
+    """ Master ssh connections, shared by all the commands run on a host.
+
+        A command run on a host may open a master connection, whose socket is in
+        a private directory; the following commands are multiplexed over it
+        instead of paying for a new connection and authentication each time.
+        Commands which do not open a master, such as the last command run on a
+        host, only reuse it. At most `limit` masters are open at once, hosts
+        beyond the limit being connected to directly.
+
+        >>> with ControlMasters(limit=8) as masters:
+        ...     probe = command(host, "true", options=masters.options(host))
+        ...     cmd = command(host, options=masters.options(host, open=False))
+        ...     masters.release(host)
+
+        Masters are closed by release() once the commands of a host are over, and
+        all of them by close(). Should the process be killed, they exit on their
+        own after being idle for `persist` seconds.
+
+    """
+
+    def __init__(self, limit=16, persist=600, timeout=60):
+        """
+        :param limit: maximum number of master connections open at once
+        :param persist: time in seconds idle masters outlive this process
+        :param timeout: maximum time in seconds to open or close a master
+
+        """
+        self.limit = limit
+        self.persist = persist
+        self.timeout = timeout
+        self.directory = Path(tempfile.mkdtemp(prefix="qb.backup.ssh."))
+        # hostname -> (host, ControlPath) of the open masters
+        self.masters = {}
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def options(self, host, open=True):
+        """ Options of ssh multiplexing a command over the master of host.
+
+        :param open: whether the master is opened if host has none
+        :returns: a list of options, empty if host has no master
+        """
+        with self._lock:
+            opened = host.hostname in self.masters
+            if opened:
+                _, path = self.masters[host.hostname]
+            elif not open or len(self.masters) >= self.limit:
+                return []
+            else:
+                # Sockets paths are limited to about 100 characters, hostnames
+                # are not used. The slot is taken while the master is opened.
+                self._opened += 1
+                path = self.directory / str(self._opened)
+                self.masters[host.hostname] = host, path
+        if not opened and not self._open(host, path):
+            with self._lock:
+                del self.masters[host.hostname]
+            return []
+        return ["-o", "ControlMaster=no", "-o", "ControlPath={}".format(path)]
+
+    def _open(self, host, path):
+        # The master runs in background (-f) once connected, its output is not
+        # captured since it would keep the pipes open
+        # fmt: off
+        cmd = command(host, options=(
+            "-o", "ConnectTimeout={}".format(CONNECT_TIMEOUT),
+            "-o", "ControlMaster=yes",
+            "-o", "ControlPath={}".format(path),
+            "-o", "ControlPersist={}".format(self.persist),
+            "-f", "-N",
+        ))
+        # fmt: on
+        try:
+            subprocess.run(
+                cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=self.timeout,
+                check=True,
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            log.warning("cannot open ssh master of %s: %s", host.hostname, e)
+            return False
+        log.debug("ssh master of %s opened", host.hostname)
+        return True
+
+    def pid(self, host):
+        """ Process id of the master of host, e.g. to move it to the cgroup of the
+            host, since the master carries the traffic of the multiplexed commands.
+
+        :returns: the pid, or None if host has no master or it cannot be checked
+        """
+        with self._lock:
+            _, path = self.masters.get(host.hostname, (None, None))
+        if path is None:
+            return None
+        # fmt: off
+        cmd = command(host, options=(
+            "-o", "ControlPath={}".format(path),
+            "-O", "check",
+        ))
+        # fmt: on
+        try:
+            p = subprocess.run(
+                cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+                timeout=self.timeout,
+                check=True,
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            log.warning("cannot check ssh master of %s: %s", host.hostname, e)
+            return None
+        # "Master running (pid=1234)"
+        m = re.search(r"\(pid=(\d+)\)", p.stderr)
+        return int(m.group(1)) if m else None
+
+    def release(self, host):
+        """ Close the master of host, if any. """
+        with self._lock:
+            _, path = self.masters.pop(host.hostname, (None, None))
+        if path is None:
+            return
+        # fmt: off
+        cmd = command(host, options=(
+            "-o", "ControlPath={}".format(path),
+            "-O", "exit",
+        ))
+        # fmt: on
+        try:
+            subprocess.run(
+                cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=self.timeout,
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            log.warning("cannot close ssh master of %s: %s", host.hostname, e)
+
+    def close(self):
+        """ Close all the masters and remove their directory. """
+        for host, _ in list(self.masters.values()):
+            self.release(host)
+        shutil.rmtree(str(self.directory), ignore_errors=True)
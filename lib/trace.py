@@ -0,0 +1,119 @@
+import json
+import os
+import resource
+import time
+
+
+def rss():
+    """ Resident set size of the current process in bytes, peak RSS if the
+        current one is not available.
+    """
+    try:
+        with open("/proc/self/statm") as fd:
+            return int(fd.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Trace:
+    """ Timeline of a run in the Chrome Trace Event format, which can be opened in
+        chrome://tracing or https://ui.perfetto.dev.
+
+        Every worker of the run has its own track, on which the backup of each
+        host is a span, split into the spans of its phases. Counter tracks show
+        the number of hosts in flight and the memory of the process.
+
+        >>> trace = Trace()
+        >>> Backuper(hosts, workers=4, trace=trace).run()
+        >>> trace.write("/tmp/run.json")
+
+    """
+
+    def __init__(self, name="qb.backup"):
+        self.pid = os.getpid()
+        self.origin = time.monotonic_ns()
+        self.events = [
+            {"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": name}}
+        ]
+        self._slots = set()
+
+    def _ts(self, ns):
+        """ Timestamp of an event in microseconds since the start of the trace. """
+        return (ns - self.origin) / 1000
+
+    def _slot(self, slot):
+        if slot not in self._slots:
+            self._slots.add(slot)
+            self.events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": self.pid,
+                    "tid": slot,
+                    "args": {"name": "worker {}".format(slot + 1)},
+                }
+            )
+
+    def span(self, name, slot, start, end, cat="host", **args):
+        """ Add a span to the track of a worker slot.
+
+        :param start: time.monotonic_ns() at which the span starts
+        :param end: time.monotonic_ns() at which the span ends
+        :param args: extra information shown with the span
+
+        """
+        self._slot(slot)
+        self.events.append(
+            {
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": self._ts(start),
+                "dur": (end - start) / 1000,
+                "pid": self.pid,
+                "tid": slot,
+                "args": args,
+            }
+        )
+
+    def host(self, slot, hostname, status, phases):
+        """ Add the span of a host backup and the spans of its phases.
+
+        :param phases: Phases of the backup. Waiting in the queue is not shown,
+            the host not being on a worker yet.
+
+        """
+        spans = [s for s in phases.spans if s[0] != "queue"]
+        if not spans:
+            return
+        self.span(hostname, slot, spans[0][1], spans[-1][2], status=status)
+        for phase, start, end in spans:
+            self.span(phase, slot, start, end, cat="phase", host=hostname)
+
+    def counters(self, in_flight, now=None):
+        """ Sample the counters: hosts in flight and memory of the process. """
+        ts = self._ts(time.monotonic_ns() if now is None else now)
+        self.events.append(
+            {
+                "name": "in flight",
+                "ph": "C",
+                "ts": ts,
+                "pid": self.pid,
+                "args": {"hosts": in_flight},
+            }
+        )
+        self.events.append(
+            {
+                "name": "memory",
+                "ph": "C",
+                "ts": ts,
+                "pid": self.pid,
+                "args": {"rss": rss()},
+            }
+        )
+
+    def write(self, path):
+        """ Write the trace as a JSON file. """
+        with open(path, "w") as fd:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, fd)
@@ -0,0 +1,142 @@
+import collections.abc
+import shlex
+
+from . import ssh
+
+
+class TransportError(ValueError):
+    pass
+
+
+class SshTransport:
+    """ Connect to the host with ssh, its backup being run by the command forced
+        for the key of the backup server. A port of the host is forwarded to the
+        local sshd, through which borg reaches its repository.
+    """
+
+    name = "ssh"
+    # Whether the backup reaches the local sshd through a tunnel, its launch
+    # being limited by the LaunchRamp
+    tunnel = True
+
+    def command(self, host, masters=None):
+        """ Command line running the backup of host.
+
+        :param masters: optional ssh.ControlMasters, the command being multiplexed
+            over the master of host if one was opened by a previous command, e.g.
+            the probe. None is opened for the backup, the last command of host.
+        """
+        options = ["-R", "64064:localhost:22"]
+        if masters is not None:
+            options += masters.options(host, open=False)
+        return ssh.command(host, options=options)
+
+    def processes(self, host, masters=None):
+        """ Processes carrying the backup besides the command, e.g. to be moved
+            to the cgroup of host: the ssh master, if any.
+        """
+        pid = masters.pid(host) if masters is not None else None
+        return [pid] if pid is not None else []
+
+    def release(self, host, masters=None):
+        """ Release what command() opened, once the backup of host is over. """
+        if masters is not None:
+            masters.release(host)
+
+    def probe(self, host, masters=None):
+        """ Cheap command line succeeding if the backup of host can be attempted,
+            None if there is none.
+
+        :param masters: optional ssh.ControlMasters, a master of host being opened
+            for the probe and reused by the backup
+        """
+        options = ["-o", "ConnectTimeout={}".format(ssh.CONNECT_TIMEOUT)]
+        if masters is not None:
+            options += masters.options(host)
+        return ssh.command(host, "true", options=options)
+
+    def __eq__(self, other):
+        return type(other) is type(self)
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __repr__(self):
+        return "<SshTransport>"
+
+
+class LocalTransport:
+    """ Run the backup on this server without ssh, e.g. in a jail or container
+        through a wrapper such as `jexec` or `nsenter`, saving the encryption and
+        forwarding of the whole data stream.
+
+        >>> LocalTransport(["jexec", "{hostname}", "/usr/local/sbin/backup"])
+
+    Arguments are formatted with the hostname of the host.
+    """
+
+    name = "local"
+    tunnel = False
+
+    def __init__(self, argv):
+        """
+        :param argv: command line, as a list or a shell-like string
+        :raises: TransportError if empty
+
+        """
+        if isinstance(argv, str):
+            argv = shlex.split(argv)
+        argv = tuple(str(a) for a in argv)
+        if not argv:
+            raise TransportError("local transport without command")
+        try:
+            for arg in argv:
+                arg.format(hostname="")
+        except (AttributeError, KeyError, IndexError, ValueError) as e:
+            raise TransportError("bad local command {!r}: {}".format(argv, e))
+        self.argv = argv
+
+    def command(self, host, masters=None):
+        return [arg.format(hostname=host.hostname) for arg in self.argv]
+
+    def processes(self, host, masters=None):
+        return []
+
+    def release(self, host, masters=None):
+        pass
+
+    def probe(self, host, masters=None):
+        return None
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other.argv == self.argv
+
+    def __hash__(self):
+        return hash(self.argv)
+
+    def __repr__(self):
+        return "<LocalTransport {}>".format(" ".join(self.argv))
+
+
+SSH = SshTransport()
+
+# Transports parsed from configurations, shared by the hosts using the same one
+_transports = {}
+
+
+def parse(value):
+    """ Parse the transport setting of a host: "ssh", or {"local": command}.
+
+    :returns: a transport, the same object for equal settings
+    :raises: TransportError if badly formatted
+    """
+    if value is None or value == "ssh":
+        return SSH
+    if isinstance(value, collections.abc.Mapping) and set(value) == {"local"}:
+        command = value["local"]
+        if isinstance(command, collections.abc.Sequence):
+            transport = LocalTransport(command)
+            return _transports.setdefault(transport, transport)
+    raise TransportError(
+        "transport must be ssh or a mapping {{local: command}}, not {!r}".format(value)
+    )
@@ -0,0 +1,175 @@
+from datetime import date, timedelta
+import json
+import logging
+import os
+from pathlib import Path
+import socket
+
+from .backup import throughput
+from .cgroup import resources
+from ._utils import FLockError, Phases, lock_manager
+
+
+log = logging.getLogger("qb.backup")
+
+
+class WorkQueue:
+    """ Share the hosts of a run among several processes, possibly on several
+        nodes sharing the queue directory.
+
+        Every worker iterates over the same list of hosts, and only yields the hosts
+        it manages to claim: a host is claimed by taking a lock on its claim file,
+        held during the whole backup, and released once the backup is over and
+        the host marked as done. If a worker dies, its locks are released and its
+        hosts can be claimed again by the other workers.
+
+        >>> queue = WorkQueue("/shared/backup/queue")
+        >>> Backuper(queue.claim(config.hosts), on_done=queue.release).run()
+
+        Layout of the queue directory:
+
+            <directory>/<run>/claims/<hostname>      claim files
+            <directory>/<run>/done/<hostname>        worker which did the backup
+            <directory>/<run>/reports/<worker>.json  summary of each worker
+
+        NOTE: the locks used are POSIX locks (fcntl), which work on NFS. Locks are
+        held per process, several workers cannot share a process.
+    """
+
+    def __init__(self, directory, run=None, worker=None, locks=None):
+        """
+        :param directory: directory shared by all workers
+        :param run: identifier of the run, shared by all workers of the run.
+            Defaults to the current date.
+        :param worker: unique identifier of this worker, defaults to
+            <hostname>-<pid>
+        :param locks: LockManager of the claim locks
+
+        """
+        self.locks = locks or lock_manager
+        self.run = run or date.today().isoformat()
+        self.worker = worker or "{}-{}".format(socket.gethostname(), os.getpid())
+        self.path = Path(directory) / self.run
+        self.claims = self.path / "claims"
+        self.done = self.path / "done"
+        self.reports = self.path / "reports"
+        for d in (self.claims, self.done, self.reports):
+            d.mkdir(parents=True, exist_ok=True)
+        # Hostnames of all the hosts of the run, claimed or not, see claim()
+        self.hosts = []
+
+    def claim(self, hosts):
+        """ Generate the hosts claimed by this worker.
+
+        Claimed hosts must be released once their backup is over.
+
+        :param hosts: the hosts of the run, in the order they should be handled
+        :returns: a generator of hosts
+
+        """
+        already_done = 0
+        for host in hosts:
+            self.hosts.append(host.hostname)
+            done = self.done / host.hostname
+            if done.exists():
+                already_done += 1
+                continue
+            claim = self.claims / host.hostname
+            try:
+                self.locks.acquire(claim)
+            except FLockError:
+                # Claimed by another worker
+                continue
+            # The backup may have been finished while taking the lock
+            if done.exists():
+                self.locks.release(claim)
+                continue
+            log.debug("%s claimed by %s", host.hostname, self.worker)
+            yield host
+        if self.hosts and already_done == len(self.hosts):
+            # e.g. a second run on the same day with the default run identifier
+            log.warning(
+                "all the hosts of run %s were already done, nothing to backup; "
+                "give another run identifier to back them up again",
+                self.run,
+            )
+
+    def release(self, host):
+        """ Mark a claimed host as done and release it. """
+        (self.done / host.hostname).write_text(self.worker + "\n")
+        self.locks.release(self.claims / host.hostname)
+
+    def report(self, backuper):
+        """ Write the summary and the results of a Backuper run by this worker. """
+        summary = dict(backuper.summary)
+        summary["RUNTIME"] = summary["RUNTIME"].total_seconds()
+        report = {
+            "run": self.run,
+            "worker": self.worker,
+            "summary": summary,
+            "results": backuper.results,
+            "hosts": self.hosts,
+        }
+        path = self.reports / (self.worker + ".json")
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(report, indent=2))
+        tmp.rename(path)
+        return path
+
+    @staticmethod
+    def merge(reports):
+        """ Merge the reports of the workers of a run.
+
+        :param reports: iterable of report dicts, as written by report()
+        :returns: a report dict whose results are the results of all the workers,
+            and whose summary is computed over all of them. As workers run
+            concurrently, the runtime is the one of the slowest worker, and the
+            distributions of the phases are computed over all the hosts. The
+            hosts of the run which no worker handled are listed in UNCLAIMED,
+            and counted as skipped.
+
+        """
+        reports = list(reports)
+        results = [r for report in reports for r in report["results"]]
+        succeeded = sum(r["summary"]["SUCCEEDED"] for r in reports)
+        failed = sum(r["summary"]["FAILED"] for r in reports)
+        # Every worker goes through all the hosts of the run
+        hostnames = {h for r in reports for h in r.get("hosts", ())}
+        if hostnames:
+            total = len(hostnames)
+        else:
+            total = sum(r["summary"]["TOTAL"] for r in reports)
+        unclaimed = sorted(hostnames - {r["hostname"] for r in results})
+        runtime = max((r["summary"]["RUNTIME"] for r in reports), default=0)
+        regressions = [
+            x for r in reports for x in r["summary"].get("REGRESSIONS", [])
+        ]
+        circuits = [x for r in reports for x in r["summary"].get("CIRCUITS", [])]
+        return {
+            "workers": sorted(r["worker"] for r in reports),
+            "summary": {
+                "SUCCEEDED": succeeded,
+                "FAILED": failed,
+                "SKIPPED": total - succeeded - failed - len(circuits),
+                "TOTAL": total,
+                "RUNTIME": timedelta(seconds=int(runtime)),
+                "STATUS": "success" if failed == 0 else "failure",
+                "PHASES": Phases.aggregate(r.get("phases", {}) for r in results),
+                "BYTES": sum(
+                    r.get("stats", {}).get("original_size", 0) for r in results
+                ),
+                "THROUGHPUT": throughput(results),
+                "REGRESSIONS": regressions,
+                "REGRESSED": len({r["hostname"] for r in regressions}),
+                "RESOURCES": resources(results),
+                "OPEN": len(circuits),
+                "CIRCUITS": circuits,
+                "UNCLAIMED": unclaimed,
+            },
+            "results": results,
+        }
+
+    def load_reports(self):
+        """ Load the reports written by all the workers of the run. """
+        for path in sorted(self.reports.glob("*.json")):
+            yield json.loads(path.read_text())
@@ -2,12 +2,30 @@
 
 
 import argparse
+from datetime import timedelta
+import json
 import logging
 import logging.config
 from pathlib import Path
 import sys
+import threading
 
-from qb.backup import Backuper, Config, ConfigError
+from qb.backup import Backuper, Config, ConfigError, HostRegistry, SelectorError
+from qb.backup.backup import describe, open_circuit
+from qb.backup.borg import format_size
+from qb.backup.cgroup import format_usage
+from qb.backup.daemon import Daemon
+from qb.backup.history import History
+from qb.backup.logging import combine
+from qb.backup.planner import simulate
+from qb.backup.profiling import Profiler
+from qb.backup.ramp import LaunchRamp
+from qb.backup.schedule import ScheduleError, parse_interval
+from qb.backup.sharding import Shard, ShardError, plan
+from qb.backup.ssh import ControlMasters
+from qb.backup._utils import FairSlots
+from qb.backup.trace import Trace
+from qb.backup.workqueue import WorkQueue
 
 
 log = logging.getLogger("qb.backup")
@@ -22,50 +40,495 @@ exit status:
  1  failure during backups
  2  invalid command line
 
+host selectors:
+ foo.example.com       exact hostname
+ *.example.com         glob pattern on hostnames
+ re:^web[0-9]+         regular expression on hostnames
+ tag:web               hosts tagged with web (glob patterns allowed)
+ !tag:web              negation
+ tag:web&tag:prod      intersection
+ tag:web,tag:db        union (same as passing several selectors)
+
 """
 
 
-def run(args):
+def load(path, **kwargs):
     try:
-        config = Config.load(args.conf)
+        return Config.load(path, **kwargs)
     except OSError as e:
         # Logging is not configured yet, cannot use it
-        print(f"cannot read {args.conf}: {e}", file=sys.stderr)
+        print(f"cannot read {path}: {e}", file=sys.stderr)
         exit(1)
     except ConfigError as e:
         # Logging is not configured yet, cannot use it
-        print(f"badly formatted file {args.conf}: {e}", file=sys.stderr)
+        print(f"badly formatted file {path}: {e}", file=sys.stderr)
         exit(1)
 
+
+def shard_type(text):
+    try:
+        return Shard.parse(text)
+    except ShardError as e:
+        raise argparse.ArgumentTypeError(e)
+
+
+def interval_type(text):
+    try:
+        return parse_interval(text)
+    except ScheduleError as e:
+        raise argparse.ArgumentTypeError(e)
+
+
+def rate_type(text):
+    try:
+        rate = float(text)
+    except ValueError:
+        rate = 0
+    if not rate > 0:
+        raise argparse.ArgumentTypeError(
+            "rate must be a positive number, not {!r}".format(text)
+        )
+    return rate
+
+
+def launch_ramp(config, args):
+    """ LaunchRamp of a run, if any: the one of config, whose rate is overridden
+        by --launch-rate.
+    """
+    if not args.launch_rate:
+        return config.launch
+    ramp = config.launch
+    if ramp is None:
+        return LaunchRamp(args.launch_rate)
+    return LaunchRamp(
+        args.launch_rate,
+        burst=ramp.burst,
+        jitter=ramp.jitter,
+        backoff=ramp.backoff,
+        min_rate=ramp.min_rate,
+    )
+
+
+def select(config, args, lazy=False, unmatched=None):
+    """ Select the hosts of a config according to --only, --exclude and --shard.
+
+    :param lazy: if True and all the hosts are selected, return the inventory of
+        the config, whose hosts are built while iterating
+    :param unmatched: optional set, see HostRegistry.select()
+    :raises: SelectorError if a selector does not match any host
+    """
+    shard = args.shard or config.shard
+    if lazy and not (args.only or args.exclude or shard):
+        return config.inventory
+
+    hosts = config.hosts
+    registry = HostRegistry(hosts)
+    if args.exclude:
+        hosts = registry.select(args.exclude, exclude=True, unmatched=unmatched)
+    if args.only:
+        hosts = registry.select(args.only, unmatched=unmatched)
+
+    if shard:
+        hosts = shard.select(hosts)
+        log.info("shard %s: %d hosts selected", shard, len(hosts))
+    return hosts
+
+
+class AppendPath(argparse.Action):
+    """ Append the values of an option to a list, the default list being replaced
+        by the values given.
+    """
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        paths = getattr(namespace, self.dest)
+        if paths is self.default:
+            paths = []
+        setattr(namespace, self.dest, paths + [values])
+
+
+class HelpFormatter(argparse.ArgumentDefaultsHelpFormatter):
+    """ Show the default values of the options, except the ones whose help
+        already describes it.
+    """
+
+    def _get_help_string(self, action):
+        if "(default:" in action.help:
+            return action.help
+        return super()._get_help_string(action)
+
+
+def run(args):
+    if args.profile:
+        # Reports are written even if the run is aborted
+        with Profiler(args.profile, every=args.profile_every) as profiler:
+            return run_backups(args, profiler)
+    return run_backups(args)
+
+
+def run_backups(args, profiler=None):
+    if len(args.conf) > 1:
+        return run_many(args, profiler)
+    config = load(
+        args.conf[0], compiled=args.config_cache, strict=args.strict_includes
+    )
+    if profiler is not None:
+        profiler.snapshot("config")
+    if args.plan:
+        return plan_run(config, args)
+
     # NOTE: this line may raise an uncaught ValueError if there is an issue
     # with the config. To debug efficiently the issue we need the whole
     # exception stack, for example it can be:
     #   ValueError: Unable to configure handler 'logs'
     #   PermissionError: [Errno 13] Permission denied: '/var/log/backup.log'
     logging.config.dictConfig(config.logging)
+    if profiler is not None:
+        profiler.snapshot("logging")
 
-    if args.exclude:
-        # Avoid typos and prevent unintended behavior
-        for x in args.exclude:
-            if not any(h.hostname == x for h in config.hosts):
-                log.error("%r not present in config, aborting.", x)
-                exit(1)
-        config.hosts = [h for h in config.hosts if h.hostname not in args.exclude]
-    if args.only:
-        # Avoid typos and prevent unintended behavior
-        for o in args.only:
-            if all(h.hostname != o for h in config.hosts):
-                log.error("%r not present in config, aborting.", o)
-                exit(1)
-        config.hosts = [h for h in config.hosts if h.hostname in args.only]
+    try:
+        hosts = select(config, args, lazy=True)
+    except SelectorError as e:
+        log.error("%s, aborting.", e)
+        exit(1)
 
+    history = None
     try:
-        proc = Backuper(config.hosts, failfast=args.failfast)
-        rc = proc.run()
+        history = History(config.history) if config.history else None
+        queue = None
+        if args.queue or config.queue:
+            queue = WorkQueue(args.queue or config.queue, run=args.queue_run)
+            log.info("claiming hosts from %s as %s", queue.path, queue.worker)
+            hosts = queue.claim(hosts)
+        trace = Trace() if args.trace else None
+        masters = ControlMasters(args.ssh_masters) if args.ssh_masters else None
+        on_done = queue.release if queue else None
+        if profiler is not None:
+            on_done = profiler.on_done(on_done)
+        proc = Backuper(
+            hosts,
+            failfast=args.failfast,
+            history=history,
+            workers=args.workers or config.workers,
+            lock_timeout=config.lock_timeout,
+            on_done=on_done,
+            trace=trace,
+            masters=masters,
+            cgroups=config.cgroup,
+            launch=launch_ramp(config, args),
+            breaker=config.breaker,
+        )
+        try:
+            rc = proc.run()
+        finally:
+            if masters is not None:
+                masters.close()
+            if trace is not None:
+                trace.write(args.trace)
+        if queue:
+            queue.report(proc)
         return rc
     except Exception as e:
         log.exception(e)
         exit(1)
+    finally:
+        if history is not None:
+            history.close()
+
+
+def run_many(args, profiler=None):
+    """ Run the backups of several configurations in one process. Each of them
+        keeps its own logging, history and summary, and backups are limited by
+        both the workers of their configuration and --total-workers.
+    """
+    if args.plan or args.queue or args.trace:
+        print("--plan, --queue and --trace take a single --conf", file=sys.stderr)
+        exit(2)
+    configs = [
+        load(path, compiled=args.config_cache, strict=args.strict_includes)
+        for path in args.conf
+    ]
+    if profiler is not None:
+        profiler.snapshot("config")
+    if any(config.queue for config in configs):
+        print("work queues take a single --conf", file=sys.stderr)
+        exit(2)
+    # Threads are named after their configuration, see ThreadFilter
+    tags = ["conf{}".format(i + 1) for i in range(len(configs))]
+    # NOTE: see run() for possible ValueErrors
+    logging.config.dictConfig(combine([c.logging for c in configs], tags))
+    if profiler is not None:
+        profiler.snapshot("logging")
+
+    # Selectors need to match hosts of one of the configurations only
+    runs = {}
+    unmatched = []
+    for tag, path, config in zip(tags, args.conf, configs):
+        unmatched.append(set())
+        try:
+            hosts = select(config, args, lazy=True, unmatched=unmatched[-1])
+        except SelectorError as e:
+            log.error("%s: %s, aborting.", path, e)
+            exit(1)
+        runs[tag] = path, config, hosts
+    unmatched = set.intersection(*unmatched)
+    if unmatched:
+        log.error(
+            "%s not present in any config, aborting.",
+            ", ".join(map(repr, sorted(unmatched))),
+        )
+        exit(1)
+
+    workers = {tag: args.workers or c.workers for tag, (_, c, _) in runs.items()}
+    slots = FairSlots(args.total_workers or sum(workers.values()))
+    masters = ControlMasters(args.ssh_masters) if args.ssh_masters else None
+    # All the tunnels reach the same sshd, a single ramp is shared, set by the
+    # first configuration with a launch section
+    first = next((c for c in configs if c.launch is not None), configs[0])
+    launch = launch_ramp(first, args)
+    rcs = {}
+
+    def target(tag, path, config, hosts):
+        history = None
+        try:
+            log.info("running backups of %s", path)
+            history = History(config.history) if config.history else None
+            proc = Backuper(
+                hosts,
+                failfast=args.failfast,
+                history=history,
+                workers=workers[tag],
+                lock_timeout=config.lock_timeout,
+                masters=masters,
+                cgroups=config.cgroup,
+                launch=launch,
+                breaker=config.breaker,
+                name=tag,
+                slots=slots,
+                on_done=profiler.on_done() if profiler is not None else None,
+            )
+            rcs[tag] = proc.run()
+        except Exception as e:
+            log.exception(e)
+            rcs[tag] = 1
+        finally:
+            if history is not None:
+                history.close()
+
+    threads = [
+        threading.Thread(target=target, args=(tag,) + run, name=tag)
+        for tag, run in runs.items()
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if masters is not None:
+            masters.close()
+    return max(rcs.values(), default=1)
+
+
+def plan_run(config, args):
+    """ Print the predicted course of a run from the durations of the history,
+        without running any backup.
+    """
+    try:
+        hosts = list(select(config, args, lazy=True))
+    except SelectorError as e:
+        print(f"{e}, aborting.", file=sys.stderr)
+        exit(1)
+    durations = {}
+    if config.history and Path(config.history).exists():
+        with History(config.history) as history:
+            durations = history.durations()
+    workers = args.workers or config.workers
+    planned = simulate(hosts, durations, workers, config.lock_timeout)
+
+    known = sum(not h["estimated"] for h in planned["hosts"])
+    print(f"plan of {len(hosts)} hosts on {workers} workers")
+    if known:
+        print(f"durations from history of {known}/{len(hosts)} hosts")
+    else:
+        print("no history available, durations are unknown")
+    makespan = planned["makespan"]
+    print(f"predicted makespan: {timedelta(seconds=round(makespan))}")
+    print(f"{'SLOT':<8} {'HOSTS':>7} {'BUSY':>12} {'UTILISATION':>12}")
+    for slot, busy in enumerate(planned["busy"]):
+        count = sum(h["slot"] == slot for h in planned["hosts"])
+        usage = 100 * busy / makespan if makespan else 0
+        busy = str(timedelta(seconds=round(busy)))
+        print(f"{slot + 1:<8} {count:>7} {busy:>12} {usage:>11.1f}%")
+
+    window = args.window.total_seconds()
+    late = [h for h in planned["hosts"] if h["end"] > window]
+    failed = [h for h in planned["hosts"] if h["status"] != "SUCCEEDED"]
+    if late:
+        print(f"hosts missing the window of {args.window}:")
+        for h in sorted(late, key=lambda h: h["end"]):
+            end = timedelta(seconds=round(h["end"]))
+            estimated = " (estimated)" if h["estimated"] else ""
+            print(f"{h['hostname']:<20}: ends after {end}{estimated}")
+    if failed:
+        print("hosts failing to acquire their lock:")
+        for h in failed:
+            print(f"{h['hostname']:<20}: lock busy")
+    return 1 if late or failed else 0
+
+
+def daemon(args):
+    cache = {}
+    config = load(
+        args.conf,
+        cache=cache,
+        compiled=args.config_cache,
+        strict=args.strict_includes,
+    )
+    # NOTE: logging is configured by Daemon, see run() for possible ValueErrors
+    try:
+        proc = Daemon(
+            args.conf,
+            config,
+            cache=cache,
+            compiled=args.config_cache,
+            strict=args.strict_includes,
+            select=lambda config: select(config, args),
+            poll=args.poll,
+        )
+    except SelectorError as e:
+        log.error("%s, aborting.", e)
+        exit(1)
+    return proc.run_forever()
+
+
+def shards(args):
+    config = load(args.conf, compiled=args.config_cache, strict=args.strict_includes)
+    count = args.count or (config.shard.count if config.shard else None)
+    if not count or count < 1:
+        print("a positive number of shards must be given", file=sys.stderr)
+        exit(2)
+
+    durations = {}
+    if config.history and Path(config.history).exists():
+        with History(config.history) as history:
+            durations = history.durations()
+    known = sum(h.hostname in durations for h in config.hosts)
+
+    planned = plan(config.hosts, count, durations)
+    total = sum(s["load"] for s in planned) or 1
+    mean = total / count
+    if known:
+        print(f"load estimated from history of {known}/{len(config.hosts)} hosts")
+    else:
+        print("no history available, load estimated from host count")
+    print(f"{'SHARD':<8} {'HOSTS':>7} {'LOAD':>12} {'SHARE':>7}")
+    for s in planned:
+        weight = timedelta(seconds=round(s["load"])) if known else len(s["hosts"])
+        share = 100 * s["load"] / total
+        shard = str(s["shard"])
+        print(f"{shard:<8} {len(s['hosts']):>7} {str(weight):>12} {share:>6.1f}%")
+    print(f"imbalance (max/mean load): {max(s['load'] for s in planned) / mean:.3f}")
+
+    if args.list:
+        for s in planned:
+            for host in s["hosts"]:
+                print(f"{s['shard']} {host.hostname}")
+    return 0
+
+
+def merge(args):
+    directory = args.queue or load(args.conf).queue
+    if not directory:
+        print("queue directory neither in config nor given", file=sys.stderr)
+        exit(2)
+
+    queue = WorkQueue(directory, run=args.queue_run)
+    reports = list(queue.load_reports())
+    if not reports:
+        print(f"no report found in {queue.reports}", file=sys.stderr)
+        exit(1)
+    report = WorkQueue.merge(reports)
+    summary = report["summary"]
+
+    if args.json:
+        print(json.dumps(report, indent=2, default=str))
+    else:
+        print(f"{'Workers':<20}: {', '.join(report['workers'])}")
+        for result in report["results"]:
+            if result["status"] != "SUCCEEDED":
+                print(f"{result['hostname']:<20}: {result['status']}")
+        if summary["REGRESSIONS"]:
+            print(f"{'Regressions':<20}: {summary['REGRESSED']} hosts regressed")
+            for r in summary["REGRESSIONS"]:
+                msg, *values = describe(r)
+                print(msg % tuple(values))
+        if summary["CIRCUITS"]:
+            print(f"{'Circuits':<20}: {summary['OPEN']} hosts not backuped")
+            for c in summary["CIRCUITS"]:
+                msg, *values = open_circuit(c)
+                print(msg % tuple(values))
+        if summary["UNCLAIMED"]:
+            print(f"{'Unclaimed':<20}: {', '.join(summary['UNCLAIMED'])}")
+        print(f"{'Summary':<20}: RUNTIME {summary['RUNTIME']}")
+        print(
+            f"{'Summary':<20}: "
+            "SUCCESS %(SUCCEEDED)3d/%(TOTAL)-3d  "
+            "FAILURE %(FAILED)3d/%(TOTAL)-3d  "
+            "SKIPPED %(SKIPPED)3d/%(TOTAL)-3d" % summary
+        )
+        for phase, d in summary["PHASES"].items():
+            print(
+                f"{'Phases':<20}: {phase:<9} min {d['min']:9.3f}s  "
+                f"median {d['median']:9.3f}s  p95 {d['p95']:9.3f}s"
+            )
+        if summary["THROUGHPUT"]:
+            t = summary["THROUGHPUT"]
+            print(
+                f"{'Transfer':<20}: {format_size(summary['BYTES'])} original  "
+                f"min {t['min']:.1f} MB/s  median {t['median']:.1f} MB/s  "
+                f"p95 {t['p95']:.1f} MB/s"
+            )
+        if summary["RESOURCES"]:
+            print(f"{'Resources':<20}: {format_usage(summary['RESOURCES'])}")
+    return 0 if summary["STATUS"] == "success" else 1
+
+
+def add_config_arguments(parser):
+    parser.add_argument(
+        "--config-cache",
+        metavar="FILENAME",
+        type=Path,
+        help="store the parsed configuration in FILENAME, and load it from there "
+        "as long as none of the configuration files changed",
+    )
+    parser.add_argument(
+        "--strict-includes",
+        action="store_true",
+        help="fail if mappings included by a same !include share keys, instead "
+        "of keeping the value of the last file",
+    )
+
+
+def add_selection_arguments(parser):
+    limits_p = parser.add_mutually_exclusive_group()
+    limits_p.add_argument(
+        "--only",
+        metavar="SELECTOR",
+        nargs="+",
+        help="limit backups to the hosts matched by these selectors only",
+    )
+    limits_p.add_argument(
+        "--exclude",
+        metavar="SELECTOR",
+        nargs="+",
+        help="do not backup the hosts matched by these selectors",
+    )
+    parser.add_argument(
+        "--shard",
+        metavar="K/N",
+        type=shard_type,
+        help="only backup the K-th out of N shares of the hosts (overrides config)",
+    )
 
 
 def cli():
@@ -83,7 +546,7 @@ def cli():
 
     run_p = subcommands.add_parser(
         "run",
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        formatter_class=HelpFormatter,
         help="Run a series of backups according to a conf file",
     )
     run_p.add_argument(
@@ -91,21 +554,177 @@ def cli():
         "--conf",
         metavar="FILENAME",
         type=Path,
-        default="/etc/backup/config.yml",
-        help="set configuration file",
+        action=AppendPath,
+        default=[Path("/etc/backup/config.yml")],
+        help="set configuration file, can be given several times to run the "
+        "backups of several configurations in one process, each of them keeping "
+        "its own logging, mails and history (default: /etc/backup/config.yml)",
     )
-    limits_p = run_p.add_mutually_exclusive_group()
-    limits_p.add_argument(
-        "--only", metavar="HOST", nargs="+", help="limit backups to these hosts only"
+    add_config_arguments(run_p)
+    add_selection_arguments(run_p)
+    run_p.add_argument(
+        "-f", "--failfast", action="store_true", help="quit on the first error",
     )
-    limits_p.add_argument(
-        "--exclude", metavar="HOST", nargs="+", help="do not backup these hosts"
+    run_p.add_argument(
+        "-w",
+        "--workers",
+        metavar="N",
+        type=int,
+        help="number of backups run concurrently (overrides config)",
     )
     run_p.add_argument(
-        "-f", "--failfast", action="store_true", help="quit on the first error",
+        "--total-workers",
+        metavar="N",
+        type=int,
+        help="with several --conf, maximum number of backups run concurrently "
+        "over all of them, workers being shared fairly among configurations "
+        "(default: the sum of their workers)",
+    )
+    run_p.add_argument(
+        "--ssh-masters",
+        metavar="N",
+        type=int,
+        help="run the probe of the circuit breaker and the backup of each host "
+        "over a shared ssh master connection, at most N of them being open at once",
+    )
+    run_p.add_argument(
+        "--launch-rate",
+        metavar="N",
+        type=rate_type,
+        help="start at most N backups per second, lowered automatically when "
+        "tunnels are refused (overrides config). With several --conf, a single "
+        "rate is shared by all of them, its burst and jitter coming from the first "
+        "config with a launch section",
+    )
+    run_p.add_argument(
+        "--profile",
+        metavar="DIR",
+        type=Path,
+        help="profile the CPU and memory usage of this process, writing the "
+        "hot functions and the top allocators to files in DIR",
+    )
+    run_p.add_argument(
+        "--profile-every",
+        metavar="N",
+        type=int,
+        default=100,
+        help="with --profile, take a memory snapshot every N hosts",
+    )
+    run_p.add_argument(
+        "--trace",
+        metavar="FILENAME",
+        type=Path,
+        help="write the timeline of the run to FILENAME, in the Chrome trace "
+        "format (see chrome://tracing or https://ui.perfetto.dev)",
+    )
+    run_p.add_argument(
+        "--plan",
+        action="store_true",
+        help="do not run any backup, print the predicted course of the run "
+        "instead, simulated from the durations recorded in history",
+    )
+    run_p.add_argument(
+        "--window",
+        metavar="DURATION",
+        type=interval_type,
+        default="24h",
+        help="with --plan, report the hosts whose backup would end after "
+        "DURATION (seconds, or a number followed by s, m, h or d)",
+    )
+    run_p.add_argument(
+        "--queue",
+        metavar="DIRECTORY",
+        type=Path,
+        help="claim hosts from a work queue shared with other processes "
+        "(overrides config)",
+    )
+    run_p.add_argument(
+        "--queue-run",
+        metavar="NAME",
+        help="name of the run in the work queue (default: the current date)",
     )
     run_p.set_defaults(func=run)
 
+    daemon_p = subcommands.add_parser(
+        "daemon",
+        formatter_class=HelpFormatter,
+        help="Backup hosts according to their schedule, until SIGTERM",
+    )
+    daemon_p.add_argument(
+        "-c",
+        "--conf",
+        metavar="FILENAME",
+        type=Path,
+        default="/etc/backup/config.yml",
+        help="set configuration file, reloaded on SIGHUP",
+    )
+    add_config_arguments(daemon_p)
+    add_selection_arguments(daemon_p)
+    daemon_p.add_argument(
+        "--poll",
+        metavar="SECONDS",
+        type=int,
+        default=60,
+        help="reload the configuration when its files change, checked every "
+        "SECONDS (0 to only reload on SIGHUP)",
+    )
+    daemon_p.set_defaults(func=daemon)
+
+    shards_p = subcommands.add_parser(
+        "shards",
+        formatter_class=HelpFormatter,
+        help="Print the assignment of hosts to shards and their expected load",
+    )
+    shards_p.add_argument(
+        "-c",
+        "--conf",
+        metavar="FILENAME",
+        type=Path,
+        default="/etc/backup/config.yml",
+        help="set configuration file",
+    )
+    add_config_arguments(shards_p)
+    shards_p.add_argument(
+        "-n",
+        "--count",
+        metavar="N",
+        type=int,
+        help="number of shards (default: the one of the config)",
+    )
+    shards_p.add_argument(
+        "-l", "--list", action="store_true", help="print the shard of every host",
+    )
+    shards_p.set_defaults(func=shards)
+
+    merge_p = subcommands.add_parser(
+        "merge",
+        formatter_class=HelpFormatter,
+        help="Merge the reports of the processes of a work queue run",
+    )
+    merge_p.add_argument(
+        "-c",
+        "--conf",
+        metavar="FILENAME",
+        type=Path,
+        default="/etc/backup/config.yml",
+        help="set configuration file",
+    )
+    merge_p.add_argument(
+        "--queue",
+        metavar="DIRECTORY",
+        type=Path,
+        help="work queue directory (default: the one of the config)",
+    )
+    merge_p.add_argument(
+        "--queue-run",
+        metavar="NAME",
+        help="name of the run in the work queue (default: the current date)",
+    )
+    merge_p.add_argument(
+        "--json", action="store_true", help="print the merged report as JSON",
+    )
+    merge_p.set_defaults(func=merge)
+
     return parser
 
 
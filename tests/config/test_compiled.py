@@ -0,0 +1,78 @@
+import unittest
+from unittest.mock import patch
+
+import os
+from pathlib import Path
+import tempfile
+
+import qb.backup.config.compiled as module
+
+
+class TestFunctions(unittest.TestCase):
+    def test_changed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            path = tmp / "a.yml"
+            path.write_text("[a.test]")
+            sources = {str(path): module.IncludeLoader.stat(path)}
+            patterns = {(tmp, "*.yml")}
+            self.assertFalse(module.changed(sources, patterns))
+
+            (tmp / "b.yml").write_text("[b.test]")
+            self.assertTrue(module.changed(sources, patterns))
+            self.assertFalse(module.changed(sources, set()))
+
+            os.utime(path, ns=(0, 0))
+            self.assertTrue(module.changed(sources, set()))
+
+
+class TestCompiledCache(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = Path(self._tmp.name)
+        self.config = self.tmp / "config.yml"
+        self.config.write_text("{}")
+        self.sources = {str(self.config): module.IncludeLoader.stat(self.config)}
+        self.compiled = module.CompiledCache(self.tmp / "config.cache")
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_get_missing(self):
+        self.assertIsNone(self.compiled.get(self.config))
+
+    def test_put_get(self):
+        document = {"hosts": ["a.test"]}
+
+        self.compiled.put(self.config, document, self.sources, set())
+        res = self.compiled.get(self.config)
+
+        self.assertEqual(res, (document, self.sources, set()))
+        # No temporary file left
+        self.assertEqual(list(self.tmp.glob(".*")), [])
+
+    def test_get_other_path(self):
+        self.compiled.put(self.config, {}, self.sources, set())
+
+        self.assertIsNone(self.compiled.get(self.tmp / "other.yml"))
+
+    def test_get_changed(self):
+        self.compiled.put(self.config, {}, self.sources, set())
+        os.utime(self.config, ns=(0, 0))
+
+        self.assertIsNone(self.compiled.get(self.config))
+
+    @patch.object(module, "log")
+    def test_get_corrupted(self, m_log):
+        self.compiled.path.write_bytes(b"garbage")
+
+        self.assertIsNone(self.compiled.get(self.config))
+        m_log.debug.assert_called()
+
+    @patch.object(module, "log")
+    def test_put_error(self, m_log):
+        compiled = module.CompiledCache(self.tmp / "missing" / "config.cache")
+
+        compiled.put(self.config, {}, self.sources, set())
+
+        m_log.warning.assert_called()
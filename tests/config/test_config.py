@@ -1,7 +1,11 @@
 import unittest
 from unittest.mock import mock_open, patch
+from parameterized import parameterized
 
+from datetime import timedelta
+import os
 from pathlib import Path
+import tempfile
 
 import qb.backup.config.config as module
 
@@ -44,7 +48,10 @@ class TestConfig(unittest.TestCase):
     def test___init__hosts(self):
         dct = {
             "default": {"port": 33},
-            "hosts": ["foo.test", {"hostname": "bar.test", "port": 44}],
+            "hosts": [
+                "foo.test",
+                {"hostname": "bar.test", "port": 44, "tags": ["web", "prod"]},
+            ],
             "logging": {},
         }
 
@@ -54,6 +61,282 @@ class TestConfig(unittest.TestCase):
         self.assertEqual(foo.port, "33")
         self.assertEqual(bar.hostname, "bar.test")
         self.assertEqual(bar.port, "44")
+        self.assertEqual(foo.tags, frozenset())
+        self.assertEqual(bar.tags, {"web", "prod"})
+
+    def test___init__hosts_compact(self):
+        dct = {
+            "default": {"lock": "/var/lock/{}.lock"},
+            "hosts": [
+                {"hostname": "foo.test", "tags": ["web"]},
+                {"hostname": "bar.test", "tags": ["web"], "lock": "/tmp/bar.lock"},
+            ],
+        }
+
+        foo, bar = module.Config(dct).hosts
+
+        self.assertFalse(hasattr(foo, "__dict__"))
+        self.assertIs(foo.tags, bar.tags)
+        self.assertIs(foo.port, bar.port)
+        # Lock paths are built when used, once
+        self.assertEqual(foo._lock, None)
+        self.assertEqual(foo.lock, Path("/var/lock/foo.test.lock"))
+        self.assertIs(foo.lock, foo.lock)
+        self.assertEqual(bar.lock, Path("/tmp/bar.lock"))
+
+    def test___init__hosts_no_lock(self):
+        foo, = module.Config({"hosts": ["foo.test"]}).hosts
+
+        self.log.error.assert_called_once()
+        with self.assertRaises(AttributeError):
+            foo.lock
+
+    def test_inventory(self):
+        config = module.Config({"hosts": ["foo.test", {"hostname": "bar.test"}]})
+
+        with patch.object(config.Host, "from_entry", wraps=config.Host.from_entry) as m:
+            hosts = iter(config.inventory)
+            self.assertEqual(len(config.inventory), 2)
+            m.assert_not_called()
+            self.assertEqual(next(hosts).hostname, "foo.test")
+            m.assert_called_once()
+
+        self.assertEqual([h.hostname for h in config.hosts], ["foo.test", "bar.test"])
+        self.assertIs(config.hosts, config.hosts)
+
+    # fmt: off
+    @parameterized.expand([
+        ({"hosts": [{"port": 22}]}, "without hostname"),
+        ({"hosts": [["foo.test"]]}, "without hostname"),
+        ({"hosts": [{"hostname": 42}]}, "hostname must be a string"),
+        ({"hosts": [{"hostname": "foo.test", "tags": "web"}]}, "list of strings"),
+        ({"hosts": [{"hostname": "foo.test", "tags": ["web", 1]}]}, "list of str"),
+        ({"hosts": [{"hostname": "foo.test", "prot": 22}]}, "prot"),
+        ({"hosts": [{"hostname": "foo.test", "interval": "2x"}]}, "interval"),
+        ({"default": {"schedule": "* *"}, "hosts": []}, "5 fields"),
+        ({"cgroup": {"root": "/cg", "default": {"cpu.max": 1}}}, "cpu.max"),
+        ({"launch": {"rate": -1}}, "rate must be positive"),
+        ({"breaker": {"failures": 3}}, "requires a history"),
+        ({"hosts": [{"hostname": "foo.test", "transport": "rsh"}]}, "rsh"),
+        ({"default": {"transport": {"local": []}}, "hosts": []}, "without command"),
+        ({"history": "h.db", "breaker": {"failures": 0}}, "failures"),
+    ])
+    # fmt: on
+    def test___init__hosts_error(self, dct, msg):
+        with self.assertRaisesRegex(module.ConfigError, msg):
+            module.Config(dct)
+
+    def test___init__duplicates(self):
+        dct = {
+            "hosts": ["foo.test", "bar.test", {"hostname": "foo.test", "port": 23}],
+        }
+
+        with self.assertRaisesRegex(module.ConfigError, "foo.test"):
+            module.Config(dct)
+
+    def test___init__schedule(self):
+        dct = {
+            "default": {"schedule": "0 3 * * *"},
+            "hosts": [
+                "foo.test",
+                {"hostname": "bar.test", "interval": "6h"},
+                {"hostname": "baz.test", "schedule": "0 4 * * *"},
+            ],
+        }
+
+        foo, bar, baz = module.Config(dct).hosts
+
+        self.assertEqual(foo.schedule, module.Cron("0 3 * * *"))
+        self.assertIsNone(foo.interval)
+        # Host settings replace the default ones
+        self.assertIsNone(bar.schedule)
+        self.assertEqual(bar.interval, timedelta(hours=6))
+        self.assertEqual(baz.schedule, module.Cron("0 4 * * *"))
+
+    def test___init__transport(self):
+        dct = {
+            "default": {"transport": {"local": "jexec {hostname} backup"}},
+            "hosts": [
+                "jail1",
+                {"hostname": "foo.test", "transport": "ssh"},
+                {"hostname": "jail2", "transport": {"local": "jexec {hostname} b"}},
+            ],
+        }
+
+        jail1, foo, jail2 = module.Config(dct).hosts
+
+        self.assertEqual(jail1.transport.command(jail1), ["jexec", "jail1", "backup"])
+        self.assertEqual(foo.transport.name, "ssh")
+        self.assertEqual(jail2.transport.command(jail2), ["jexec", "jail2", "b"])
+        (default,) = module.Config({"hosts": ["foo.test"]}).hosts
+        self.assertEqual(default.transport.name, "ssh")
+
+    def test___init__schedule_error(self):
+        dct = {"hosts": [{"hostname": "foo.test", "schedule": "0 25 * * *"}]}
+
+        with self.assertRaises(module.ConfigError):
+            module.Config(dct)
+
+    # fmt: off
+    @parameterized.expand([
+        ({"workers": 0},),
+        ({"workers": "4"},),
+        ({"workers": 1.5},),
+        ({"lock_timeout": -1},),
+        ({"lock_timeout": "600"},),
+    ])
+    # fmt: on
+    def test___init__workers_error(self, dct):
+        with self.assertRaises(module.ConfigError):
+            module.Config(dct)
+
+    def test_stale(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            (tmp / "hosts").mkdir()
+            (tmp / "hosts" / "a.yml").write_text("[a.test]")
+            (tmp / "config.yml").write_text(
+                "{default: {lock: '{}.lock'}, hosts: !include 'hosts/*.yml'}"
+            )
+            cache = {}
+
+            config = module.Config.load(tmp / "config.yml", cache=cache)
+            self.assertEqual([h.hostname for h in config.hosts], ["a.test"])
+            self.assertFalse(config.stale())
+            self.assertIn(str(tmp / "hosts" / "a.yml"), cache)
+
+            # New included file
+            (tmp / "hosts" / "b.yml").write_text("[b.test]")
+            self.assertTrue(config.stale())
+            config = module.Config.load(tmp / "config.yml", cache=cache)
+            self.assertFalse(config.stale())
+
+            # Modified file
+            os.utime(tmp / "config.yml", ns=(0, 0))
+            self.assertTrue(config.stale())
+            config = module.Config.load(tmp / "config.yml", cache=cache)
+
+            # Deleted file
+            (tmp / "hosts" / "a.yml").unlink()
+            self.assertTrue(config.stale())
+            config = module.Config.load(tmp / "config.yml", cache=cache)
+            self.assertEqual([h.hostname for h in config.hosts], ["b.test"])
+            self.assertNotIn(str(tmp / "hosts" / "a.yml"), cache)
+
+    def test_stale_nested(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            (tmp / "sub" / "more").mkdir(parents=True)
+            (tmp / "sub" / "hosts.yml").write_text("!include more/*.yml")
+            (tmp / "sub" / "more" / "a.yml").write_text("[a.test]")
+            (tmp / "config.yml").write_text(
+                "{default: {lock: '{}.lock'}, hosts: !include sub/hosts.yml}"
+            )
+            cache = {}
+            config = module.Config.load(tmp / "config.yml", cache=cache)
+
+            # Reload with the included files unchanged
+            os.utime(tmp / "config.yml", ns=(0, 0))
+            self.assertTrue(config.stale())
+            config = module.Config.load(tmp / "config.yml", cache=cache)
+            self.assertEqual([h.hostname for h in config.hosts], ["a.test"])
+            self.assertFalse(config.stale())
+
+            # Modified nested file
+            (tmp / "sub" / "more" / "a.yml").write_text("[a.test, b.test]")
+            os.utime(tmp / "sub" / "more" / "a.yml", ns=(0, 0))
+            self.assertTrue(config.stale())
+            config = module.Config.load(tmp / "config.yml", cache=cache)
+            self.assertEqual([h.hostname for h in config.hosts], ["a.test", "b.test"])
+
+    @patch.object(module.yaml, "load", wraps=module.yaml.load)
+    def test_load_compiled(self, m_load):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            (tmp / "hosts").mkdir()
+            (tmp / "hosts" / "a.yml").write_text("[a.test, {hostname: b.test}]")
+            (tmp / "config.yml").write_text(
+                "{default: {lock: '{}.lock'}, hosts: !include 'hosts/*.yml'}"
+            )
+            compiled = tmp / "config.cache"
+
+            def parsed():
+                # Files parsed with IncludeLoader, not the default logging config
+                loaders = [c[1].get("Loader", c[0][-1]) for c in m_load.call_args_list]
+                m_load.reset_mock()
+                return sum(issubclass(cls, module.IncludeLoader) for cls in loaders)
+
+            config = module.Config.load(tmp / "config.yml", compiled=compiled)
+            self.assertTrue(compiled.exists())
+            self.assertEqual(parsed(), 2)
+
+            config = module.Config.load(tmp / "config.yml", compiled=compiled)
+            # Nothing parsed again
+            self.assertEqual(parsed(), 0)
+            hostnames = [h.hostname for h in config.hosts]
+            self.assertEqual(hostnames, ["a.test", "b.test"])
+            self.assertEqual(config.hosts[0].lock, Path("a.test.lock"))
+            self.assertFalse(config.stale())
+
+            # New included file
+            (tmp / "hosts" / "c.yml").write_text("[c.test]")
+            config = module.Config.load(tmp / "config.yml", compiled=compiled)
+            self.assertEqual(parsed(), 3)
+            hostnames = sorted(h.hostname for h in config.hosts)
+            self.assertEqual(hostnames, ["a.test", "b.test", "c.test"])
+
+    def test_load_strict(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            (tmp / "default").mkdir()
+            (tmp / "default" / "a.yml").write_text("{port: 22, lock: '{}.lock'}")
+            (tmp / "default" / "b.yml").write_text("{port: 23}")
+            (tmp / "config.yml").write_text(
+                "{default: !include 'default/*.yml', hosts: [a.test]}"
+            )
+
+            config = module.Config.load(tmp / "config.yml")
+            self.assertEqual(config.hosts[0].port, "23")
+
+            with self.assertRaisesRegex(module.ConfigError, "'port' in .*a.yml"):
+                module.Config.load(tmp / "config.yml", strict=True)
+
+    def test_load_inventory(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            inventory = "hostname,port,lock\nfoo.test,,\nbar.test,23,/b\n"
+            (tmp / "hosts.csv").write_text(inventory)
+            (tmp / "config.yml").write_text(
+                "{default: {lock: '/var/lock/{}.lock', port: 2222},"
+                " hosts: !inventory hosts.csv}"
+            )
+            cache = {}
+
+            config = module.Config.load(tmp / "config.yml", cache=cache)
+            foo, bar = config.hosts
+
+            self.assertEqual((foo.hostname, foo.port), ("foo.test", "2222"))
+            self.assertEqual(foo.lock, Path("/var/lock/foo.test.lock"))
+            self.assertEqual((bar.hostname, bar.port), ("bar.test", "23"))
+            self.assertEqual(bar.lock, Path("/b"))
+            # The inventory is tracked as the included files
+            self.assertFalse(config.stale())
+            self.assertIn(str(tmp / "hosts.csv"), cache)
+            (tmp / "hosts.csv").write_text("hostname\nbaz.test\n")
+            self.assertTrue(config.stale())
+            config = module.Config.load(tmp / "config.yml", cache=cache)
+            self.assertEqual([h.hostname for h in config.hosts], ["baz.test"])
+
+    def test_load_inventory_error(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            (tmp / "config.yml").write_text("hosts: !inventory missing.json")
+
+            with self.assertRaisesRegex(module.ConfigError, "missing.json"):
+                module.Config.load(tmp / "config.yml")
+
+    def test_stale_untracked(self):
+        self.assertFalse(module.Config({}).stale())
 
     def test___init__logging0(self):
         dct = {
@@ -0,0 +1,108 @@
+import unittest
+from parameterized import parameterized
+
+from pathlib import Path
+import sqlite3
+import tempfile
+
+import qb.backup.config.inventory as module
+
+
+class TestParseUrl(unittest.TestCase):
+    # fmt: off
+    @parameterized.expand([
+        ("sqlite:///etc/backup/hosts.db", "sqlite", "/etc/backup/hosts.db", {}),
+        ("sqlite:hosts?table=servers", "sqlite", "/cwd/hosts", {"table": "servers"}),
+        ("json:/etc/backup/hosts", "json", "/etc/backup/hosts", {}),
+        ("hosts.json", "json", "/cwd/hosts.json", {}),
+        ("/etc/backup/hosts.csv?delimiter=;", "csv", "/etc/backup/hosts.csv",
+         {"delimiter": ";"}),
+        ("cmdb/hosts.sqlite3", "sqlite", "/cwd/cmdb/hosts.sqlite3", {}),
+    ])
+    # fmt: on
+    def test_parse_url(self, url, fmt, path, options):
+        res = module.parse_url(url, Path("/cwd"))
+
+        self.assertEqual(res, (fmt, Path(path), options))
+
+    @parameterized.expand([("hosts.yml",), ("xml:hosts",), ("hosts",)])
+    def test_parse_url_unknown(self, url):
+        with self.assertRaises(ValueError):
+            module.parse_url(url, Path("/cwd"))
+
+
+class TestLoad(unittest.TestCase):
+
+    EXPECTED = [
+        {"hostname": "foo.test"},
+        {"hostname": "bar.test", "port": "23", "tags": ["web", "prod"]},
+    ]
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = Path(self._tmp.name)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_load_json(self):
+        path = self.tmp / "hosts.json"
+        path.write_text('["foo.test", {"hostname": "bar.test", "port": 23}]')
+
+        res = module.load("json", path, {})
+
+        self.assertEqual(res, ["foo.test", {"hostname": "bar.test", "port": 23}])
+
+    def test_load_json_not_list(self):
+        path = self.tmp / "hosts.json"
+        path.write_text('{"hostname": "foo.test"}')
+
+        with self.assertRaises(ValueError):
+            module.load("json", path, {})
+
+    def test_load_csv(self):
+        path = self.tmp / "hosts.csv"
+        path.write_text("hostname,port,tags\nfoo.test,,\nbar.test,23,\"web,prod\"\n")
+
+        res = module.load("csv", path, {})
+
+        self.assertEqual(res, self.EXPECTED)
+
+    def test_load_csv_delimiter(self):
+        path = self.tmp / "hosts.csv"
+        path.write_text("hostname;port;tags\nfoo.test;;\nbar.test;23;web prod\n")
+
+        res = module.load("csv", path, {"delimiter": ";"})
+
+        self.assertEqual(res, self.EXPECTED)
+
+    def sqlite(self):
+        path = self.tmp / "hosts.db"
+        db = sqlite3.connect(str(path))
+        db.execute("CREATE TABLE hosts (hostname TEXT, port TEXT, tags TEXT)")
+        db.execute("INSERT INTO hosts VALUES ('foo.test', NULL, '')")
+        db.execute("INSERT INTO hosts VALUES ('bar.test', '23', 'web prod')")
+        db.commit()
+        db.close()
+        return path
+
+    def test_load_sqlite(self):
+        res = module.load("sqlite", self.sqlite(), {})
+
+        self.assertEqual(res, self.EXPECTED)
+
+    def test_load_sqlite_query(self):
+        query = "SELECT hostname FROM hosts WHERE tags LIKE '%web%'"
+
+        res = module.load("sqlite", self.sqlite(), {"query": query})
+
+        self.assertEqual(res, [{"hostname": "bar.test"}])
+
+    def test_load_sqlite_error(self):
+        with self.assertRaises(ValueError):
+            module.load("sqlite", self.sqlite(), {"table": "missing"})
+
+        with self.assertRaises(ValueError):
+            module.load("sqlite", self.tmp / "missing.db", {})
+        # The database is not created
+        self.assertFalse((self.tmp / "missing.db").exists())
@@ -1,8 +1,11 @@
 import unittest
 from unittest.mock import Mock, patch
+from parameterized import parameterized
 
 from io import BytesIO
+import os
 from pathlib import Path
+import tempfile
 import yaml
 
 import qb.backup.config.parser as module
@@ -23,7 +26,7 @@ class TestIncludeLoader(unittest.TestCase):
     @patch("builtins.open")
     @patch.object(module.Path, "glob")
     def test_include_mappings(self, m_glob, m_open):
-        m_glob.return_value = (Mock(Path), Mock(Path))
+        m_glob.return_value = (Path("/path/to/b"), Path("/path/to/a"))
         m_open.side_effect = (BytesIO(b'{"a": 1}'), BytesIO(b'{"b": 2}'))
 
         res = self.loader.include(Mock(yaml.ScalarNode, value="/path/to/whatever"))
@@ -35,7 +38,7 @@ class TestIncludeLoader(unittest.TestCase):
     @patch("builtins.open")
     @patch.object(module.Path, "glob")
     def test_include_sequences(self, m_glob, m_open):
-        m_glob.return_value = (Mock(Path), Mock(Path))
+        m_glob.return_value = (Path("relpath/to/b"), Path("relpath/to/a"))
         m_open.side_effect = (BytesIO(b"[1, 2, 3]"), BytesIO(b"[4, 5]"))
 
         res = self.loader.include(Mock(yaml.ScalarNode, value="./relpath/to/whatever"))
@@ -43,6 +46,8 @@ class TestIncludeLoader(unittest.TestCase):
         self.assertEqual(list(res), [1, 2, 3, 4, 5])
         # Path.glob must not be called with an absolute pattern
         self.assertFalse(m_glob.call_args[0][0].startswith("/"))
+        # Files are loaded in sorted order
+        self.assertEqual(m_open.call_args_list[0][0][0], Path("relpath/to/a"))
 
     def test_merge_empty(self):
         res = module.IncludeLoader.merge(())
@@ -54,7 +59,236 @@ class TestIncludeLoader(unittest.TestCase):
 
         self.assertEqual(res, {"a": 1, "b": 2, "c": 3, "d": 2})
 
+    def test_merge_mappings_precedence(self):
+        res = module.IncludeLoader.merge(({"a": 1, "b": 2}, {"b": 3}, {"a": 4}))
+
+        self.assertIs(type(res), dict)
+        self.assertEqual(res, {"a": 4, "b": 3})
+
+    def test_merge_mappings_strict(self):
+        paths = [Path("a.yml"), Path("b.yml"), Path("c.yml")]
+
+        with self.assertRaises(ValueError) as ctx:
+            module.IncludeLoader.merge(
+                ({"a": 1, "b": 2}, {"b": 3}, {"c": 4, "a": 5}), paths, strict=True
+            )
+
+        msg = str(ctx.exception)
+        self.assertIn("'b' in a.yml and b.yml", msg)
+        self.assertIn("'a' in a.yml and c.yml", msg)
+        self.assertNotIn("'c'", msg)
+
+    def test_merge_mappings_strict_no_conflict(self):
+        res = module.IncludeLoader.merge(({"a": 1}, {"b": 2}), strict=True)
+
+        self.assertEqual(res, {"a": 1, "b": 2})
+
     def test_merge_sequences(self):
         res = module.IncludeLoader.merge(([1, 2, 3], [2], [4, 0]))
 
         self.assertEqual(list(res), [1, 2, 3, 2, 4, 0])
+
+
+class TestIncludeLoaderSession(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = Path(self._tmp.name)
+        (self.tmp / "hosts").mkdir()
+        (self.tmp / "hosts" / "a.yml").write_text("[a.test]")
+        (self.tmp / "hosts" / "b.yml").write_text("[b.test]")
+        (self.tmp / "config.yml").write_text("hosts: !include hosts/*.yml")
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def load(self, loader):
+        with open(self.tmp / "config.yml") as fd:
+            conf = yaml.load(fd, Loader=loader)
+        return sorted(conf["hosts"])
+
+    def test_session_sources(self):
+        loader = module.IncludeLoader.session()
+
+        res = self.load(loader)
+
+        self.assertEqual(res, ["a.test", "b.test"])
+        self.assertEqual(
+            set(loader.sources),
+            {str(self.tmp / "hosts" / "a.yml"), str(self.tmp / "hosts" / "b.yml")},
+        )
+        self.assertEqual(loader.patterns, {(self.tmp, "hosts/*.yml")})
+        # Sessions do not share state with the base class
+        self.assertIsNone(module.IncludeLoader.sources)
+
+    @patch.object(module.yaml, "load", wraps=yaml.load)
+    def test_session_cache(self, m_load):
+        cache = {}
+        self.load(module.IncludeLoader.session(cache))
+        self.assertEqual(m_load.call_count, 3)
+
+        path = self.tmp / "hosts" / "b.yml"
+        path.write_text("[b.test, c.test]")
+        # Make sure the mtime changes even on coarse filesystems
+        os.utime(path, ns=(0, 0))
+        m_load.reset_mock()
+        res = self.load(module.IncludeLoader.session(cache))
+
+        self.assertEqual(res, ["a.test", "b.test", "c.test"])
+        # Only the main file and the changed file are parsed again
+        self.assertEqual(m_load.call_count, 2)
+
+    def test_parallel(self):
+        for i in range(10):
+            path = self.tmp / "hosts" / "c{}.yml".format(i)
+            path.write_text("[c{}.test]".format(i))
+        (self.tmp / "hosts" / "d.yml").write_text("!include ../more/*.yml")
+        (self.tmp / "more").mkdir()
+        (self.tmp / "more" / "e.yml").write_text("[e.test]")
+        cache = {}
+        loader = module.IncludeLoader.session(cache)
+        loader.parallel = 2
+        loader.processes = 2
+
+        with open(self.tmp / "config.yml") as fd:
+            res = list(yaml.load(fd, Loader=loader)["hosts"])
+
+        with open(self.tmp / "config.yml") as fd:
+            expected = list(yaml.load(fd, Loader=module.IncludeLoader)["hosts"])
+        self.assertEqual(res, expected)
+        # Sorted order
+        self.assertEqual(res[:4], ["a.test", "b.test", "c0.test", "c1.test"])
+        self.assertEqual(res[-1], "e.test")
+        # Files included in worker processes are recorded too
+        self.assertIn(str(self.tmp / "hosts" / "../more/e.yml"), loader.sources)
+        self.assertIn((self.tmp / "hosts", "../more/*.yml"), loader.patterns)
+        # Only the files without includes are cached
+        self.assertIn(str(self.tmp / "hosts" / "c9.yml"), cache)
+        self.assertNotIn(str(self.tmp / "hosts" / "d.yml"), cache)
+
+    @patch.object(module, "ProcessPoolExecutor")
+    def test_parallel_cache(self, m_executor):
+        m_executor.return_value.__enter__.return_value.map.return_value = ()
+        cache = {}
+        self.load(module.IncludeLoader.session(cache))
+
+        loader = module.IncludeLoader.session(cache)
+        loader.parallel = 2
+        res = self.load(loader)
+
+        self.assertEqual(res, ["a.test", "b.test"])
+        # Nothing to parse in the pool
+        map_ = m_executor.return_value.__enter__.return_value.map
+        self.assertEqual(list(map_.call_args[0][2]), [])
+
+
+# Inventories loaded by both loaders, config.yml being the main file
+# fmt: off
+INVENTORIES = [
+    ("sequences", {
+        "config.yml": "hosts: !include hosts/*.yml",
+        "hosts/a.yml": "[a.test, {hostname: b.test, port: 23}]",
+        "hosts/b.yml": "- c.test\n- {hostname: d.test, tags: [web, prod]}\n",
+    }),
+    ("mappings", {
+        "config.yml": "default: !include default/*.yml\nhosts: []",
+        "default/lock.yml": "lock: /var/lock/{}.lock",
+        "default/port.yml": "port: 2222\nschedule: '0 3 * * *'",
+    }),
+    ("nested", {
+        "config.yml": "hosts: !include sub/hosts.yml",
+        "sub/hosts.yml": "!include more/*.yml",
+        "sub/more/a.yml": "[a.test]",
+    }),
+    ("empty", {
+        "config.yml": "hosts: !include missing/*.yml\nlogging: {}",
+    }),
+    ("scalars", {
+        "config.yml": """
+workers: 4
+lock_timeout: 1.5
+history: ~
+queue: null
+flags: [yes, no, on, off, true, False]
+when: 2020-02-01
+at: 2020-02-01 12:30:00
+octal: 0o17
+hexa: 0x1F
+text: "caf\\u00e9 \\t"
+folded: >
+  a b
+  c
+literal: |
+  a
+  b
+anchors: {a: &x {port: 22}, b: *x, c: {<<: *x, lock: foo}}
+""",
+    }),
+]
+# fmt: on
+
+
+@unittest.skipIf(module.CIncludeLoader is None, "PyYAML built without libyaml")
+class TestLoaderParity(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = Path(self._tmp.name)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def write(self, files):
+        for name, content in files.items():
+            path = self.tmp / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(content)
+        return self.tmp / "config.yml"
+
+    def load(self, path, loader):
+        with open(path) as fd:
+            return loader.materialize(yaml.load(fd, Loader=loader))
+
+    def test_default(self):
+        self.assertIs(module.IncludeLoader, module.CIncludeLoader)
+
+    @parameterized.expand(INVENTORIES)
+    def test_parity(self, _, files):
+        path = self.write(files)
+
+        py = self.load(path, module.PyIncludeLoader)
+        c = self.load(path, module.CIncludeLoader)
+
+        self.assertEqual(py, c)
+
+    def test_parity_absolute(self):
+        self.write({"hosts/a.yml": "[a.test]"})
+        path = self.write(
+            {"config.yml": "hosts: !include {}".format(self.tmp / "hosts" / "*.yml")}
+        )
+
+        py = self.load(path, module.PyIncludeLoader)
+        c = self.load(path, module.CIncludeLoader)
+
+        self.assertEqual(py, c)
+        self.assertEqual(c, {"hosts": ["a.test"]})
+
+    def test_parity_session(self):
+        path = self.write(INVENTORIES[0][1])
+        py = module.PyIncludeLoader.session()
+        c = module.CIncludeLoader.session()
+
+        self.assertEqual(self.load(path, py), self.load(path, c))
+        self.assertEqual(py.sources, c.sources)
+        self.assertEqual(py.patterns, c.patterns)
+
+    # fmt: off
+    @parameterized.expand([
+        ("[a.test",), ("{a: 1",), ("a: b: c",), ("- a\nb: 1",), ("!unknown x",),
+    ])
+    # fmt: on
+    def test_parity_error(self, content):
+        path = self.write({"config.yml": "hosts: !include hosts.yml"})
+        self.write({"hosts.yml": content})
+
+        for loader in (module.PyIncludeLoader, module.CIncludeLoader):
+            with self.assertRaises(yaml.YAMLError):
+                self.load(path, loader)
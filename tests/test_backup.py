@@ -1,19 +1,23 @@
 import unittest
-from unittest.mock import Mock, patch
+from unittest.mock import MagicMock, Mock, patch
 
 import collections
 import logging
 from pathlib import Path
 from subprocess import CompletedProcess, CalledProcessError, TimeoutExpired
+import threading
+import time
 
 import qb.backup.backup as module
+from qb.backup.transport import SSH, LocalTransport
 
 
 class Host:
-    def __init__(self, hostname, port=None, lock=None):
+    def __init__(self, hostname, port=None, lock=None, transport=SSH):
         self.hostname = hostname
         self.port = str(port or 22)
         self.lock = lock or Path("/tmp/qb.backup-test.lock")
+        self.transport = transport
 
 
 class TestFunctions(unittest.TestCase):
@@ -82,21 +86,68 @@ class TestBackuper(unittest.TestCase):
 
         self.assertEqual(self.b.backup.call_count, 2)
 
-    @patch.object(module.subprocess, "run")
-    @patch.object(module, "FLock")
-    def test_run_fail_lock(self, m_FLock, m_run):
+    @patch.object(module, "run_command")
+    def test_run_fail_lock(self, m_run):
         host = "example.test"
-        m_FLock.side_effect = module.FLockError
+        self.b.locks = Mock(**{"lock.side_effect": module.FLockBusyError})
 
         self.b.hosts = [Host(host)]
         rc = self.b.run()
 
         self.assertEqual(rc, 1)
+        self.assertEqual(self.b.summary["FAILED"], 1)
         self.log.warning.assert_called()
         self.log.error.assert_not_called()
         m_run.assert_not_called()
+        # Tried again, waiting for the lock
+        self.assertEqual(self.b.locks.lock.call_count, 2)
 
-    @patch.object(module.subprocess, "run")
+    @patch.object(module, "run_command")
+    def test_run_fail_lock_error(self, m_run):
+        self.b.locks = Mock(**{"lock.side_effect": module.FLockError})
+
+        self.b.hosts = [Host("example.test")]
+        rc = self.b.run()
+
+        self.assertEqual(rc, 1)
+        self.log.warning.assert_called()
+        # Not a busy lock, not tried again
+        self.b.locks.lock.assert_called_once()
+
+    @patch.object(module, "run_command")
+    def test_run_requeue(self, m_run):
+        m_run.return_value = CompletedProcess("cmd", 0, "output text")
+        busy = Path("/tmp/qb.backup-test-busy.lock")
+        self.b.locks = Mock()
+        locked = MagicMock()
+        self.b.locks.lock.side_effect = (module.FLockBusyError, locked, locked)
+        self.b.lock_timeout = 60
+        self.b.on_done = on_done = Mock()
+
+        self.b.hosts = [Host("foo.test", lock=busy), Host("bar.test")]
+        rc = self.b.run()
+
+        self.assertEqual(rc, 0)
+        self.assertEqual(self.b.summary["SUCCEEDED"], 2)
+        # The busy host is backuped after the other one, waiting for its lock
+        hostnames = [r["hostname"] for r in self.b.results]
+        self.assertEqual(hostnames, ["bar.test", "foo.test"])
+        self.assertEqual(self.b.locks.lock.call_args_list[-1][0], (busy, 60))
+        self.assertEqual([c[0][0].hostname for c in on_done.call_args_list], hostnames)
+
+    def test_run_workers(self):
+        barrier = threading.Barrier(3, timeout=5)
+        self.b.backup = Mock(side_effect=lambda *args: barrier.wait())
+        self.b.workers = 3
+
+        self.b.hosts = [Host("foo.test"), Host("bar.test"), Host("baz.test")]
+        rc = self.b.run()
+
+        # All backups ran concurrently, otherwise the barrier is broken
+        self.assertEqual(rc, 0)
+        self.assertEqual(self.b.backup.call_count, 3)
+
+    @patch.object(module, "run_command")
     def test_run_timeout(self, m_run):
         host = "example.test"
         m_run.side_effect = TimeoutExpired("cmd", 300, "output text", "error text")
@@ -109,7 +160,7 @@ class TestBackuper(unittest.TestCase):
         m_run.assert_called_once()
         self.log.error.assert_called()
 
-    @patch.object(module.subprocess, "run")
+    @patch.object(module, "run_command")
     def test_run_failure(self, m_run):
         host = "example.test"
         m_run.side_effect = CalledProcessError(1, "cmd", "output text", "error text")
@@ -121,7 +172,7 @@ class TestBackuper(unittest.TestCase):
         self.assertIn(host, " ".join(m_run.call_args[0][0]))
         self.log.error.assert_called()
 
-    @patch.object(module.subprocess, "run")
+    @patch.object(module, "run_command")
     def test_run_fastfailure(self, m_run):
         host = "example.test"
         m_run.side_effect = (
@@ -139,7 +190,7 @@ class TestBackuper(unittest.TestCase):
         self.assertIn(host, " ".join(m_run.call_args[0][0]))
         self.log.error.assert_called()
 
-    @patch.object(module.subprocess, "run")
+    @patch.object(module, "run_command")
     def test_run_slowfailure(self, m_run):
         host = "example.test"
         m_run.side_effect = (
@@ -156,7 +207,376 @@ class TestBackuper(unittest.TestCase):
         self.assertIn(host, " ".join(m_run.call_args[0][0]))
         self.log.error.assert_called()
 
-    @patch.object(module.subprocess, "run")
+    @patch.object(module, "run_command")
+    def test_run_phases(self, m_run):
+        def run_command(cmd, timeout, on_line, on_start=None):
+            time.sleep(0.01)
+            on_line("stderr", "remote output")
+            on_line("stdout", "more output")
+            time.sleep(0.01)
+            return CompletedProcess("cmd", 0, "output text")
+
+        m_run.side_effect = run_command
+
+        self.b.hosts = [Host("foo.test"), Host("bar.test")]
+        self.b.run()
+
+        for result in self.b.results:
+            phases = result["phases"]
+            self.assertEqual(
+                list(phases), ["queue", "lock", "connect", "transfer", "teardown"]
+            )
+            self.assertLess(0.005, phases["connect"])
+            self.assertLess(0.005, phases["transfer"])
+            work = sum(phases.values()) - phases["queue"]
+            self.assertLessEqual(work, result["duration"])
+        # The second host waited for the first one
+        self.assertLess(0.02, self.b.results[1]["phases"]["queue"])
+        summary = self.b.summary["PHASES"]
+        self.assertEqual(set(summary["connect"]), {"min", "median", "p95"})
+
+    @patch.object(module, "run_command")
+    def test_run_stats(self, m_run):
+        def run_command(cmd, timeout, on_line, on_start=None):
+            if cmd[-1] == "foo.test":
+                on_line("stdout", "This archive: 1.00 GB 1.00 GB 1.00 GB\n")
+                on_line("stderr", "Creating archive\n")
+                on_line("stderr", "This archive:  20.00 GB  10.00 GB  100.00 MB\n")
+                on_line("stderr", "Duration: 10.00 seconds\n")
+            return CompletedProcess("cmd", 0, "output text")
+
+        m_run.side_effect = run_command
+        self.b.history = history = Mock(**{"results.return_value": []})
+
+        self.b.hosts = [Host("foo.test"), Host("bar.test")]
+        self.b.run()
+
+        foo, bar = self.b.results
+        # Only stderr is parsed
+        self.assertEqual(foo["stats"]["original_size"], 20 * 10 ** 9)
+        self.assertEqual(foo["stats"]["throughput"], 2000.0)
+        self.assertEqual(bar["stats"], {})
+        self.assertEqual(self.b.summary["BYTES"], 20 * 10 ** 9)
+        self.assertEqual(self.b.summary["THROUGHPUT"]["median"], 2000.0)
+        _, kwargs = history.record.call_args_list[0]
+        self.assertEqual(kwargs["deduplicated_size"], 100 * 10 ** 6)
+        self.assertEqual(history.record.call_args_list[1][1], {})
+
+    @patch.object(module, "run_command")
+    def test_run_regressions(self, m_run):
+        m_run.return_value = CompletedProcess("cmd", 0, "output text")
+        # Much faster than any backup
+        previous = [{"duration": 1e-6 * i} for i in range(1, 6)]
+        self.b.history = history = Mock(**{"results.return_value": previous})
+        self.b.baseline = 5
+
+        self.b.hosts = [Host("foo.test")]
+        self.b.run()
+
+        history.results.assert_called_once_with("foo.test", last=5, status="SUCCEEDED")
+        (regression,) = self.b.summary["REGRESSIONS"]
+        self.assertEqual(regression["hostname"], "foo.test")
+        self.assertEqual(regression["metric"], "duration")
+        self.assertEqual(self.b.summary["REGRESSED"], 1)
+        messages = [c[0][0] for c in self.log_progress.info.call_args_list]
+        self.assertIn("Regressions", "".join(messages))
+
+    @patch.object(module, "run_command")
+    def test_run_regressions_history_error(self, m_run):
+        m_run.return_value = CompletedProcess("cmd", 0, "output text")
+        self.b.history = Mock()
+        self.b.history.results.side_effect = module.sqlite3.OperationalError
+
+        self.b.hosts = [Host("foo.test")]
+        rc = self.b.run()
+
+        self.assertEqual(rc, 0)
+        self.assertEqual(self.b.summary["REGRESSIONS"], [])
+        self.log.warning.assert_called()
+
+    @patch.object(module, "run_command")
+    def test_run_masters(self, m_run):
+        m_run.side_effect = (
+            CompletedProcess("cmd", 0, "output text"),
+            CalledProcessError(1, "cmd", "output text", "error text"),
+        )
+        self.b.masters = masters = Mock(
+            **{"options.return_value": ["-o", "ControlPath=/path/to/socket"]}
+        )
+
+        self.b.hosts = [Host("foo.test"), Host("bar.test")]
+        self.b.run()
+
+        cmd = m_run.call_args_list[0][0][0]
+        self.assertIn("ControlPath=/path/to/socket", cmd)
+        self.assertEqual(cmd[-1], "foo.test")
+        # The backup only reuses the master opened by a probe
+        self.assertEqual(masters.options.call_args[1], {"open": False})
+        # Released even if the backup failed
+        released = [c[0][0].hostname for c in masters.release.call_args_list]
+        self.assertEqual(released, ["foo.test", "bar.test"])
+
+    @patch.object(module, "run_command")
+    def test_run_cgroups(self, m_run):
+        def run_command(cmd, timeout, on_line, on_start=None):
+            on_start(Mock(pid=1234))
+            return CompletedProcess("cmd", 0, "output text")
+
+        m_run.side_effect = run_command
+        self.b.cgroups = cgroups = Mock(
+            **{
+                "create.side_effect": lambda host: Path("/cg") / host.hostname,
+                "usage.return_value": {"cpu_seconds": 1.5, "read_bytes": 10},
+            }
+        )
+        self.b.masters = masters = Mock(
+            **{"options.return_value": [], "pid.return_value": 42}
+        )
+
+        jail = LocalTransport(["jexec", "{hostname}", "/usr/local/sbin/backup"])
+        self.b.hosts = [Host("foo.test"), Host("bar.test", transport=jail)]
+        self.b.run()
+
+        # The session and its master are moved to the group of the host
+        self.assertEqual(
+            cgroups.attach.call_args_list[:2],
+            [((Path("/cg/foo.test"), 42),), ((Path("/cg/foo.test"), 1234),)],
+        )
+        masters.pid.assert_called()
+        removed = [c[0][0] for c in cgroups.remove.call_args_list]
+        self.assertEqual(removed, [Path("/cg/foo.test"), Path("/cg/bar.test")])
+        # Only local transports run borg in the group, and account for its I/O
+        self.assertEqual(
+            cgroups.usage.call_args_list,
+            [
+                ((Path("/cg/foo.test"),), {"io": False}),
+                ((Path("/cg/bar.test"),), {"io": True}),
+            ],
+        )
+        self.assertEqual(self.b.results[0]["resources"]["cpu_seconds"], 1.5)
+        self.assertEqual(
+            self.b.summary["RESOURCES"], {"cpu_seconds": 3.0, "read_bytes": 20}
+        )
+
+    @patch.object(module, "run_command")
+    def test_run_cgroups_unavailable(self, m_run):
+        m_run.return_value = CompletedProcess("cmd", 0, "output text")
+        self.b.cgroups = cgroups = Mock(**{"create.return_value": None})
+
+        self.b.hosts = [Host("foo.test")]
+        rc = self.b.run()
+
+        # Backuped without isolation
+        self.assertEqual(rc, 0)
+        cgroups.attach.assert_not_called()
+        cgroups.remove.assert_not_called()
+        self.assertEqual(self.b.summary["RESOURCES"], {})
+
+    @patch.object(module, "run_command")
+    def test_run_launch(self, m_run):
+        def run_command(cmd, timeout, on_line, on_start=None):
+            if cmd[-1] == "foo.test":
+                for _ in range(2):
+                    on_line("stderr", "kex_exchange_identification: Connection reset")
+                    on_line("stderr", "Connection closed by 127.0.0.1 port 64064")
+                raise CalledProcessError(2, cmd, "", "")
+            return CompletedProcess("cmd", 0, "output text")
+
+        m_run.side_effect = run_command
+        self.b.launch = launch = Mock()
+
+        self.b.hosts = [Host("foo.test"), Host("bar.test")]
+        self.b.run()
+
+        self.assertEqual(launch.acquire.call_count, 2)
+        # Once per backup whose tunnel was refused
+        launch.throttle.assert_called_once_with()
+        launch.recover.assert_called_once_with()
+
+    @patch.object(module, "run_command")
+    def test_run_launch_host_down(self, m_run):
+        def run_command(cmd, timeout, on_line, on_start=None):
+            line = "ssh: connect to host foo.test port 22: Connection refused"
+            on_line("stderr", line)
+            raise CalledProcessError(255, cmd, "", "")
+
+        m_run.side_effect = run_command
+        self.b.launch = launch = Mock()
+
+        self.b.hosts = [Host("foo.test")]
+        self.b.run()
+
+        # Other hosts are not slowed down
+        launch.throttle.assert_not_called()
+
+    @patch.object(module, "run_command")
+    def test_run_breaker(self, m_run):
+        m_run.return_value = CompletedProcess("cmd", 0, "output text")
+        streak = {"failures": 8, "since": "2020-01-01", "skipped": 2}
+        self.b.history = history = Mock(**{"results.return_value": []})
+        self.b.breaker = breaker = Mock(
+            **{
+                "allow.side_effect": lambda host, masters: host.hostname != "foo.test",
+                "streak.return_value": streak,
+            }
+        )
+
+        self.b.hosts = [Host("foo.test"), Host("bar.test")]
+        rc = self.b.run()
+
+        breaker.load.assert_called_once_with(history)
+        # Open hosts are not backuped, nor failed
+        self.assertEqual(rc, 0)
+        self.assertEqual(m_run.call_count, 1)
+        self.assertEqual(self.b.summary["OPEN"], 1)
+        self.assertEqual(self.b.summary["SKIPPED"], 0)
+        self.assertEqual(
+            self.b.summary["CIRCUITS"], [dict(streak, hostname="foo.test")]
+        )
+        # Recorded so that skipped runs are counted
+        statuses = {c[0][1]: c[0][2] for c in history.record.call_args_list}
+        self.assertEqual(statuses, {"foo.test": "OPEN", "bar.test": "SUCCEEDED"})
+
+    @patch.object(module, "run_command")
+    def test_run_local(self, m_run):
+        m_run.side_effect = (
+            CompletedProcess("cmd", 0, "output text"),
+            TimeoutExpired("cmd", 60, "output text", "error text"),
+        )
+        jail = LocalTransport(["jexec", "{hostname}", "/usr/local/sbin/backup"])
+        self.b.masters = masters = Mock()
+
+        self.b.hosts = [Host("jail1", transport=jail), Host("jail2", transport=jail)]
+        rc = self.b.run()
+
+        self.assertEqual(m_run.call_args_list[0][0][0][:2], ["jexec", "jail1"])
+        # Same timeout and error handling as ssh
+        self.assertEqual(m_run.call_args[1]["timeout"], self.b.timeout)
+        self.assertEqual(rc, 1)
+        self.assertEqual(self.b.summary["FAILED"], 1)
+        self.log.error.assert_called()
+        masters.options.assert_not_called()
+
+    def test_run_local_missing(self):
+        missing = LocalTransport(["/nonexistent/qb.backup-test", "{hostname}"])
+        echo = LocalTransport(["echo", "{hostname}"])
+
+        self.b.hosts = [Host("jail1", transport=missing), Host("jail2", transport=echo)]
+        rc = self.b.run()
+
+        # The other hosts are backuped anyway
+        self.assertEqual(rc, 1)
+        self.assertEqual(self.b.summary["FAILED"], 1)
+        self.assertEqual(self.b.summary["SUCCEEDED"], 1)
+        self.log.error.assert_called()
+
+    @patch.object(module, "run_command")
+    def test_run_local_launch(self, m_run):
+        def run_command(cmd, timeout, on_line, on_start=None):
+            on_line("stderr", "Connection closed by 127.0.0.1 port 64064")
+            return CompletedProcess("cmd", 0, "output text")
+
+        m_run.side_effect = run_command
+        jail = LocalTransport(["jexec", "{hostname}", "/usr/local/sbin/backup"])
+        self.b.launch = launch = Mock()
+
+        self.b.hosts = [Host("jail1", transport=jail)]
+        self.b.run()
+
+        # No tunnel to the local sshd
+        launch.acquire.assert_not_called()
+        launch.throttle.assert_not_called()
+        launch.recover.assert_not_called()
+
+    def test_run_slots(self):
+        threads = []
+        self.b.backup = Mock(
+            side_effect=lambda *args: threads.append(threading.current_thread().name)
+        )
+        self.b.name = "conf1"
+        self.b.slots = slots = Mock()
+
+        self.b.hosts = [Host("foo.test"), Host("bar.test")]
+        self.b.run()
+
+        self.assertEqual(slots.acquire.call_args_list, [(("conf1",),)] * 2)
+        self.assertEqual(slots.release.call_count, 2)
+        # Workers are named after the run
+        self.assertTrue(all(t.startswith("conf1_") for t in threads))
+
+    def test_run_trace(self):
+        self.b.backup = Mock(side_effect=lambda *args: time.sleep(0.02))
+        self.b.workers = 2
+        self.b.trace = trace = Mock()
+
+        self.b.hosts = [Host("foo.test"), Host("bar.test"), Host("baz.test")]
+        self.b.run()
+
+        hosts = {c[0][1]: c[0][0] for c in trace.host.call_args_list}
+        self.assertEqual(set(hosts), {"foo.test", "bar.test", "baz.test"})
+        # Concurrent hosts are on different slots, slots are reused
+        self.assertNotEqual(hosts["foo.test"], hosts["bar.test"])
+        self.assertIn(hosts["baz.test"], (0, 1))
+        in_flight = [c[0][0] for c in trace.counters.call_args_list]
+        self.assertEqual(max(in_flight), 2)
+        self.assertEqual(in_flight[-1], 0)
+
+    @patch.object(module, "run_command")
+    def test_run_phases_failure(self, m_run):
+        m_run.side_effect = CalledProcessError(1, "cmd", "output text", "error text")
+
+        self.b.hosts = [Host("foo.test")]
+        self.b.run()
+
+        # No output read, the connection phase lasted until the failure
+        phases = self.b.results[0]["phases"]
+        self.assertEqual(list(phases), ["queue", "lock", "connect", "teardown"])
+
+    @patch.object(module, "run_command")
+    def test_run_iterator(self, m_run):
+        m_run.return_value = CompletedProcess("cmd", 0, "output text")
+
+        self.b.hosts = iter([Host("foo.test"), Host("bar.test")])
+        rc = self.b.run()
+
+        self.assertEqual(rc, 0)
+        self.assertEqual(self.b.summary["TOTAL"], 2)
+        self.assertEqual(self.b.summary["SUCCEEDED"], 2)
+        hostnames = [r["hostname"] for r in self.b.results]
+        self.assertEqual(hostnames, ["foo.test", "bar.test"])
+
+    @patch.object(module, "run_command")
+    def test_run_history(self, m_run):
+        m_run.side_effect = (
+            CompletedProcess("cmd", 0, "output text"),
+            CalledProcessError(1, "cmd", "output text", "error text"),
+        )
+        self.b.history = history = Mock(**{"results.return_value": []})
+
+        self.b.hosts = [Host("foo.test"), Host("bar.test")]
+        self.b.run()
+
+        self.assertEqual(history.record.call_count, 2)
+        (run0, host0, status0, _), _ = history.record.call_args_list[0]
+        (run1, host1, status1, _), _ = history.record.call_args_list[1]
+        self.assertEqual(run0, run1)
+        self.assertEqual((host0, status0), ("foo.test", "SUCCEEDED"))
+        self.assertEqual((host1, status1), ("bar.test", "FAILED"))
+
+    @patch.object(module, "run_command")
+    def test_run_history_error(self, m_run):
+        m_run.return_value = CompletedProcess("cmd", 0, "output text")
+        self.b.history = Mock(**{"results.return_value": []})
+        self.b.history.record.side_effect = module.sqlite3.OperationalError
+
+        self.b.hosts = [Host("foo.test")]
+        rc = self.b.run()
+
+        # A broken history does not fail backups
+        self.assertEqual(rc, 0)
+        self.log.warning.assert_called()
+
+    @patch.object(module, "run_command")
     def test_run_success(self, m_run):
         host = "example.test"
         m_run.return_value = CompletedProcess("cmd", 0, "output text")
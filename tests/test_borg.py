@@ -0,0 +1,103 @@
+import unittest
+from parameterized import parameterized
+
+import qb.backup.borg as module
+
+
+STATS = """\
+------------------------------------------------------------------------------
+Archive name: foo.test-2020-02-01T03:00:00
+Archive fingerprint: 2b2b1cf0bd3d3b3c
+Time (start): Sat, 2020-02-01 03:00:00
+Time (end):   Sat, 2020-02-01 04:01:40
+Duration: 1 hours 1 minutes 40.00 seconds
+Number of files: 123456
+Utilization of max. archive size: 0%
+------------------------------------------------------------------------------
+                       Original size      Compressed size    Deduplicated size
+This archive:               37.00 GB             20.50 GB            120.34 MB
+All archives:                1.20 TB            600.00 GB             80.00 GB
+
+                       Unique chunks         Total chunks
+Chunk index:                  123456              1234567
+------------------------------------------------------------------------------
+"""
+
+
+class TestSize(unittest.TestCase):
+    # fmt: off
+    @parameterized.expand([
+        ("512 B", 512),
+        ("1.50 kB", 1500),
+        ("37.00 GB", 37 * 10 ** 9),
+        (" 2.00 TB ", 2 * 10 ** 12),
+        ("1.00 MiB", 2 ** 20),
+    ])
+    # fmt: on
+    def test_parse_size(self, text, size):
+        self.assertEqual(module.parse_size(text), size)
+
+    # fmt: off
+    @parameterized.expand([
+        ("",), ("12",), ("1.2 XB",), ("GB",), ("10.50 KB",), ("1 kiB",),
+    ])
+    # fmt: on
+    def test_parse_size_error(self, text):
+        with self.assertRaises(ValueError):
+            module.parse_size(text)
+
+    @parameterized.expand([(512, "512.00 B"), (1500, "1.50 kB"), (37e9, "37.00 GB")])
+    def test_format_size(self, size, text):
+        self.assertEqual(module.format_size(size), text)
+
+
+class TestBorgStats(unittest.TestCase):
+    def setUp(self):
+        self.stats = module.BorgStats()
+
+    def feed(self, text):
+        for line in text.splitlines(True):
+            self.stats.feed(line)
+
+    def test_stats(self):
+        self.feed(STATS)
+
+        res = self.stats.metrics()
+
+        self.assertEqual(
+            res,
+            {
+                "original_size": 37 * 10 ** 9,
+                "compressed_size": 20.5 * 10 ** 9,
+                "deduplicated_size": 120340000,
+                "files": 123456,
+                # 37 GB in 3700 s, according to borg
+                "throughput": 10.0,
+            },
+        )
+
+    def test_stats_wall_duration(self):
+        self.feed(STATS.replace("Duration: 1 hours 1 minutes 40.00 seconds\n", ""))
+
+        res = self.stats.metrics(duration=37000)
+
+        self.assertEqual(res["throughput"], 1.0)
+
+    def test_no_stats(self):
+        self.feed("Creating archive\nsome output\n\n")
+
+        self.assertEqual(self.stats.metrics(duration=10), {})
+
+    # fmt: off
+    @parameterized.expand([
+        ("This archive: 37.00 GB 20.50 GB\n",),
+        ("This archive: lots of data\n",),
+        ("This archive: 37.00 GB 20.50 GB 120.34 KB\n",),
+        ("Number of files: many\n",),
+        ("Duration: forever\n",),
+    ])
+    # fmt: on
+    def test_malformed(self, line):
+        self.stats.feed(line)
+
+        self.assertEqual(self.stats.metrics(duration=10), {})
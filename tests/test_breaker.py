@@ -0,0 +1,112 @@
+import unittest
+from unittest.mock import Mock, patch
+from parameterized import parameterized
+
+import sqlite3
+import subprocess
+
+import qb.backup.breaker as module
+from qb.backup.transport import SSH, LocalTransport
+
+
+class Host:
+    def __init__(self, hostname, port="22", transport=SSH):
+        self.hostname = hostname
+        self.port = port
+        self.transport = transport
+
+
+def streak(failures, skipped=0):
+    return {"failures": failures, "since": "2020-01-01", "skipped": skipped}
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def breaker(self, streaks, **kwargs):
+        breaker = module.CircuitBreaker(**kwargs)
+        breaker.load(Mock(**{"streaks.return_value": streaks}))
+        return breaker
+
+    def test_closed(self):
+        breaker = self.breaker({"foo.test": streak(6)}, failures=7)
+
+        self.assertIsNone(breaker.streak(Host("foo.test")))
+        self.assertTrue(breaker.allow(Host("foo.test")))
+        self.assertTrue(breaker.allow(Host("bar.test")))
+
+    # fmt: off
+    @parameterized.expand([
+        (0, False),
+        (1, False),
+        (2, True),
+        (3, False),
+        (5, True),
+    ])
+    # fmt: on
+    def test_retry_every(self, skipped, allowed):
+        breaker = self.breaker({"foo.test": streak(7, skipped)}, retry_every=3)
+
+        self.assertEqual(breaker.streak(Host("foo.test"))["failures"], 7)
+        self.assertEqual(breaker.allow(Host("foo.test")), allowed)
+
+    def test_never_retried(self):
+        breaker = self.breaker({"foo.test": streak(7, 6)}, retry_every=0)
+
+        self.assertFalse(breaker.allow(Host("foo.test")))
+
+    @patch.object(module.subprocess, "run")
+    def test_probe(self, m_run):
+        breaker = self.breaker({"foo.test": streak(7)}, retry_every=0, probe=True)
+
+        self.assertTrue(breaker.allow(Host("foo.test")))
+        cmd = m_run.call_args[0][0]
+        self.assertEqual(cmd[-2:], ["foo.test", "true"])
+        self.assertIn("ConnectTimeout=10", cmd)
+
+        masters = Mock(**{"options.return_value": ["-o", "ControlPath=/s"]})
+        self.assertTrue(breaker.allow(Host("foo.test"), masters))
+        self.assertIn("ControlPath=/s", m_run.call_args[0][0])
+
+        m_run.side_effect = subprocess.CalledProcessError(255, cmd)
+        self.assertFalse(breaker.allow(Host("foo.test")))
+        # Closed hosts are not probed
+        m_run.reset_mock()
+        self.assertTrue(breaker.allow(Host("bar.test")))
+        m_run.assert_not_called()
+
+    @patch.object(module.subprocess, "run")
+    def test_probe_local(self, m_run):
+        breaker = self.breaker({"jail1": streak(7)}, retry_every=0, probe=True)
+        jail = LocalTransport(["jexec", "{hostname}", "backup"])
+
+        self.assertFalse(breaker.allow(Host("jail1", transport=jail)))
+        # Nothing to probe
+        m_run.assert_not_called()
+
+    def test_load_error(self):
+        breaker = module.CircuitBreaker(failures=1)
+        history = Mock(**{"streaks.side_effect": sqlite3.OperationalError})
+
+        with self.assertLogs("qb.backup", "WARNING"):
+            breaker.load(history)
+
+        self.assertTrue(breaker.allow(Host("foo.test")))
+
+    def test_parse(self):
+        breaker = module.CircuitBreaker.parse({"failures": 3, "probe": True})
+
+        self.assertEqual(breaker.failures, 3)
+        self.assertEqual(breaker.retry_every, 7)
+        self.assertTrue(breaker.probe)
+
+    # fmt: off
+    @parameterized.expand([
+        ([3], "mapping"),
+        ({"failure": 3}, "failure"),
+        ({"failures": 0}, "failures"),
+        ({"failures": "7"}, "failures"),
+        ({"retry_every": -1}, "retry_every"),
+    ])
+    # fmt: on
+    def test_parse_error(self, conf, msg):
+        with self.assertRaisesRegex(module.BreakerError, msg):
+            module.CircuitBreaker.parse(conf)
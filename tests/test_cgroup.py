@@ -0,0 +1,163 @@
+import unittest
+from parameterized import parameterized
+
+from pathlib import Path
+import tempfile
+
+import qb.backup.cgroup as module
+
+
+class Host:
+    def __init__(self, hostname, tags=()):
+        self.hostname = hostname
+        self.tags = frozenset(tags)
+
+
+class TestParse(unittest.TestCase):
+    def test_parse(self):
+        cgroups = module.Cgroups.parse(
+            {
+                "root": "/sys/fs/cgroup/backup",
+                "default": {"cpu.weight": 100, "io.weight": 100},
+                "tags": {"db": {"io.weight": 50}, "big": {"memory.max": "4G"}},
+                "hosts": {"foo.test": {"io.weight": 10}},
+            }
+        )
+
+        self.assertEqual(cgroups.root, Path("/sys/fs/cgroup/backup"))
+        self.assertEqual(
+            cgroups.limits(Host("foo.test", ["db"])),
+            {"cpu.weight": "100", "io.weight": "10"},
+        )
+        self.assertEqual(
+            cgroups.limits(Host("bar.test", ["db", "big"])),
+            {"cpu.weight": "100", "io.weight": "50", "memory.max": "4G"},
+        )
+        self.assertEqual(
+            cgroups.limits(Host("baz.test")), {"cpu.weight": "100", "io.weight": "100"}
+        )
+
+    # fmt: off
+    @parameterized.expand([
+        ("/sys/fs/cgroup", "mapping with a root"),
+        ({"default": {}}, "mapping with a root"),
+        ({"root": "/cg", "limits": {}}, "limits"),
+        ({"root": "/cg", "tags": {"db": {"cpu.max": 1}}}, "tag db: cpu.max"),
+        ({"root": "/cg", "hosts": {"foo.test": 100}}, "host foo.test"),
+        ({"root": "/cg", "hosts": ["foo.test"]}, "hosts must be a mapping"),
+    ])
+    # fmt: on
+    def test_parse_error(self, conf, msg):
+        with self.assertRaisesRegex(module.CgroupError, msg):
+            module.Cgroups.parse(conf)
+
+
+class TestCgroups(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        # Stands for a delegated group of the cgroup2 filesystem
+        self.root = Path(tmp.name)
+        (self.root / "cgroup.controllers").write_text("cpuset cpu io pids\n")
+        (self.root / "cgroup.subtree_control").write_text("")
+        self.cgroups = module.Cgroups(
+            self.root, default={"io.weight": 50, "memory.max": "1G"}
+        )
+
+    def test_create(self):
+        with self.assertLogs("qb.backup", "WARNING") as logs:
+            group = self.cgroups.create(Host("foo.test"))
+
+        self.assertEqual(group, self.root / "foo.test")
+        self.assertEqual((group / "io.weight").read_text(), "50")
+        # memory is not available
+        self.assertFalse((group / "memory.max").exists())
+        self.assertIn("memory.max", logs.output[0])
+        self.assertEqual(
+            (self.root / "cgroup.subtree_control").read_text(), "+cpu +io"
+        )
+
+    def test_create_error(self):
+        self.cgroups.root = self.root / "missing"
+
+        with self.assertLogs("qb.backup", "WARNING"):
+            group = self.cgroups.create(Host("foo.test"))
+
+        self.assertIsNone(group)
+
+    def test_attach(self):
+        group = self.root / "foo.test"
+        group.mkdir()
+
+        self.cgroups.attach(group, 1234)
+
+        self.assertEqual((group / "cgroup.procs").read_text(), "1234")
+
+    def test_usage(self):
+        group = self.root / "foo.test"
+        group.mkdir()
+        (group / "cpu.stat").write_text(
+            "usage_usec 2500000\nuser_usec 2000000\nsystem_usec 500000\n"
+        )
+        (group / "io.stat").write_text(
+            "8:0 rbytes=1000 wbytes=2000 rios=1 wios=2 dbytes=0 dios=0\n"
+            "8:16 rbytes=10 wbytes=20 rios=1 wios=2 dbytes=0 dios=0\n"
+        )
+
+        usage = self.cgroups.usage(group)
+
+        self.assertEqual(
+            usage, {"cpu_seconds": 2.5, "read_bytes": 1010, "written_bytes": 2020}
+        )
+
+    def test_usage_missing(self):
+        group = self.root / "foo.test"
+        group.mkdir()
+        (group / "cpu.stat").write_text("usage_usec 1000000\n")
+
+        self.assertEqual(self.cgroups.usage(group), {"cpu_seconds": 1.0})
+
+    def test_usage_cpu_only(self):
+        group = self.root / "foo.test"
+        group.mkdir()
+        (group / "cpu.stat").write_text("usage_usec 1000000\n")
+        (group / "io.stat").write_text("8:0 rbytes=1000 wbytes=2000\n")
+
+        self.assertEqual(self.cgroups.usage(group, io=False), {"cpu_seconds": 1.0})
+
+    def test_remove(self):
+        group = self.root / "foo.test"
+        group.mkdir()
+
+        self.cgroups.remove(group)
+
+        self.assertFalse(group.exists())
+        # Busy groups are left
+        with self.assertLogs("qb.backup", "WARNING"):
+            self.cgroups.remove(group)
+
+
+class TestResources(unittest.TestCase):
+    def test_resources(self):
+        results = [
+            {"resources": {"cpu_seconds": 1.5, "read_bytes": 10, "written_bytes": 5}},
+            {"resources": {"cpu_seconds": 2.0}},
+            {"resources": {}},
+            {},
+        ]
+
+        self.assertEqual(
+            module.resources(results),
+            {"cpu_seconds": 3.5, "read_bytes": 10, "written_bytes": 5},
+        )
+        self.assertEqual(module.resources([{"resources": {}}]), {})
+
+    def test_format_usage(self):
+        self.assertEqual(
+            module.format_usage(
+                {"cpu_seconds": 1.5, "read_bytes": 1500, "written_bytes": 0}
+            ),
+            "cpu 1.5s, 1.50 kB read, 0.00 B written",
+        )
+        # The bytes of tunnels are not accounted for
+        self.assertEqual(module.format_usage({"cpu_seconds": 2.0}), "cpu 2.0s")
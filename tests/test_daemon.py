@@ -0,0 +1,197 @@
+import unittest
+from unittest.mock import Mock, patch
+
+from datetime import datetime, timedelta, timezone
+import threading
+
+from qb.backup import ConfigError
+import qb.backup.daemon as module
+
+
+class Host:
+    def __init__(self, hostname, interval=None):
+        self.hostname = hostname
+        self.schedule = None
+        self.interval = interval
+
+
+def config(*hosts, history=None, logging=None):
+    """ Mockup for a Config. """
+    return Mock(
+        hosts=list(hosts),
+        history=history,
+        workers=2,
+        logging=logging or {"version": 1},
+        **{"stale.return_value": False}
+    )
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.object(module.logging.config, "dictConfig")
+        self.dictConfig = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(module, "Backuper")
+        self.Backuper = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(module, "log")
+        self.log = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.hosts = [
+            Host("foo.test", timedelta(hours=1)),
+            Host("bar.test", timedelta(hours=2)),
+            Host("baz.test"),
+        ]
+        self.daemon = module.Daemon("/path/to/config", config(*self.hosts))
+
+    def test_init(self):
+        self.dictConfig.assert_called_once_with({"version": 1})
+        self.assertEqual(len(self.daemon.schedule), 2)
+        self.log.warning.assert_called_once()
+
+    def test_run_due(self):
+        now = datetime.now()
+
+        run = self.daemon.run_due(now)
+        run.join()
+
+        hosts = self.Backuper.call_args[0][0]
+        self.assertEqual(sorted(h.hostname for h in hosts), ["bar.test", "foo.test"])
+        self.assertEqual(self.Backuper.call_args[1]["name"], "run1")
+        self.assertIs(self.Backuper.call_args[1]["slots"], self.daemon.slots)
+        self.assertIsNone(self.daemon.run_due(now))
+        self.assertEqual(self.daemon.schedule.next_due(), now + timedelta(hours=1))
+
+    def test_backup_on_done(self):
+        now = datetime.now()
+        hosts = self.daemon.schedule.due(now)
+        rescheduled = []
+
+        def run():
+            on_done = self.Backuper.call_args[1]["on_done"]
+            on_done(self.hosts[0])
+            rescheduled.append(set(self.daemon.schedule.next))
+            return 0
+
+        self.Backuper.return_value.run.side_effect = run
+
+        rc = self.daemon.backup(hosts, now)
+
+        self.assertEqual(rc, 0)
+        # Each host is rescheduled once its own backup is over
+        self.assertEqual(rescheduled, [{"foo.test"}])
+        self.assertEqual(set(self.daemon.schedule.next), {"foo.test", "bar.test"})
+
+    def test_backup_failure(self):
+        self.Backuper.return_value.run.side_effect = OSError
+        now = datetime.now()
+        hosts = self.daemon.schedule.due(now)
+
+        with self.assertRaises(OSError):
+            self.daemon.backup(hosts, now)
+
+        # Hosts are rescheduled anyway
+        self.assertEqual(self.daemon.schedule.next_due(), now + timedelta(hours=1))
+
+    def test_run_due_failure(self):
+        self.Backuper.return_value.run.side_effect = OSError
+
+        self.daemon.run_due(datetime.now()).join()
+
+        self.log.exception.assert_called_once()
+
+    @patch.object(module.Config, "load")
+    def test_run_due_running(self, m_load):
+        started, over = threading.Event(), threading.Event()
+
+        def run():
+            started.set()
+            over.wait(5)
+            return 0
+
+        self.Backuper.return_value.run.side_effect = run
+        now = datetime.now()
+        first = self.daemon.run_due(now)
+        started.wait(5)
+
+        # Reloaded and run while the first hosts are being backuped
+        new = Host("new.test", timedelta(hours=1))
+        m_load.return_value = config(*self.hosts, new)
+        self.daemon.reload()
+        second = self.daemon.run_due(datetime.now())
+        over.set()
+        first.join()
+        second.join()
+
+        hosts = [c[0][0] for c in self.Backuper.call_args_list]
+        self.assertEqual([h.hostname for h in hosts[1]], ["new.test"])
+        self.assertEqual(len(self.daemon.schedule.next), 3)
+
+    @patch.object(module.Config, "load")
+    def test_reload(self, m_load):
+        m_load.return_value = config(self.hosts[0], logging={"version": 1})
+        self.daemon.reload_requested = True
+
+        self.daemon.reload()
+
+        m_load.assert_called_once_with(
+            "/path/to/config", cache=self.daemon.cache, compiled=None, strict=False
+        )
+        self.assertEqual(len(self.daemon.schedule), 1)
+        self.assertFalse(self.daemon.reload_requested)
+        # Logging did not change, it is not configured again
+        self.dictConfig.assert_called_once()
+
+    @patch.object(module.Config, "load")
+    def test_reload_logging(self, m_load):
+        m_load.return_value = config(*self.hosts, logging={"version": 1, "foo": 0})
+
+        self.daemon.reload()
+
+        self.assertEqual(self.dictConfig.call_count, 2)
+
+    @patch.object(module.Config, "load")
+    def test_reload_error(self, m_load):
+        m_load.side_effect = ConfigError("bad")
+        config = self.daemon.config
+
+        self.daemon.reload()
+
+        self.assertIs(self.daemon.config, config)
+        self.log.error.assert_called_once()
+
+    @patch.object(module, "History")
+    def test_last_runs(self, m_History):
+        history = m_History.return_value.__enter__.return_value
+        history.last_runs.return_value = {"foo.test": "2020-02-01T03:00:00+00:00"}
+
+        res = module.Daemon.last_runs(config(history="/path/to/db"))
+
+        self.assertEqual(
+            res["foo.test"],
+            datetime(2020, 2, 1, 3, 0, tzinfo=timezone.utc)
+            .astimezone()
+            .replace(tzinfo=None),
+        )
+
+    @patch.object(module, "signal")
+    def test_run_forever(self, m_signal):
+        self.daemon.poll = 1
+        self.daemon.config.stale.return_value = True
+
+        def run(*args):
+            self.daemon._on_stop(None, None)
+            return 0
+
+        self.Backuper.return_value.run.side_effect = run
+        with patch.object(self.daemon, "reload") as m_reload:
+            with patch.object(module.time, "monotonic", side_effect=[0, 10, 10]):
+                rc = self.daemon.run_forever()
+
+        self.assertEqual(rc, 0)
+        self.Backuper.return_value.run.assert_called_once()
+        # The run is over before the daemon stops
+        self.assertEqual([run.is_alive() for run in self.daemon.runs], [False])
+        m_reload.assert_called_once_with()
+        self.assertEqual(m_signal.signal.call_count, 3)
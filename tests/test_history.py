@@ -0,0 +1,144 @@
+import unittest
+
+import sqlite3
+import tempfile
+from pathlib import Path
+
+import qb.backup.history as module
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.history = module.History(":memory:")
+
+    def tearDown(self):
+        self.history.close()
+
+    def test_record(self):
+        self.history.record("2020-01-01", "foo.test", "SUCCEEDED", 12.5)
+        self.history.record("2020-01-02", "foo.test", "FAILED", 3.0)
+        self.history.record("2020-01-02", "bar.test", "SUCCEEDED", 1.0)
+
+        res = self.history.results("foo.test")
+
+        self.assertEqual([r["run"] for r in res], ["2020-01-02", "2020-01-01"])
+        self.assertEqual(res[0]["status"], "FAILED")
+        self.assertEqual(res[1]["duration"], 12.5)
+
+    def test_record_stats(self):
+        self.history.record(
+            "2020-01-01",
+            "foo.test",
+            "SUCCEEDED",
+            3700.0,
+            original_size=37 * 10 ** 9,
+            deduplicated_size=120340000,
+            throughput=10.0,
+        )
+
+        (res,) = self.history.results("foo.test")
+
+        self.assertEqual(res["original_size"], 37 * 10 ** 9)
+        self.assertEqual(res["throughput"], 10.0)
+        self.assertIsNone(res["files"])
+
+    def test_results_filter(self):
+        for day in range(1, 6):
+            self.history.record(f"2020-01-0{day}", "foo.test", "SUCCEEDED", day)
+        self.history.record("2020-01-06", "foo.test", "FAILED", 0)
+
+        res = self.history.results("foo.test", last=2, status="SUCCEEDED")
+
+        self.assertEqual([r["duration"] for r in res], [5, 4])
+
+    def test_last_runs(self):
+        self.history.record("2020-01-01", "foo.test", "SUCCEEDED", 1.0)
+        self.history.record("2020-01-03", "foo.test", "FAILED", 1.0)
+        self.history.record("2020-01-02", "bar.test", "SUCCEEDED", 1.0)
+
+        res = self.history.last_runs()
+
+        self.assertEqual(res, {"foo.test": "2020-01-03", "bar.test": "2020-01-02"})
+
+    def test_streaks(self):
+        rows = [
+            ("2020-01-01", "foo.test", "SUCCEEDED"),
+            ("2020-01-02", "foo.test", "FAILED"),
+            ("2020-01-03", "foo.test", "FAILED"),
+            ("2020-01-04", "foo.test", "OPEN"),
+            ("2020-01-05", "foo.test", "FAILED"),
+            ("2020-01-06", "foo.test", "OPEN"),
+            ("2020-01-07", "foo.test", "OPEN"),
+            ("2020-01-01", "bar.test", "FAILED"),
+            ("2020-01-02", "bar.test", "SUCCEEDED"),
+            ("2020-01-01", "baz.test", "FAILED"),
+        ]
+        for run, hostname, status in rows:
+            self.history.record(run, hostname, status)
+
+        res = self.history.streaks()
+
+        # Skipped runs do not break the streak, only count since the last backup
+        self.assertEqual(
+            res,
+            {
+                "foo.test": {"failures": 3, "since": "2020-01-02", "skipped": 2},
+                "baz.test": {"failures": 1, "since": "2020-01-01", "skipped": 0},
+            },
+        )
+
+    def test_durations(self):
+        for day, duration in enumerate((100, 1, 2, 3, 1000, 4), 1):
+            self.history.record(f"2020-01-0{day}", "foo.test", "SUCCEEDED", duration)
+        self.history.record("2020-01-07", "foo.test", "FAILED", 10000)
+        self.history.record("2020-01-01", "bar.test", "FAILED", 10000)
+
+        res = self.history.durations(last=5)
+
+        # The first run is too old, the failed one ignored
+        self.assertEqual(res, {"foo.test": 3})
+
+    def test_migration(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "history.db"
+            db = sqlite3.connect(str(path))
+            db.execute("CREATE TABLE results (run TEXT, hostname TEXT, status TEXT)")
+            db.execute("INSERT INTO results VALUES ('2020-01-01', 'foo.test', 'OK')")
+            db.commit()
+            db.close()
+
+            with module.History(path) as history:
+                history.record("2020-01-02", "foo.test", "SUCCEEDED", 2.0)
+                res = history.results("foo.test")
+
+        self.assertEqual([r["duration"] for r in res], [2.0, None])
+
+    def test_migration_streaks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "history.db"
+            db = sqlite3.connect(str(path))
+            db.execute("CREATE TABLE results (run TEXT, hostname TEXT, status TEXT)")
+            db.executemany(
+                "INSERT INTO results VALUES (?, ?, ?)",
+                [
+                    ("2020-01-02", "foo.test", "OPEN"),
+                    ("2020-01-01", "foo.test", "FAILED"),
+                    ("2020-01-01", "bar.test", "SUCCEEDED"),
+                ],
+            )
+            db.commit()
+            db.close()
+
+            # Replayed once when opened
+            with module.History(path) as history:
+                res = history.streaks()
+            with module.History(path) as history:
+                history.record("2020-01-03", "foo.test", "FAILED")
+                again = history.streaks()
+
+        self.assertEqual(
+            res, {"foo.test": {"failures": 1, "since": "2020-01-01", "skipped": 1}}
+        )
+        self.assertEqual(
+            again, {"foo.test": {"failures": 2, "since": "2020-01-01", "skipped": 0}}
+        )
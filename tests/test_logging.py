@@ -123,3 +123,59 @@ class TestBufferingSMTPHandler(unittest.TestCase):
         log.log(module.META, "", {"TOTAL": 63})
         subject = self.h.getSubject()
         self.assertIn("63", subject)
+
+
+class TestThreadFilter(unittest.TestCase):
+    # fmt: off
+    @parameterized.expand([
+        ("conf1", True),
+        ("conf1_3", True),
+        ("conf2_0", False),
+        ("MainThread", True),
+        ("ThreadPoolExecutor-0_0", True),
+    ])
+    # fmt: on
+    def test_filter(self, thread, expected):
+        record = logging.LogRecord("qb.backup", logging.INFO, "", 0, "", (), None)
+        record.threadName = thread
+
+        res = module.ThreadFilter("conf1", ["conf1", "conf2"]).filter(record)
+
+        self.assertEqual(res, expected)
+
+
+class TestCombine(unittest.TestCase):
+    def conf(self, filename):
+        return {
+            "version": 1,
+            "formatters": {"default": {"format": "%(message)s"}},
+            "handlers": {
+                "console": {"class": "logging.StreamHandler", "formatter": "default"},
+                "logs": {
+                    "class": "logging.FileHandler",
+                    "formatter": "default",
+                    "filename": filename,
+                },
+            },
+            "loggers": {
+                "qb.backup": {"level": "DEBUG", "handlers": ["console", "logs"]}
+            },
+        }
+
+    def test_combine(self):
+        confs = [self.conf("a.log"), self.conf("b.log")]
+
+        res = module.combine(confs, ["conf1", "conf2"])
+
+        self.assertEqual(
+            res["loggers"]["qb.backup"]["handlers"],
+            ["console", "conf1.logs", "conf2.logs"],
+        )
+        self.assertEqual(res["handlers"]["conf2.logs"]["filename"], "b.log")
+        self.assertEqual(res["handlers"]["conf2.logs"]["filters"], ["conf2"])
+        self.assertEqual(res["handlers"]["conf2.logs"]["formatter"], "conf2.default")
+        # The console is shared, not filtered
+        self.assertNotIn("filters", res["handlers"]["console"])
+        self.assertEqual(res["filters"]["conf1"]["tag"], "conf1")
+        # The configurations are not altered
+        self.assertEqual(confs[0], self.conf("a.log"))
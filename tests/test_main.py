@@ -2,10 +2,14 @@ import unittest
 from unittest.mock import Mock, mock_open, patch, sentinel
 from parameterized import parameterized
 
+from datetime import timedelta
+from io import StringIO
 from pathlib import Path
 import sys
 
 from qb.backup import ConfigError
+from qb.backup.sharding import shard_of
+from qb.backup.workqueue import WorkQueue
 
 import main as module
 
@@ -46,7 +50,29 @@ else:
 
 Args = namedtuple(
     "Args",
-    "conf only exclude failfast",
+    "conf only exclude failfast shard queue queue_run workers config_cache "
+    "strict_includes trace plan window ssh_masters total_workers launch_rate "
+    "profile profile_every",
+    # fmt: off
+    defaults=[
+        ["/path/to/config"], None, None, False, None, None, None, None, None,
+        False, None, False, timedelta(hours=24), None, None, None, None, 100,
+    ],
+    # fmt: on
+)
+ShardsArgs = namedtuple(
+    "ShardsArgs",
+    "conf count list config_cache strict_includes",
+    defaults=["/path/to/config", None, False, None, False],
+)
+DaemonArgs = namedtuple(
+    "DaemonArgs",
+    "conf only exclude shard poll config_cache strict_includes",
+    defaults=["/path/to/config", None, None, None, 60, None, False],
+)
+MergeArgs = namedtuple(
+    "MergeArgs",
+    "conf queue queue_run json",
     defaults=["/path/to/config", None, None, False],
 )
 WhateverException = type("WhateverException", (Exception,), {})
@@ -55,7 +81,11 @@ WhateverException = type("WhateverException", (Exception,), {})
 class TestRun(unittest.TestCase):
 
     CONF_DATA = """{
-        "hosts": ["foo.test", {"hostname": "bar.test", "port": 23}],
+        "hosts": [
+            "foo.test",
+            {"hostname": "bar.test", "port": 23, "tags": ["web"]},
+            {"hostname": "baz.test", "tags": ["web", "prod"]}
+        ],
         "default": {"lock": "/var/lock/backup/{}.lock"}
     }"""
 
@@ -106,7 +136,11 @@ class TestRun(unittest.TestCase):
         self.assertEqual(res, sentinel.rc)
         self.log.exception.assert_not_called()
 
+        # All hosts selected, they are built while the Backuper iterates
         hosts = m_Backuper.call_args[0][0]  # args[0]
+        self.assertIsInstance(hosts, module.Config.Inventory)
+        self.assertEqual(len(hosts), 3)
+        hosts = list(hosts)
         self.assertEqual(hosts[0].hostname, "foo.test")
         self.assertEqual(hosts[0].port, "22")
         self.assertEqual(hosts[1].hostname, "bar.test")
@@ -126,6 +160,20 @@ class TestRun(unittest.TestCase):
         self.assertEqual(hosts[0].hostname, "bar.test")
         self.assertEqual(hosts[0].port, "23")
 
+    @patch("builtins.open", mock_open(read_data=CONF_DATA))
+    @patch.object(module, "Backuper")
+    def test_proc_only_selector(self, m_Backuper):
+        # XXX: required for tests to pass in python <3.8
+        open.return_value.name = "whatever"
+        args = Args(only=["tag:web", "f*.test"])
+
+        module.run(args)
+
+        hosts = m_Backuper.call_args[0][0]  # args[0]
+        self.assertEqual(
+            [h.hostname for h in hosts], ["foo.test", "bar.test", "baz.test"]
+        )
+
     @patch("builtins.open", mock_open(read_data=CONF_DATA))
     @patch.object(module, "Backuper")
     def test_proc_only_error(self, m_Backuper):
@@ -149,9 +197,22 @@ class TestRun(unittest.TestCase):
         module.run(args)
 
         hosts = m_Backuper.call_args[0][0]  # args[0]
-        self.assertEqual(len(hosts), 1)
+        self.assertEqual(len(hosts), 2)
         self.assertEqual(hosts[0].hostname, "bar.test")
         self.assertEqual(hosts[0].port, "23")
+        self.assertEqual(hosts[1].hostname, "baz.test")
+
+    @patch("builtins.open", mock_open(read_data=CONF_DATA))
+    @patch.object(module, "Backuper")
+    def test_proc_exclude_selector(self, m_Backuper):
+        # XXX: required for tests to pass in python <3.8
+        open.return_value.name = "whatever"
+        args = Args(exclude=["tag:web&!tag:prod"])
+
+        module.run(args)
+
+        hosts = m_Backuper.call_args[0][0]  # args[0]
+        self.assertEqual([h.hostname for h in hosts], ["foo.test", "baz.test"])
 
     @patch("builtins.open", mock_open(read_data=CONF_DATA))
     @patch.object(module, "Backuper")
@@ -167,6 +228,435 @@ class TestRun(unittest.TestCase):
         self.log.error.assert_called_once()
 
 
+    @patch("builtins.open", mock_open(read_data=CONF_DATA))
+    @patch.object(module, "Backuper")
+    def test_proc_shard(self, m_Backuper):
+        # XXX: required for tests to pass in python <3.8
+        open.return_value.name = "whatever"
+        shards = [module.Shard(k, 2) for k in (1, 2)]
+
+        hostnames = []
+        for shard in shards:
+            module.run(Args(shard=shard))
+            hosts = m_Backuper.call_args[0][0]  # args[0]
+            hostnames.append({h.hostname for h in hosts})
+
+        self.assertEqual(
+            hostnames[0] | hostnames[1], {"foo.test", "bar.test", "baz.test"}
+        )
+        self.assertFalse(hostnames[0] & hostnames[1])
+
+    @patch.object(module, "Backuper")
+    def test_proc_workers(self, m_Backuper):
+        data = self.CONF_DATA.replace("{", '{"workers": 4, "lock_timeout": 60,', 1)
+
+        for args, workers in ((Args(), 4), (Args(workers=2), 2)):
+            with patch("builtins.open", mock_open(read_data=data)):
+                # XXX: required for tests to pass in python <3.8
+                open.return_value.name = "whatever"
+                module.run(args)
+
+            self.assertEqual(m_Backuper.call_args[1]["workers"], workers)
+            self.assertEqual(m_Backuper.call_args[1]["lock_timeout"], 60)
+
+    @patch.object(module, "Backuper")
+    @patch.object(module, "History")
+    def test_proc_history(self, m_History, m_Backuper):
+        data = self.CONF_DATA.replace("{", '{"history": "/path/to/db",', 1)
+
+        with patch("builtins.open", mock_open(read_data=data)):
+            # XXX: required for tests to pass in python <3.8
+            open.return_value.name = "whatever"
+            module.run(self.args)
+
+        m_History.assert_called_once_with("/path/to/db")
+        self.assertEqual(m_Backuper.call_args[1]["history"], m_History.return_value)
+
+    @patch("builtins.open", mock_open(read_data=CONF_DATA))
+    @patch.object(module, "Backuper")
+    @patch.object(module, "Trace")
+    def test_proc_trace(self, m_Trace, m_Backuper):
+        # XXX: required for tests to pass in python <3.8
+        open.return_value.name = "whatever"
+        m_Backuper.return_value.run.side_effect = WhateverException
+
+        with self.assertRaises(SystemExit):
+            module.run(Args(trace=Path("/path/to/trace.json")))
+
+        # Written even if the run failed
+        self.assertEqual(m_Backuper.call_args[1]["trace"], m_Trace.return_value)
+        m_Trace.return_value.write.assert_called_once_with(Path("/path/to/trace.json"))
+
+    @patch("builtins.open", mock_open(read_data=CONF_DATA))
+    @patch.object(module, "Backuper")
+    @patch.object(module, "ControlMasters")
+    def test_proc_ssh_masters(self, m_ControlMasters, m_Backuper):
+        # XXX: required for tests to pass in python <3.8
+        open.return_value.name = "whatever"
+        m_Backuper.return_value.run.side_effect = WhateverException
+
+        with self.assertRaises(SystemExit):
+            module.run(Args(ssh_masters=8))
+
+        m_ControlMasters.assert_called_once_with(8)
+        masters = m_ControlMasters.return_value
+        self.assertEqual(m_Backuper.call_args[1]["masters"], masters)
+        # Closed even if the run failed
+        masters.close.assert_called_once_with()
+
+    @patch("builtins.open", mock_open(read_data=CONF_DATA))
+    @patch.object(module, "Backuper")
+    @patch.object(module, "Profiler")
+    def test_proc_profile(self, m_Profiler, m_Backuper):
+        # XXX: required for tests to pass in python <3.8
+        open.return_value.name = "whatever"
+        m_Backuper.return_value.run.return_value = 0
+        profiler = m_Profiler.return_value.__enter__.return_value
+
+        rc = module.run(Args(profile=Path("/path/to/profile"), profile_every=10))
+
+        self.assertEqual(rc, 0)
+        m_Profiler.assert_called_once_with(Path("/path/to/profile"), every=10)
+        m_Profiler.return_value.__exit__.assert_called_once()
+        labels = [c[0][0] for c in profiler.snapshot.call_args_list]
+        self.assertEqual(labels, ["config", "logging"])
+        profiler.on_done.assert_called_once_with(None)
+        on_done = m_Backuper.call_args[1]["on_done"]
+        self.assertEqual(on_done, profiler.on_done.return_value)
+
+    def test_launch_ramp(self):
+        config = module.Config({"launch": {"rate": 2, "burst": 5, "jitter": 1}})
+
+        self.assertIs(module.launch_ramp(config, Args()), config.launch)
+        ramp = module.launch_ramp(config, Args(launch_rate=0.5))
+        # Other settings are kept
+        self.assertEqual((ramp.rate, ramp.burst, ramp.jitter), (0.5, 5, 1))
+        self.assertIsNone(module.launch_ramp(module.Config(), Args()))
+        ramp = module.launch_ramp(module.Config(), Args(launch_rate=3))
+        self.assertEqual((ramp.rate, ramp.burst), (3, 1))
+
+    @patch("builtins.open", mock_open(read_data=CONF_DATA))
+    @patch.object(module, "Backuper")
+    @patch.object(module, "WorkQueue")
+    def test_proc_queue(self, m_WorkQueue, m_Backuper):
+        # XXX: required for tests to pass in python <3.8
+        open.return_value.name = "whatever"
+        queue = m_WorkQueue.return_value
+
+        module.run(Args(queue=Path("/path/to/queue"), queue_run="run0"))
+
+        m_WorkQueue.assert_called_once_with(Path("/path/to/queue"), run="run0")
+        self.assertEqual(m_Backuper.call_args[0][0], queue.claim.return_value)
+        self.assertEqual(m_Backuper.call_args[1]["on_done"], queue.release)
+        queue.report.assert_called_once_with(m_Backuper.return_value)
+
+    def configs(self, b=None):
+        """ Patch the loading of configurations a.yml and b.yml. """
+        configs = {
+            "a.yml": module.Config(
+                {"hosts": ["foo.test"], "history": "a.db", "default": {"lock": "{}"}}
+            ),
+            "b.yml": module.Config(
+                dict(b or {}, hosts=["bar.test"], default={"lock": "{}"})
+            ),
+        }
+        patchers = [
+            patch.object(
+                module.Config, "load", side_effect=lambda path, **kwargs: configs[path]
+            ),
+            # Neither log files nor history databases are written
+            patch.object(module.logging.config, "dictConfig"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @patch.object(module, "History")
+    @patch.object(module, "Backuper")
+    def test_proc_confs(self, m_Backuper, m_History):
+        self.configs()
+        m_Backuper.return_value.run.return_value = 0
+        args = Args(conf=["a.yml", "b.yml"], only=["foo.test"])
+
+        rc = module.run(args)
+
+        self.assertEqual(rc, 0)
+        # Selectors only need to match the hosts of one configuration
+        hosts = sorted([h.hostname for h in c[0][0]] for c in m_Backuper.call_args_list)
+        self.assertEqual(hosts, [[], ["foo.test"]])
+        m_History.assert_called_once_with("a.db")
+        m_History.return_value.close.assert_called_once_with()
+
+    @parameterized.expand([(None, 2), (5, 5)])
+    @patch.object(module, "History", Mock())
+    @patch.object(module, "Backuper")
+    def test_proc_confs_launch(self, launch_rate, rate, m_Backuper):
+        self.configs({"launch": {"rate": 2, "burst": 4}})
+        m_Backuper.return_value.run.return_value = 0
+        args = Args(conf=["a.yml", "b.yml"], launch_rate=launch_rate)
+
+        module.run(args)
+
+        # A single ramp, since all the tunnels reach the same sshd
+        ramps = [c[1]["launch"] for c in m_Backuper.call_args_list]
+        self.assertIs(ramps[0], ramps[1])
+        self.assertEqual((ramps[0].rate, ramps[0].burst), (rate, 4))
+
+    @patch.object(module, "Backuper")
+    def test_proc_confs_only_error(self, m_Backuper):
+        self.configs()
+        args = Args(conf=["a.yml", "b.yml"], only=["foo.test", "xxx.test"])
+
+        with self.assertRaises(SystemExit) as ctx:
+            module.run(args)
+
+        self.assertEqual(ctx.exception.args, (1,))
+        self.assertIn("xxx.test", self.log.error.call_args[0][1])
+        m_Backuper.assert_not_called()
+
+
+class TestDaemon(unittest.TestCase):
+    CONF_DATA = TestRun.CONF_DATA
+
+    def setUp(self):
+        log_patcher = patch.object(module, "log")
+        self.log = log_patcher.start()
+        self.addCleanup(log_patcher.stop)
+
+    @patch("builtins.open", mock_open(read_data=CONF_DATA))
+    @patch.object(module, "Daemon")
+    def test_daemon(self, m_Daemon):
+        # XXX: required for tests to pass in python <3.8
+        open.return_value.name = "whatever"
+        m_Daemon.return_value.run_forever.return_value = 0
+
+        rc = module.daemon(DaemonArgs(only=["tag:web"]))
+
+        self.assertEqual(rc, 0)
+        _, config = m_Daemon.call_args[0]
+        select = m_Daemon.call_args[1]["select"]
+        hosts = select(config)
+        self.assertEqual([h.hostname for h in hosts], ["bar.test", "baz.test"])
+
+    @patch("builtins.open", mock_open(read_data=CONF_DATA))
+    @patch.object(module, "Daemon")
+    def test_daemon_selector_error(self, m_Daemon):
+        # XXX: required for tests to pass in python <3.8
+        open.return_value.name = "whatever"
+        m_Daemon.side_effect = module.SelectorError("'xxx.test' not present")
+
+        with self.assertRaises(SystemExit) as ctx:
+            module.daemon(DaemonArgs(only=["xxx.test"]))
+
+        self.assertEqual(ctx.exception.args, (1,))
+        self.log.error.assert_called_once()
+
+
+class TestMerge(unittest.TestCase):
+    def setUp(self):
+        self.queue = Path("/path/to/queue")
+        self._WorkQueue = patch.object(module, "WorkQueue")
+        self.WorkQueue = self._WorkQueue.start()
+        self.WorkQueue.merge = WorkQueue.merge
+        self.addCleanup(self._WorkQueue.stop)
+
+    def reports(self, *statuses):
+        self.WorkQueue.return_value.load_reports.return_value = [
+            {
+                "worker": "w{}".format(i),
+                "summary": {
+                    "SUCCEEDED": int(status == "SUCCEEDED"),
+                    "FAILED": int(status == "FAILED"),
+                    "TOTAL": 1,
+                    "RUNTIME": 60.0,
+                },
+                "results": [
+                    {
+                        "hostname": "h{}.test".format(i),
+                        "status": status,
+                        "phases": {"connect": 0.5 + i},
+                        "stats": {"original_size": 10 ** 9, "throughput": 1.0 + i},
+                    }
+                ],
+            }
+            for i, status in enumerate(statuses)
+        ]
+
+    def merge(self, json=False):
+        args = MergeArgs(queue=self.queue, json=json)
+        with patch("sys.stdout", new_callable=StringIO) as stdout:
+            rc = module.merge(args)
+        return rc, stdout.getvalue()
+
+    def test_merge_success(self):
+        self.reports("SUCCEEDED", "SUCCEEDED")
+
+        rc, out = self.merge()
+
+        self.assertEqual(rc, 0)
+        self.assertIn("w0, w1", out)
+        self.assertIn("SUCCESS   2/2", out)
+        self.assertRegex(out, r"connect +min +0.500s +median +1.000s +p95 +1.500s")
+        self.assertIn("Transfer            : 2.00 GB original  min 1.0 MB/s", out)
+
+    def test_merge_regressions(self):
+        self.reports("SUCCEEDED", "SUCCEEDED")
+        reports = self.WorkQueue.return_value.load_reports.return_value
+        reports[1]["summary"]["REGRESSIONS"] = [
+            {
+                "hostname": "h1.test",
+                "metric": "duration",
+                "value": 7200,
+                "median": 3600,
+                "mad": 60,
+                "score": 60.0,
+            }
+        ]
+
+        rc, out = self.merge()
+
+        self.assertEqual(rc, 0)
+        self.assertIn("Regressions         : 1 hosts regressed", out)
+        self.assertIn(
+            "h1.test             : slower, duration 2:00:00 instead of 1:00:00 "
+            "(+100%, 60.0 MADs)",
+            out,
+        )
+
+    def test_merge_failure(self):
+        self.reports("SUCCEEDED", "FAILED")
+
+        rc, out = self.merge(json=True)
+
+        self.assertEqual(rc, 1)
+        self.assertIn('"FAILED": 1', out)
+
+    def test_merge_no_report(self):
+        self.reports()
+
+        with self.assertRaises(SystemExit) as ctx:
+            self.merge()
+
+        self.assertEqual(ctx.exception.args, (1,))
+
+
+class TestPlan(unittest.TestCase):
+
+    CONF_DATA = """{
+        "hosts": ["foo.test", "bar.test", "baz.test"],
+        "default": {"lock": "/var/lock/backup/{}.lock"},
+        "history": "/path/to/db",
+        "workers": 2
+    }"""
+
+    def plan(self, args, durations=None):
+        with patch("builtins.open", mock_open(read_data=self.CONF_DATA)):
+            # XXX: required for tests to pass in python <3.8
+            open.return_value.name = "whatever"
+            with patch.object(module, "History") as m_History, patch.object(
+                module.Path, "exists", Mock(return_value=durations is not None)
+            ), patch.object(module, "Backuper") as m_Backuper, patch(
+                "sys.stdout", new_callable=StringIO
+            ) as stdout:
+                history = m_History.return_value.__enter__.return_value
+                history.durations.return_value = durations
+                rc = module.run(args)
+        m_Backuper.assert_not_called()
+        return rc, stdout.getvalue()
+
+    def test_plan(self):
+        durations = {"foo.test": 3600, "bar.test": 7200, "baz.test": 1800}
+
+        rc, out = self.plan(Args(plan=True), durations)
+
+        self.assertEqual(rc, 0)
+        self.assertIn("plan of 3 hosts on 2 workers", out)
+        self.assertIn("history of 3/3 hosts", out)
+        self.assertIn("predicted makespan: 2:00:00", out)
+        # foo.test then baz.test on the first worker
+        self.assertRegex(out, r"1 +2 +1:30:00 +75.0%")
+        self.assertRegex(out, r"2 +1 +2:00:00 +100.0%")
+
+    def test_plan_window(self):
+        durations = {"foo.test": 3600, "bar.test": 7200}
+        args = Args(plan=True, workers=1, window=timedelta(hours=2))
+
+        rc, out = self.plan(args, durations)
+
+        self.assertEqual(rc, 1)
+        self.assertIn("missing the window of 2:00:00", out)
+        self.assertIn("bar.test            : ends after 3:00:00\n", out)
+        self.assertIn("baz.test            : ends after 4:30:00 (estimated)", out)
+        self.assertNotIn("foo.test            :", out)
+
+    def test_plan_no_history(self):
+        rc, out = self.plan(Args(plan=True, only=["foo.test"]))
+
+        self.assertEqual(rc, 0)
+        self.assertIn("plan of 1 hosts", out)
+        self.assertIn("no history available", out)
+
+    def test_plan_bad_selector(self):
+        with self.assertRaises(SystemExit) as ctx:
+            self.plan(Args(plan=True, only=["xxx.test"]))
+
+        self.assertEqual(ctx.exception.args, (1,))
+
+
+class TestShards(unittest.TestCase):
+
+    CONF_DATA = """{
+        "hosts": [%s],
+        "default": {"lock": "/var/lock/backup/{}.lock"},
+        "shard": "1/3"
+    }""" % ", ".join('"host{}.test"'.format(i) for i in range(20))
+
+    def shards(self, args, conf_data=CONF_DATA):
+        with patch("builtins.open", mock_open(read_data=conf_data)):
+            # XXX: required for tests to pass in python <3.8
+            open.return_value.name = "whatever"
+            with patch("sys.stdout", new_callable=StringIO) as stdout:
+                rc = module.shards(args)
+        return rc, stdout.getvalue()
+
+    def test_shards_config(self):
+        rc, out = self.shards(ShardsArgs())
+
+        self.assertEqual(rc, 0)
+        self.assertIn("no history available", out)
+        for shard in ("1/3", "2/3", "3/3"):
+            self.assertIn(shard, out)
+
+    def test_shards_list(self):
+        rc, out = self.shards(ShardsArgs(count=2, list=True))
+
+        lines = [l for l in out.splitlines() if l.endswith(".test")]
+        self.assertEqual(len(lines), 20)
+        for line in lines:
+            shard, hostname = line.split()
+            self.assertEqual(int(shard[0]), shard_of(hostname, 2))
+
+    @patch.object(module, "History")
+    @patch.object(module.Path, "exists", Mock(return_value=True))
+    def test_shards_history(self, m_History):
+        history = m_History.return_value.__enter__.return_value
+        history.durations.return_value = {"host1.test": 3600, "host2.test": 60}
+        conf_data = self.CONF_DATA.replace("{", '{"history": "/path/to/db",', 1)
+
+        rc, out = self.shards(ShardsArgs(count=2), conf_data)
+
+        self.assertEqual(rc, 0)
+        self.assertIn("history of 2/20 hosts", out)
+
+    def test_shards_no_count(self):
+        conf_data = self.CONF_DATA.replace('"shard": "1/3"', '"history": null')
+
+        with self.assertRaises(SystemExit) as ctx:
+            self.shards(ShardsArgs(), conf_data)
+
+        self.assertEqual(ctx.exception.args, (2,))
+
+
 class TestCli(unittest.TestCase):
     def setUp(self):
         self.parser = module.cli()
@@ -183,6 +673,11 @@ class TestCli(unittest.TestCase):
         (("run", "--only"),),
         (("run", "--exclude"),),
         (("run", "--only", "foo.test", "--exclude", "bar.test"),),
+        (("run", "--shard", "4/3"),),
+        (("run", "--shard", "1"),),
+        (("shards", "--count", "two"),),
+        (("run", "--launch-rate", "0"),),
+        (("run", "--launch-rate", "fast"),),
     ])
     # fmt: on
     def test_bad_cl(self, args):
@@ -191,18 +686,82 @@ class TestCli(unittest.TestCase):
 
         self.assertEqual(ctx.exception.args, (2,))
 
+    def test_run_help(self):
+        with patch("sys.stdout", new=StringIO()) as stdout:
+            with self.assertRaises(SystemExit):
+                self.parser.parse_args(("run", "--help"))
+
+        # Defaults are given once, as plain paths
+        text = " ".join(stdout.getvalue().split())
+        self.assertIn("(default: /etc/backup/config.yml)", text)
+        self.assertNotIn("PosixPath", text)
+        self.assertNotRegex(text, r"\(default: [^()]*\) \(default:")
+
     def test_run(self):
         args = ("run", "--conf", "/path/to/foo", "--failfast")
 
         parsed = self.parser.parse_args(args)
 
-        self.assertEqual(parsed.conf, Path("/path/to/foo"))
+        self.assertEqual(parsed.conf, [Path("/path/to/foo")])
         self.assertTrue(parsed.failfast)
 
+    def test_run_confs(self):
+        args = ("run", "--conf", "a.yml", "-c", "b.yml", "--total-workers", "4")
+
+        parsed = self.parser.parse_args(args)
+
+        self.assertEqual(parsed.conf, [Path("a.yml"), Path("b.yml")])
+        self.assertEqual(parsed.total_workers, 4)
+
+    def test_run_launch_rate(self):
+        parsed = self.parser.parse_args(("run", "--launch-rate", "0.5"))
+
+        self.assertEqual(parsed.launch_rate, 0.5)
+
+    def test_run_workers(self):
+        parsed = self.parser.parse_args(("run", "-w", "8"))
+
+        self.assertEqual(parsed.workers, 8)
+
+    def test_run_shard(self):
+        args = ("run", "--shard", "2/3")
+
+        parsed = self.parser.parse_args(args)
+
+        self.assertEqual(parsed.shard, module.Shard(2, 3))
+
+    def test_shards(self):
+        args = ("shards", "--count", "4", "--list")
+
+        parsed = self.parser.parse_args(args)
+
+        self.assertEqual(parsed.count, 4)
+        self.assertTrue(parsed.list)
+        self.assertEqual(parsed.func, module.shards)
+
+    def test_daemon(self):
+        args = ("daemon", "--only", "tag:web", "--poll", "0")
+
+        parsed = self.parser.parse_args(args)
+
+        self.assertEqual(parsed.only, ["tag:web"])
+        self.assertEqual(parsed.poll, 0)
+        self.assertEqual(parsed.func, module.daemon)
+
+    def test_merge(self):
+        args = ("merge", "--queue", "/path/to/queue", "--queue-run", "run0")
+
+        parsed = self.parser.parse_args(args)
+
+        self.assertEqual(parsed.queue, Path("/path/to/queue"))
+        self.assertEqual(parsed.queue_run, "run0")
+        self.assertEqual(parsed.func, module.merge)
+
     def test_run_default(self):
         args = ("run",)
 
         parsed = self.parser.parse_args(args)
 
-        self.assertEqual(parsed.conf, Path("/etc/backup/config.yml"))
+        self.assertEqual(parsed.conf, [Path("/etc/backup/config.yml")])
         self.assertFalse(parsed.failfast)
+        self.assertIsNone(parsed.shard)
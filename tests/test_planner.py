@@ -0,0 +1,80 @@
+import unittest
+
+import qb.backup.planner as module
+
+
+class Host:
+    def __init__(self, hostname, lock=None):
+        self.hostname = hostname
+        self.lock = lock or "/var/lock/{}.lock".format(hostname)
+
+
+class TestSimulate(unittest.TestCase):
+    def hosts(self, planned):
+        return [(h["hostname"], h["slot"], h["start"], h["end"]) for h in planned]
+
+    def test_sequential(self):
+        hosts = [Host("foo.test"), Host("bar.test")]
+
+        res = module.simulate(hosts, {"foo.test": 10, "bar.test": 20})
+
+        self.assertEqual(res["makespan"], 30)
+        self.assertEqual(res["busy"], [30])
+        self.assertEqual(
+            self.hosts(res["hosts"]), [("foo.test", 0, 0, 10), ("bar.test", 0, 10, 30)]
+        )
+
+    def test_workers(self):
+        hosts = [Host("a.test"), Host("b.test"), Host("c.test")]
+        durations = {"a.test": 10, "b.test": 20, "c.test": 5}
+
+        res = module.simulate(hosts, durations, workers=2)
+
+        self.assertEqual(res["makespan"], 20)
+        self.assertEqual(res["busy"], [15, 20])
+        # c.test starts on the first free worker
+        self.assertEqual(res["hosts"][2]["slot"], 0)
+        self.assertEqual(res["hosts"][2]["start"], 10)
+
+    def test_unknown_durations(self):
+        hosts = [Host("a.test"), Host("b.test"), Host("c.test"), Host("d.test")]
+        durations = {"a.test": 10, "b.test": 20, "c.test": 60}
+
+        res = module.simulate(hosts, durations)
+
+        self.assertEqual(res["makespan"], 110)
+        self.assertEqual(
+            [h["estimated"] for h in res["hosts"]], [False, False, False, True]
+        )
+
+    def test_lock_requeued(self):
+        lock = "/var/lock/shared.lock"
+        hosts = [Host("a.test", lock), Host("b.test", lock), Host("c.test")]
+        durations = {"a.test": 10, "b.test": 10, "c.test": 1}
+
+        res = module.simulate(hosts, durations, workers=2, lock_timeout=60)
+
+        # b.test is tried again once c.test is started, waits for the lock of
+        # a.test on a worker
+        self.assertEqual(
+            self.hosts(res["hosts"]),
+            [("a.test", 0, 0, 10), ("c.test", 1, 0, 1), ("b.test", 1, 10, 20)],
+        )
+        self.assertEqual(res["busy"], [10, 20])
+        self.assertEqual({h["status"] for h in res["hosts"]}, {"SUCCEEDED"})
+
+    def test_lock_timeout(self):
+        lock = "/var/lock/shared.lock"
+        hosts = [Host("a.test", lock), Host("b.test", lock)]
+
+        res = module.simulate(hosts, {"a.test": 100}, workers=2, lock_timeout=30)
+
+        self.assertEqual(res["makespan"], 100)
+        failed = res["hosts"][1]
+        self.assertEqual(failed["status"], "FAILED")
+        self.assertEqual((failed["start"], failed["end"]), (30, 30))
+
+    def test_empty(self):
+        res = module.simulate([], workers=2)
+
+        self.assertEqual(res, {"makespan": 0, "busy": [0, 0], "hosts": []})
@@ -0,0 +1,90 @@
+import unittest
+
+import logging
+from logging.handlers import BufferingHandler
+from pathlib import Path
+import pstats
+import tempfile
+import threading
+import tracemalloc
+
+import qb.backup.profiling as module
+
+
+def allocate(n):
+    return [str(i) * 10 for i in range(n)]
+
+
+def work():
+    allocate(2000)
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = Path(tmp.name) / "profile"
+
+    def test_profile(self):
+        kept = []
+
+        with module.Profiler(self.directory, every=2) as profiler:
+            profiler.snapshot("config")
+            kept.append(allocate(5000))
+            # Worker threads are profiled as well
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+            on_done = profiler.on_done()
+            for host in ("foo.test", "bar.test", "baz.test"):
+                on_done(host)
+
+        self.assertFalse(tracemalloc.is_tracing())
+        names = sorted(p.name for p in self.directory.iterdir())
+        self.assertEqual(
+            names,
+            [
+                "cpu.prof",
+                "cpu.txt",
+                "memory-01-config.txt",
+                "memory-02-hosts-2.txt",
+                "memory-03-end.txt",
+            ],
+        )
+        stats = pstats.Stats(str(self.directory / "cpu.prof"))
+        functions = {name for _, _, name in stats.stats}
+        self.assertIn("allocate", functions)
+        self.assertIn("work", functions)
+        self.assertIn("allocate", (self.directory / "cpu.txt").read_text())
+        end = (self.directory / "memory-03-end.txt").read_text()
+        self.assertIn("3 hosts done", end)
+        self.assertIn("growths since the previous snapshot", end)
+        # The allocations kept show up
+        self.assertIn("test_profiling.py", end)
+
+    def test_on_done_callback(self):
+        done = []
+        profiler = module.Profiler(self.directory, every=0)
+
+        profiler.on_done(done.append)("foo.test")
+
+        self.assertEqual(done, ["foo.test"])
+        self.assertEqual(profiler.hosts, 1)
+        self.assertEqual(profiler.snapshots, 0)
+
+
+class TestBufferedRecords(unittest.TestCase):
+    def test_buffered_records(self):
+        logger = logging.getLogger("qb.backup.test-profiling")
+        handler = BufferingHandler(100)
+        handler.set_name("mail")
+        logger.addHandler(handler)
+        logger.addHandler(logging.NullHandler())
+        self.addCleanup(logger.removeHandler, handler)
+        logger.propagate = False
+        logger.warning("one")
+        logger.warning("two")
+
+        counts = module.buffered_records([logger.name])
+
+        self.assertEqual(counts, {"mail": 2})
@@ -0,0 +1,126 @@
+import unittest
+from unittest.mock import patch
+from parameterized import parameterized
+
+import qb.backup.ramp as module
+
+
+class Clock:
+    """ Fake time, advanced by sleep(). """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+class TestLaunchRamp(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def ramp(self, rate, **kwargs):
+        return module.LaunchRamp(
+            rate, clock=self.clock, sleep=self.clock.sleep, **kwargs
+        )
+
+    def test_acquire(self):
+        ramp = self.ramp(2, burst=3)
+
+        waits = [ramp.acquire() for _ in range(5)]
+
+        # The burst starts at once, then one session every 1/rate seconds
+        self.assertEqual(waits, [0, 0, 0, 0.5, 1.0])
+        self.assertEqual(self.clock.sleeps, [0.5, 1.0])
+
+    def test_acquire_refill(self):
+        ramp = self.ramp(2, burst=3)
+        for _ in range(3):
+            ramp.acquire()
+
+        self.clock.now = 1.0
+        self.assertEqual([ramp.acquire(), ramp.acquire()], [0, 0])
+        # Tokens do not pile up beyond the burst
+        self.clock.now = 100.0
+        self.assertEqual([ramp.acquire() for _ in range(4)], [0, 0, 0, 0.5])
+
+    @patch.object(module.random, "uniform", return_value=0.25)
+    def test_acquire_jitter(self, m_uniform):
+        ramp = self.ramp(2, jitter=1)
+
+        self.assertEqual([ramp.acquire(), ramp.acquire()], [0.25, 0.75])
+        m_uniform.assert_called_with(0, 1)
+
+    def test_throttle(self):
+        ramp = self.ramp(4, min_rate=1)
+
+        with self.assertLogs("qb.backup", "WARNING"):
+            ramp.throttle()
+            # Refused tunnels of sessions started together count once
+            ramp.throttle()
+        self.assertEqual(ramp.current, 2)
+
+        for now in (1, 2, 3):
+            self.clock.now = now
+            ramp.throttle()
+        self.assertEqual(ramp.current, 1)
+
+    def test_recover(self):
+        ramp = self.ramp(10, backoff=0.2)
+        ramp.throttle()
+        self.assertEqual(ramp.current, 2)
+
+        for _ in range(7):
+            ramp.recover()
+        self.assertEqual(ramp.current, 9)
+        ramp.recover()
+        ramp.recover()
+        self.assertEqual(ramp.current, 10)
+
+    def test_parse(self):
+        ramp = module.LaunchRamp.parse({"rate": 2, "burst": "5", "jitter": 1.5})
+
+        self.assertEqual((ramp.rate, ramp.burst, ramp.jitter), (2, 5, 1.5))
+        self.assertEqual(ramp.min_rate, 0.2)
+
+    # fmt: off
+    @parameterized.expand([
+        (2, "mapping with a rate"),
+        ({"burst": 2}, "mapping with a rate"),
+        ({"rate": 2, "brust": 2}, "brust"),
+        ({"rate": "fast"}, "bad launch settings"),
+        ({"rate": 0}, "rate must be positive"),
+        ({"rate": 1, "burst": 0}, "burst"),
+        ({"rate": 1, "backoff": 1}, "backoff"),
+    ])
+    # fmt: on
+    def test_parse_error(self, conf, msg):
+        with self.assertRaisesRegex(module.RampError, msg):
+            module.LaunchRamp.parse(conf)
+
+    @parameterized.expand(
+        [
+            ("ssh: connect to host localhost port 64064: Connection refused\n",),
+            ("Connection closed by 127.0.0.1 port 64064\n",),
+        ]
+    )
+    def test_refused(self, line):
+        self.assertTrue(module.REFUSED.search(line))
+
+    @parameterized.expand(
+        [
+            ("ssh: connect to host foo.test port 22: Connection refused\n",),
+            ("Connection reset by 192.0.2.1 port 22\n",),
+            ("ssh: connect to host localhost port 640640: Connection refused\n",),
+            ("kex_exchange_identification: Connection closed by remote host\n",),
+            ("Connection closed by 10.0.0.5 port 22\n",),
+        ]
+    )
+    def test_not_refused(self, line):
+        # Errors of the connection to the host, which may just be down or drop
+        # connections itself
+        self.assertFalse(module.REFUSED.search(line))
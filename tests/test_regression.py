@@ -0,0 +1,68 @@
+import unittest
+from parameterized import parameterized
+
+import math
+
+import qb.backup.regression as module
+
+
+def samples(durations, **metrics):
+    return [dict(metrics, duration=d) for d in durations]
+
+
+class TestBaseline(unittest.TestCase):
+    def test_baseline(self):
+        median, mad = module.baseline([1, 2, 3, 4, 100])
+
+        self.assertEqual(median, 3)
+        self.assertAlmostEqual(mad, 1 * module.MAD_SCALE)
+
+
+class TestDetect(unittest.TestCase):
+
+    HISTORY = samples([3600, 3500, 3700, 3650, 3550, 3600], original_size=10 ** 9)
+
+    def test_slower(self):
+        (res,) = module.detect({"duration": 7200}, self.HISTORY)
+
+        self.assertEqual(res["metric"], "duration")
+        self.assertEqual(res["median"], 3600)
+        self.assertGreater(res["score"], 3.5)
+
+    # fmt: off
+    @parameterized.expand([
+        ("usual", {"duration": 3800, "original_size": 10 ** 9}),
+        ("faster", {"duration": 60}),
+        ("unknown", {}),
+    ])
+    # fmt: on
+    def test_not_regressed(self, _, result):
+        self.assertEqual(module.detect(result, self.HISTORY), [])
+
+    def test_more_data(self):
+        result = {"duration": 3600, "original_size": 2 * 10 ** 9}
+
+        res = module.detect(result, self.HISTORY)
+
+        self.assertEqual([r["metric"] for r in res], ["original_size"])
+        # All previous sizes are the same
+        self.assertEqual(res[0]["mad"], 0)
+        self.assertEqual(res[0]["score"], math.inf)
+
+    def test_min_change(self):
+        # Far from the stable previous sizes, but by less than 20%
+        res = module.detect({"original_size": 1.1 * 10 ** 9}, self.HISTORY)
+
+        self.assertEqual(res, [])
+
+    def test_min_samples(self):
+        res = module.detect({"duration": 7200}, self.HISTORY[:4])
+
+        self.assertEqual(res, [])
+
+    def test_missing_values(self):
+        history = self.HISTORY + samples([None] * 10)
+
+        (res,) = module.detect({"duration": 7200}, history)
+
+        self.assertEqual(res["median"], 3600)
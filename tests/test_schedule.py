@@ -0,0 +1,174 @@
+import unittest
+from parameterized import parameterized
+
+from datetime import datetime, timedelta
+
+import qb.backup.schedule as module
+
+
+class Host:
+    def __init__(self, hostname, schedule=None, interval=None):
+        self.hostname = hostname
+        self.schedule = module.Cron.parse(schedule) if schedule else None
+        self.interval = interval
+
+
+class TestCron(unittest.TestCase):
+    # 2020-02-01 is a Saturday
+    NOW = datetime(2020, 2, 1, 12, 34, 56)
+
+    # fmt: off
+    @parameterized.expand([
+        ("* * * * *", datetime(2020, 2, 1, 12, 35)),
+        ("0 3 * * *", datetime(2020, 2, 2, 3, 0)),
+        ("*/15 * * * *", datetime(2020, 2, 1, 12, 45)),
+        ("30 2 * * 1-5", datetime(2020, 2, 3, 2, 30)),
+        ("0 0 * * 7", datetime(2020, 2, 2, 0, 0)),
+        ("0 0 * * 0", datetime(2020, 2, 2, 0, 0)),
+        ("0 12,13 * * *", datetime(2020, 2, 1, 13, 0)),
+        ("0 0 29 2 *", datetime(2020, 2, 29, 0, 0)),
+        ("0 0 1 3 *", datetime(2020, 3, 1, 0, 0)),
+        # Both day of month and day of week restricted: either matches
+        ("0 0 10 * 1", datetime(2020, 2, 3, 0, 0)),
+        ("0 0 2 * 5", datetime(2020, 2, 2, 0, 0)),
+    ])
+    # fmt: on
+    def test_next(self, expr, expected):
+        self.assertEqual(module.Cron(expr).next(self.NOW), expected)
+
+    def test_next_strictly_after(self):
+        cron = module.Cron("0 3 * * *")
+        now = datetime(2020, 2, 1, 3, 0)
+
+        self.assertEqual(cron.next(now), datetime(2020, 2, 2, 3, 0))
+
+    # fmt: off
+    @parameterized.expand([
+        ("* * * *",), ("60 * * * *",), ("* 24 * * *",), ("* * 0 * *",),
+        ("* * * 13 *",), ("* * * * 8",), ("*/0 * * * *",), ("a * * * *",),
+        ("5-1 * * * *",),
+    ])
+    # fmt: on
+    def test_parse_error(self, expr):
+        with self.assertRaises(module.ScheduleError):
+            module.Cron(expr)
+
+    def test_never(self):
+        with self.assertRaises(module.ScheduleError):
+            module.Cron("0 0 31 2 *").next(self.NOW)
+
+    def test_parse_shared(self):
+        self.assertIs(module.Cron.parse("0 3 * * *"), module.Cron.parse("0 3 * * *"))
+        self.assertEqual(module.Cron("0 3 * * *"), module.Cron("0 3 * * *"))
+
+
+class TestParseInterval(unittest.TestCase):
+    # fmt: off
+    @parameterized.expand([
+        (3600, timedelta(hours=1)),
+        (1.5, timedelta(seconds=1.5)),
+        ("90", timedelta(seconds=90)),
+        ("30m", timedelta(minutes=30)),
+        ("6h", timedelta(hours=6)),
+        ("1.5d", timedelta(hours=36)),
+    ])
+    # fmt: on
+    def test_parse(self, value, expected):
+        self.assertEqual(module.parse_interval(value), expected)
+
+    @parameterized.expand([("6 hours",), ("h",), (0,), ("-1h",), (True,)])
+    def test_parse_error(self, value):
+        with self.assertRaises(module.ScheduleError):
+            module.parse_interval(value)
+
+
+class TestSchedule(unittest.TestCase):
+    NOW = datetime(2020, 2, 1, 12, 0)
+
+    def setUp(self):
+        self.schedule = module.Schedule()
+        # fmt: off
+        self.hosts = [
+            Host("cron.test", schedule="0 3 * * *"),
+            Host("interval.test", interval=timedelta(hours=6)),
+            Host("never.test"),
+        ]
+        # fmt: on
+
+    def hostnames(self, hosts):
+        return sorted(h.hostname for h in hosts)
+
+    def test_update(self):
+        self.schedule.update(self.hosts, self.NOW)
+
+        self.assertEqual(len(self.schedule), 2)
+        # Hosts with an interval and no history are due immediately
+        self.assertEqual(self.schedule.next_due(), self.NOW)
+        self.assertEqual(self.schedule.next["cron.test"], datetime(2020, 2, 2, 3, 0))
+
+    def test_update_last_runs(self):
+        last_runs = {"interval.test": self.NOW - timedelta(hours=1)}
+
+        self.schedule.update(self.hosts, self.NOW, last_runs)
+
+        self.assertEqual(self.schedule.next_due(), self.NOW + timedelta(hours=5))
+
+    def test_due_reschedule(self):
+        self.schedule.update(self.hosts, self.NOW)
+
+        due = self.schedule.due(self.NOW)
+        self.assertEqual(self.hostnames(due), ["interval.test"])
+        self.assertEqual(self.schedule.due(self.NOW), [])
+
+        self.schedule.reschedule(due, self.NOW, self.NOW + timedelta(hours=1))
+        self.assertEqual(self.schedule.next_due(), self.NOW + timedelta(hours=6))
+
+        later = datetime(2020, 2, 2, 3, 0)
+        due = self.schedule.due(later)
+        self.assertEqual(self.hostnames(due), ["cron.test", "interval.test"])
+        self.assertIsNone(self.schedule.next_due())
+
+    def test_update_keep(self):
+        self.schedule.update(self.hosts, self.NOW)
+        self.schedule.reschedule(self.schedule.due(self.NOW), self.NOW, self.NOW)
+
+        # fmt: off
+        hosts = [
+            Host("cron.test", schedule="0 4 * * *"),
+            Host("interval.test", interval=timedelta(hours=6)),
+            Host("new.test", interval=timedelta(hours=6)),
+        ]
+        # fmt: on
+        later = self.NOW + timedelta(hours=1)
+        self.schedule.update(hosts, later)
+
+        self.assertEqual(
+            self.schedule.next,
+            {
+                "cron.test": datetime(2020, 2, 2, 4, 0),
+                "interval.test": self.NOW + timedelta(hours=6),
+                "new.test": later,
+            },
+        )
+
+    def test_update_running(self):
+        self.schedule.update(self.hosts, self.NOW)
+        due = self.schedule.due(self.NOW)
+
+        hosts = [self.hosts[0], Host("interval.test", interval=timedelta(hours=2))]
+        self.schedule.update(hosts, self.NOW)
+
+        # Not due again while it runs
+        self.assertEqual(self.schedule.due(self.NOW), [])
+        # Rescheduled with its new interval once over
+        self.schedule.reschedule(due, self.NOW, self.NOW)
+        self.assertEqual(self.schedule.next_due(), self.NOW + timedelta(hours=2))
+
+    def test_reschedule_removed(self):
+        self.schedule.update(self.hosts, self.NOW)
+        due = self.schedule.due(self.NOW)
+
+        self.schedule.update([], self.NOW)
+        self.schedule.reschedule(due, self.NOW, self.NOW)
+
+        self.assertIsNone(self.schedule.next_due())
@@ -0,0 +1,97 @@
+import unittest
+from parameterized import parameterized
+
+import qb.backup.selector as module
+
+
+class Host:
+    def __init__(self, hostname, tags=()):
+        self.hostname = hostname
+        self.tags = frozenset(tags)
+
+
+class TestHostRegistry(unittest.TestCase):
+    def setUp(self):
+        # fmt: off
+        self.registry = module.HostRegistry([
+            Host("web1.example.test", ["web", "prod"]),
+            Host("web2.example.test", ["web", "prod"]),
+            Host("web1.staging.test", ["web", "staging"]),
+            Host("db1.example.test", ["db", "prod"]),
+            Host("mail.example.test"),
+        ])
+        # fmt: on
+
+    def select(self, *selectors, **kwargs):
+        return [h.hostname for h in self.registry.select(selectors, **kwargs)]
+
+    # fmt: off
+    @parameterized.expand([
+        ("db1.example.test", ["db1.example.test"]),
+        ("web*.example.test", ["web1.example.test", "web2.example.test"]),
+        ("*.test", ["web1.example.test", "web2.example.test", "web1.staging.test",
+                    "db1.example.test", "mail.example.test"]),
+        ("re:^web[0-9]", ["web1.example.test", "web2.example.test",
+                          "web1.staging.test"]),
+        ("re:staging", ["web1.staging.test"]),
+        ("tag:db", ["db1.example.test"]),
+        ("tag:st*", ["web1.staging.test"]),
+        ("!tag:web", ["db1.example.test", "mail.example.test"]),
+        ("tag:web&tag:prod", ["web1.example.test", "web2.example.test"]),
+        ("tag:web&!web1*", ["web2.example.test"]),
+        ("tag:db,mail.example.test", ["db1.example.test", "mail.example.test"]),
+        ("!!tag:db", ["db1.example.test"]),
+    ])
+    # fmt: on
+    def test_select(self, selector, expected):
+        self.assertEqual(self.select(selector), expected)
+
+    def test_select_union(self):
+        res = self.select("mail.example.test", "tag:db")
+
+        # Results are in registry order, not in selector order
+        self.assertEqual(res, ["db1.example.test", "mail.example.test"])
+
+    def test_select_exclude(self):
+        res = self.select("tag:web", "tag:db", exclude=True)
+
+        self.assertEqual(res, ["mail.example.test"])
+
+    # fmt: off
+    @parameterized.expand([
+        ("xxx.example.test",),
+        ("*.invalid",),
+        ("tag:nope",),
+        ("re:^nope",),
+        ("re:(",),
+        ("tag:web&tag:nope",),
+        ("mail.example.test,",),
+        ("!",),
+    ])
+    # fmt: on
+    def test_select_error(self, selector):
+        with self.assertRaises(module.SelectorError):
+            self.select(selector)
+
+    def test_select_empty_intersection(self):
+        # Each factor matches, only their intersection is empty
+        res = self.select("tag:db&tag:web")
+
+        self.assertEqual(res, [])
+
+    def test_select_unmatched(self):
+        unmatched = set()
+
+        res = self.select("tag:db,tag:nope", "xxx.test&!tag:web", unmatched=unmatched)
+
+        self.assertEqual(res, ["db1.example.test"])
+        self.assertEqual(unmatched, {"tag:nope", "xxx.test"})
+        # Malformed selectors are still errors
+        with self.assertRaises(module.SelectorError):
+            self.select("re:(", unmatched=unmatched)
+
+    def test_lookup(self):
+        self.assertEqual(len(self.registry), 5)
+        self.assertIn("mail.example.test", self.registry)
+        self.assertNotIn("xxx.example.test", self.registry)
+        self.assertEqual(self.registry["db1.example.test"].tags, {"db", "prod"})
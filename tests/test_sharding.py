@@ -0,0 +1,80 @@
+import unittest
+from parameterized import parameterized
+
+import qb.backup.sharding as module
+
+
+class Host:
+    def __init__(self, hostname):
+        self.hostname = hostname
+
+
+class TestJumpHash(unittest.TestCase):
+    def test_range(self):
+        for key in range(0, 2 ** 64, 2 ** 58 + 12345):
+            self.assertIn(module.jump_hash(key, 7), range(7))
+
+    def test_single_bucket(self):
+        self.assertEqual(module.jump_hash(123456789, 1), 0)
+
+    def test_minimal_movement(self):
+        keys = [module.host_key("host{}.test".format(i)) for i in range(2000)]
+
+        before = [module.jump_hash(k, 4) for k in keys]
+        after = [module.jump_hash(k, 5) for k in keys]
+
+        moved = [(b, a) for b, a in zip(before, after) if b != a]
+        # Keys only move to the new bucket, and about 1/5 of them do
+        self.assertTrue(all(a == 4 for _, a in moved))
+        self.assertLess(abs(len(moved) - 400), 80)
+
+    def test_host_key_stable(self):
+        # Must not depend on PYTHONHASHSEED
+        self.assertEqual(module.host_key("foo.test"), 0x2CE0D1A55066AFE6)
+
+
+class TestShard(unittest.TestCase):
+    def test_parse(self):
+        shard = module.Shard.parse("2/4")
+
+        self.assertEqual((shard.number, shard.count), (2, 4))
+        self.assertEqual(str(shard), "2/4")
+        self.assertEqual(shard, module.Shard(2, 4))
+        self.assertEqual(len({shard, module.Shard(2, 4), module.Shard(1, 4)}), 2)
+
+    # fmt: off
+    @parameterized.expand([
+        ("2",), ("a/4",), ("2/4/6",), ("0/4",), ("5/4",), ("1/0",), (None,),
+    ])
+    # fmt: on
+    def test_parse_error(self, text):
+        with self.assertRaises(module.ShardError):
+            module.Shard.parse(text)
+
+    def test_select_partition(self):
+        hosts = [Host("host{}.test".format(i)) for i in range(300)]
+
+        selected = [module.Shard(k, 3).select(hosts) for k in (1, 2, 3)]
+
+        self.assertEqual(sorted(sum(selected, []), key=hosts.index), hosts)
+        for s in selected:
+            self.assertLess(abs(len(s) - 100), 30)
+
+
+class TestPlan(unittest.TestCase):
+    def test_plan_count(self):
+        hosts = [Host("host{}.test".format(i)) for i in range(30)]
+
+        shards = module.plan(hosts, 2)
+
+        self.assertEqual([str(s["shard"]) for s in shards], ["1/2", "2/2"])
+        self.assertEqual(sum(len(s["hosts"]) for s in shards), 30)
+        self.assertEqual(sum(s["load"] for s in shards), 30)
+
+    def test_plan_durations(self):
+        hosts = [Host("a.test"), Host("b.test"), Host("c.test")]
+
+        shards = module.plan(hosts, 1, {"a.test": 10, "b.test": 30})
+
+        # c.test has no history and weighs the median of the others
+        self.assertEqual(shards[0]["load"], 60)
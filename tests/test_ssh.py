@@ -0,0 +1,123 @@
+import unittest
+from unittest.mock import patch
+
+import subprocess
+
+import qb.backup.ssh as module
+
+
+class Host:
+    def __init__(self, hostname, port="22"):
+        self.hostname = hostname
+        self.port = port
+
+
+class TestCommand(unittest.TestCase):
+    def test_command(self):
+        res = module.command(Host("foo.test", "23"), "true", options=["-R", "1:h:2"])
+
+        self.assertEqual(res[0], "ssh")
+        self.assertEqual(res[-2:], ["foo.test", "true"])
+        self.assertIn("BatchMode=yes", res)
+        self.assertEqual(res[res.index("-p") + 1], "23")
+        self.assertEqual(res[res.index("-R") + 1], "1:h:2")
+
+
+@patch.object(module.subprocess, "run")
+class TestControlMasters(unittest.TestCase):
+    def setUp(self):
+        self.masters = module.ControlMasters(limit=2)
+        self.addCleanup(self.masters.close)
+
+    def commands(self, m_run):
+        return [c[0][0] for c in m_run.call_args_list]
+
+    def test_options(self, m_run):
+        host = Host("foo.test")
+
+        first = self.masters.options(host)
+        second = self.masters.options(host)
+
+        # Opened once, reused afterwards
+        (cmd,) = self.commands(m_run)
+        self.assertIn("ControlMaster=yes", cmd)
+        self.assertIn("-f", cmd)
+        self.assertEqual(cmd[-1], "foo.test")
+        self.assertEqual(first, second)
+        self.assertIn("ControlMaster=no", first)
+        path = first[-1].split("=", 1)[1]
+        self.assertIn("ControlPath={}".format(path), cmd)
+        self.assertTrue(path.startswith(str(self.masters.directory)))
+
+    def test_options_reuse(self, m_run):
+        host = Host("foo.test")
+
+        self.assertEqual(self.masters.options(host, open=False), [])
+        m_run.assert_not_called()
+        first = self.masters.options(host)
+
+        self.assertEqual(self.masters.options(host, open=False), first)
+        self.assertEqual(m_run.call_count, 1)
+
+    def test_limit(self, m_run):
+        self.masters.options(Host("foo.test"))
+        self.masters.options(Host("bar.test"))
+
+        res = self.masters.options(Host("baz.test"))
+
+        # Connected to directly
+        self.assertEqual(res, [])
+        self.assertEqual(m_run.call_count, 2)
+
+        # Released masters free their slot
+        self.masters.release(Host("foo.test"))
+        self.assertNotEqual(self.masters.options(Host("baz.test")), [])
+
+    def test_open_error(self, m_run):
+        m_run.side_effect = subprocess.CalledProcessError(255, "ssh")
+
+        with self.assertLogs("qb.backup", "WARNING"):
+            res = self.masters.options(Host("foo.test"))
+
+        self.assertEqual(res, [])
+        self.assertEqual(self.masters.masters, {})
+
+    def test_pid(self, m_run):
+        host = Host("foo.test")
+        self.assertIsNone(self.masters.pid(host))
+        self.masters.options(host)
+        m_run.return_value = subprocess.CompletedProcess(
+            "ssh", 0, "", "Master running (pid=1234)\r\n"
+        )
+
+        self.assertEqual(self.masters.pid(host), 1234)
+        _, cmd = self.commands(m_run)
+        self.assertEqual(cmd[cmd.index("-O") + 1], "check")
+
+        m_run.side_effect = subprocess.CalledProcessError(255, "ssh")
+        with self.assertLogs("qb.backup", "WARNING"):
+            self.assertIsNone(self.masters.pid(host))
+
+    def test_release(self, m_run):
+        host = Host("foo.test")
+        options = self.masters.options(host)
+
+        self.masters.release(host)
+        self.masters.release(host)
+
+        _, cmd = self.commands(m_run)
+        self.assertEqual(cmd[cmd.index("-O") + 1], "exit")
+        self.assertEqual(cmd[-1], "foo.test")
+        self.assertIn(options[-1], cmd)
+
+    def test_close(self, m_run):
+        with self.masters:
+            self.masters.options(Host("foo.test"))
+            self.masters.options(Host("bar.test"))
+            m_run.side_effect = subprocess.TimeoutExpired("ssh", 60)
+
+        # All closed, even if one of them failed
+        exits = [c for c in self.commands(m_run) if "exit" in c]
+        self.assertEqual(len(exits), 2)
+        self.assertEqual(self.masters.masters, {})
+        self.assertFalse(self.masters.directory.exists())
@@ -0,0 +1,70 @@
+import unittest
+from unittest.mock import Mock, patch
+
+import json
+from pathlib import Path
+import tempfile
+
+import qb.backup.trace as module
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        self.trace = module.Trace()
+        self.trace.origin = 0
+
+    def events(self, ph):
+        return [e for e in self.trace.events if e["ph"] == ph]
+
+    def test_rss(self):
+        self.assertGreater(module.rss(), 0)
+
+    @patch("builtins.open", Mock(side_effect=OSError))
+    def test_rss_fallback(self):
+        self.assertGreater(module.rss(), 0)
+
+    def test_host(self):
+        phases = Mock(
+            spans=[
+                ("queue", 0, 1000),
+                ("lock", 1000, 3000),
+                ("connect", 3000, 10000),
+                ("teardown", 10000, 11000),
+            ]
+        )
+
+        self.trace.host(1, "foo.test", "SUCCEEDED", phases)
+
+        host, *spans = self.events("X")
+        self.assertEqual(host["name"], "foo.test")
+        self.assertEqual((host["ts"], host["dur"]), (1, 10))
+        self.assertEqual(host["tid"], 1)
+        self.assertEqual(host["args"], {"status": "SUCCEEDED"})
+        self.assertEqual([s["name"] for s in spans], ["lock", "connect", "teardown"])
+        self.assertEqual(spans[1]["ts"], 3)
+        # The track of the slot is named
+        (meta,) = [e for e in self.events("M") if e["name"] == "thread_name"]
+        self.assertEqual((meta["tid"], meta["args"]["name"]), (1, "worker 2"))
+
+    def test_host_queued_only(self):
+        self.trace.host(0, "foo.test", "FAILED", Mock(spans=[("queue", 0, 1000)]))
+
+        self.assertEqual(self.events("X"), [])
+
+    def test_counters(self):
+        self.trace.counters(3, now=5000)
+
+        in_flight, memory = self.events("C")
+        self.assertEqual(in_flight["args"], {"hosts": 3})
+        self.assertEqual(in_flight["ts"], 5)
+        self.assertGreater(memory["args"]["rss"], 0)
+
+    def test_write(self):
+        self.trace.span("foo.test", 0, 0, 1000)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "trace.json"
+            self.trace.write(path)
+            data = json.loads(path.read_text())
+
+        self.assertEqual(data["traceEvents"], self.trace.events)
@@ -0,0 +1,109 @@
+import unittest
+from unittest.mock import Mock
+from parameterized import parameterized
+
+import qb.backup.transport as module
+
+
+class Host:
+    def __init__(self, hostname, port="22"):
+        self.hostname = hostname
+        self.port = port
+
+
+class TestSshTransport(unittest.TestCase):
+    def test_command(self):
+        cmd = module.SSH.command(Host("foo.test"))
+
+        self.assertEqual(cmd[0], "ssh")
+        self.assertEqual(cmd[-1], "foo.test")
+        self.assertEqual(cmd[cmd.index("-R") + 1], "64064:localhost:22")
+
+    def test_masters(self):
+        host = Host("foo.test")
+        masters = Mock(
+            **{"options.return_value": ["-o", "ControlPath=/s"], "pid.return_value": 42}
+        )
+
+        cmd = module.SSH.command(host, masters)
+        pids = module.SSH.processes(host, masters)
+        module.SSH.release(host, masters)
+
+        self.assertIn("ControlPath=/s", cmd)
+        # The backup does not open a master of its own
+        masters.options.assert_called_once_with(host, open=False)
+        self.assertEqual(pids, [42])
+        masters.release.assert_called_once_with(host)
+        self.assertEqual(module.SSH.processes(host), [])
+
+    def test_probe(self):
+        cmd = module.SSH.probe(Host("foo.test"))
+
+        self.assertEqual(cmd[-2:], ["foo.test", "true"])
+        self.assertNotIn("-R", cmd)
+
+    def test_probe_masters(self):
+        host = Host("foo.test")
+        masters = Mock(**{"options.return_value": ["-o", "ControlPath=/s"]})
+
+        cmd = module.SSH.probe(host, masters)
+
+        # Opened by the probe, and reused by the backup
+        masters.options.assert_called_once_with(host)
+        self.assertIn("ControlPath=/s", cmd)
+
+
+class TestLocalTransport(unittest.TestCase):
+    def test_command(self):
+        transport = module.LocalTransport(["jexec", "{hostname}", "/sbin/backup"])
+
+        cmd = transport.command(Host("jail1"), masters=Mock())
+
+        self.assertEqual(cmd, ["jexec", "jail1", "/sbin/backup"])
+        self.assertEqual(transport.processes(Host("jail1")), [])
+        self.assertIsNone(transport.probe(Host("jail1")))
+        self.assertFalse(transport.tunnel)
+
+    def test_command_string(self):
+        transport = module.LocalTransport("nsenter -t 1 -a 'backup {hostname}'")
+
+        cmd = transport.command(Host("ct1"))
+
+        self.assertEqual(cmd, ["nsenter", "-t", "1", "-a", "backup ct1"])
+
+    # fmt: off
+    @parameterized.expand([
+        ([],),
+        ("",),
+        (["backup", "{host}"],),
+        (["{0}"],),
+        (["backup", "{hostname.x}"],),
+    ])
+    # fmt: on
+    def test_error(self, argv):
+        with self.assertRaises(module.TransportError):
+            module.LocalTransport(argv)
+
+
+class TestParse(unittest.TestCase):
+    def test_parse(self):
+        self.assertIs(module.parse(None), module.SSH)
+        self.assertIs(module.parse("ssh"), module.SSH)
+        local = module.parse({"local": ["jexec", "{hostname}", "backup"]})
+        self.assertEqual(local.argv, ("jexec", "{hostname}", "backup"))
+        # Shared by the hosts using the same transport
+        self.assertIs(module.parse({"local": ["jexec", "{hostname}", "backup"]}), local)
+        self.assertIs(module.parse({"local": "jexec {hostname} backup"}), local)
+
+    # fmt: off
+    @parameterized.expand([
+        ("local",),
+        ("rsh",),
+        ({"local": 1},),
+        ({"local": []},),
+        ({"local": "backup", "ssh": True},),
+    ])
+    # fmt: on
+    def test_parse_error(self, value):
+        with self.assertRaises(module.TransportError):
+            module.parse(value)
@@ -1,8 +1,12 @@
 import unittest
 from unittest.mock import Mock, patch, ANY
 
+import asyncio
 from datetime import timedelta
+import os
 from pathlib import Path
+import tempfile
+import threading
 import time
 
 import qb.backup._utils as module
@@ -60,6 +64,140 @@ class TestFLock(unittest.TestCase):
         fd.close.assert_called_once_with()
 
 
+class TestLockManager(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self._tmp.name) / "file.lock"
+        self.locks = module.LockManager()
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_lock(self):
+        self.path.write_text("do not truncate before locking")
+
+        with self.locks.lock(self.path):
+            self.assertEqual(self.locks.held(), [str(self.path)])
+            pid, host, since, alive = self.locks.holder(self.path)
+            self.assertEqual(pid, os.getpid())
+            self.assertTrue(alive)
+            self.assertEqual(self.path.read_text().split()[0], str(os.getpid()))
+        self.assertEqual(self.locks.held(), [])
+
+    def test_lock_busy_in_process(self):
+        with self.locks.lock(self.path):
+            with self.assertRaises(module.FLockBusyError) as ctx:
+                self.locks.acquire(str(self.path))
+        self.assertIn(str(os.getpid()), str(ctx.exception))
+
+        # Released: reading the holder did not break anything
+        with self.locks.lock(self.path):
+            pass
+
+    def test_lock_timeout_threads(self):
+        acquired = threading.Event()
+
+        def hold():
+            with self.locks.lock(self.path):
+                acquired.set()
+                time.sleep(0.2)
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        acquired.wait()
+        start = time.monotonic()
+        with self.assertRaises(module.FLockBusyError):
+            self.locks.acquire(self.path, timeout=0.05)
+        self.locks.acquire(self.path, timeout=5)
+        waited = time.monotonic() - start
+        self.locks.release(self.path)
+        thread.join()
+
+        self.assertLess(0.1, waited)
+
+    def test_lock_async(self):
+        async def main():
+            async def hold():
+                await self.locks.acquire_async(self.path)
+                await asyncio.sleep(0.1)
+                self.locks.release(self.path)
+
+            task = asyncio.ensure_future(hold())
+            await asyncio.sleep(0)
+            with self.assertRaises(module.FLockBusyError):
+                await self.locks.acquire_async(self.path)
+            await self.locks.acquire_async(self.path, timeout=5)
+            self.locks.release(self.path)
+            await task
+
+        asyncio.new_event_loop().run_until_complete(main())
+
+    def test_lock_error(self):
+        with self.assertRaises(module.FLockError) as ctx:
+            self.locks.acquire(self.path / "not" / "a" / "dir")
+        self.assertNotIsInstance(ctx.exception, module.FLockBusyError)
+
+    def test_holder_stale(self):
+        hostname = module.socket.gethostname()
+        self.path.write_text("123456 {} 1580000000.5\n".format(hostname))
+
+        with patch.object(module.os, "kill", side_effect=ProcessLookupError):
+            pid, _, since, alive = self.locks.holder(self.path)
+
+        self.assertEqual((pid, since, alive), (123456, 1580000000.5, False))
+        with patch.object(module.fcntl, "lockf", side_effect=BlockingIOError(11, "")):
+            with patch.object(module.os, "kill", side_effect=ProcessLookupError):
+                with self.assertRaises(module.FLockBusyError) as ctx:
+                    self.locks.acquire(self.path)
+        self.assertIn("stale", str(ctx.exception))
+
+    def test_holder_unknown(self):
+        self.assertIsNone(self.locks.holder(self.path))
+        self.path.write_text("garbage")
+        self.assertIsNone(self.locks.holder(self.path))
+
+
+class TestFairSlots(unittest.TestCase):
+    def test_limit(self):
+        slots = module.FairSlots(2)
+        slots.acquire("a")
+        slots.acquire("b")
+
+        self.assertEqual(slots.free, 0)
+        acquired = threading.Event()
+        thread = threading.Thread(target=lambda: (slots.acquire("a"), acquired.set()))
+        thread.start()
+        self.assertFalse(acquired.wait(0.05))
+
+        slots.release()
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+
+    def test_fair(self):
+        slots = module.FairSlots(1)
+        slots.acquire("a")
+        order = []
+
+        def work(group):
+            with slots.slot(group):
+                order.append(group)
+
+        threads = []
+        for group in ("a", "a", "a", "b"):
+            threads.append(threading.Thread(target=work, args=(group,)))
+            threads[-1].start()
+            # Wait for the thread to be waiting for a slot
+            while sum(slots._waiting.values()) < len(threads):
+                time.sleep(0.001)
+        slots.release()
+        for thread in threads:
+            thread.join()
+
+        # b is served as soon as one thread of a is
+        self.assertEqual(order, ["a", "b", "a", "a"])
+        self.assertEqual(slots.free, 1)
+
+
 class TestTimer(unittest.TestCase):
     def test_timer_context(self):
         with module.Timer() as timer:
@@ -102,3 +240,99 @@ class TestTimer(unittest.TestCase):
         self.assertEqual(secs, timedelta(seconds=12345))
         # No decimal part in the string repr
         self.assertNotIn(".", str(secs))
+
+
+class TestDistribution(unittest.TestCase):
+    def test_distribution(self):
+        res = module.distribution(range(100, 0, -1))
+
+        self.assertEqual(res, {"min": 1, "median": 50.5, "p95": 95})
+
+    def test_distribution_single(self):
+        res = module.distribution([2.5])
+
+        self.assertEqual(res, {"min": 2.5, "median": 2.5, "p95": 2.5})
+
+
+class TestPhases(unittest.TestCase):
+    @patch.object(module.time, "monotonic_ns")
+    def test_phases(self, m_monotonic_ns):
+        m_monotonic_ns.side_effect = (1000, 3000, 3500, 4000, 10000)
+        phases = module.Phases("queue", since=0)
+
+        phases.enter("lock")
+        phases.enter("connect")
+        self.assertFalse(phases.enter("transfer", after="lock"))
+        self.assertTrue(phases.enter("transfer", after="connect"))
+        phases.enter("connect")
+        phases.stop()
+
+        self.assertEqual(
+            list(phases.durations), ["queue", "lock", "connect", "transfer"]
+        )
+        self.assertEqual(
+            phases.durations,
+            {"queue": 1000, "lock": 2000, "connect": 6500, "transfer": 500},
+        )
+        self.assertEqual(phases.seconds()["connect"], 6.5e-6)
+        self.assertIsNone(phases.phase)
+        self.assertEqual(phases.spans[:2], [("queue", 0, 1000), ("lock", 1000, 3000)])
+        self.assertEqual(phases.spans[-1], ("connect", 4000, 10000))
+
+    def test_phases_monotonic(self):
+        phases = module.Phases("sleep")
+        time.sleep(0.05)
+        phases.stop()
+
+        self.assertLess(0.04, phases.seconds()["sleep"])
+
+    def test_aggregate(self):
+        res = module.Phases.aggregate(
+            [{"lock": 1.0, "connect": 2.0}, {"lock": 3.0}, {"lock": 2.0}, {}]
+        )
+
+        self.assertEqual(
+            res,
+            {
+                "lock": {"min": 1.0, "median": 2.0, "p95": 3.0},
+                "connect": {"min": 2.0, "median": 2.0, "p95": 2.0},
+            },
+        )
+
+    def test_aggregate_empty(self):
+        self.assertEqual(module.Phases.aggregate([]), {})
+
+
+class TestRunCommand(unittest.TestCase):
+    def test_run_command(self):
+        lines = []
+
+        p = module.run_command(
+            ["sh", "-c", "echo out1; echo err1 >&2; echo out2"],
+            on_line=lambda name, line: lines.append((name, line)),
+        )
+
+        self.assertEqual(p.returncode, 0)
+        self.assertEqual(p.stdout, "out1\nout2\n")
+        self.assertEqual(p.stderr, "err1\n")
+        self.assertEqual(
+            sorted(lines),
+            [("stderr", "err1\n"), ("stdout", "out1\n"), ("stdout", "out2\n")],
+        )
+
+    def test_run_command_error(self):
+        with self.assertRaises(module.subprocess.CalledProcessError) as ctx:
+            module.run_command(["sh", "-c", "echo out; echo err >&2; exit 3"])
+
+        self.assertEqual(ctx.exception.returncode, 3)
+        self.assertEqual(ctx.exception.stdout, "out\n")
+        self.assertEqual(ctx.exception.stderr, "err\n")
+
+    def test_run_command_timeout(self):
+        start = time.monotonic()
+        with self.assertRaises(module.subprocess.TimeoutExpired) as ctx:
+            module.run_command(["sh", "-c", "echo out; exec sleep 10"], timeout=0.2)
+
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(ctx.exception.timeout, 0.2)
+        self.assertEqual(ctx.exception.stdout, "out\n")
@@ -0,0 +1,155 @@
+import unittest
+from unittest.mock import Mock
+
+from datetime import timedelta
+from pathlib import Path
+import tempfile
+
+from qb.backup._utils import LockManager
+import qb.backup.workqueue as module
+
+
+class Host:
+    def __init__(self, hostname):
+        self.hostname = hostname
+
+
+def backuper(*results):
+    """ Mockup for a Backuper after a run. """
+    b = Mock()
+    b.results = [
+        {"hostname": h, "status": s, "duration": 1.0, "phases": {"connect": i}}
+        for i, (h, s) in enumerate(results, 1)
+    ]
+    succeeded = sum(s == "SUCCEEDED" for _, s in results)
+    b.summary = {
+        "SUCCEEDED": succeeded,
+        "FAILED": len(results) - succeeded,
+        "SKIPPED": 0,
+        "TOTAL": len(results),
+        "RUNTIME": timedelta(seconds=len(results)),
+        "STATUS": "success" if succeeded == len(results) else "failure",
+    }
+    return b
+
+
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = Path(self._tmp.name)
+        self.hosts = [Host("foo.test"), Host("bar.test"), Host("baz.test")]
+        self.locks = LockManager()
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def queue(self, run="run0", worker="w0"):
+        return module.WorkQueue(self.tmp, run=run, worker=worker, locks=self.locks)
+
+    def test_claim_all(self):
+        queue = self.queue()
+
+        res = []
+        for host in queue.claim(self.hosts):
+            res.append(host.hostname)
+            queue.release(host)
+
+        self.assertEqual(res, ["foo.test", "bar.test", "baz.test"])
+        for hostname in res:
+            self.assertEqual((queue.done / hostname).read_text(), "w0\n")
+        self.assertEqual(self.locks.held(), [])
+
+    def test_claim_busy(self):
+        w0 = self.queue(worker="w0")
+        w1 = self.queue(worker="w1")
+
+        claimed = w0.claim(self.hosts)
+        first = next(claimed)
+        res = [h.hostname for h in w1.claim(self.hosts)]
+
+        # foo.test is claimed by w0, w1 claims the others
+        self.assertEqual(first.hostname, "foo.test")
+        self.assertEqual(res, ["bar.test", "baz.test"])
+        self.assertEqual(list(claimed), [])
+
+    def test_claim_skip_done(self):
+        w0 = self.queue(worker="w0")
+        w1 = self.queue(worker="w1")
+
+        for host in w0.claim(self.hosts[:2]):
+            w0.release(host)
+        res = [h.hostname for h in w1.claim(self.hosts)]
+
+        self.assertEqual(res, ["baz.test"])
+
+    def test_claim_all_done(self):
+        w0 = self.queue(worker="w0")
+        w1 = self.queue(worker="w1")
+        for host in w0.claim(self.hosts):
+            w0.release(host)
+
+        with self.assertLogs("qb.backup", "WARNING") as logs:
+            res = list(w1.claim(self.hosts))
+
+        self.assertEqual(res, [])
+        self.assertIn("run0", logs.output[0])
+
+    def test_claim_other_run(self):
+        w0 = self.queue(run="run0")
+        w1 = self.queue(run="run1")
+
+        list(w0.claim(self.hosts))
+        res = list(w1.claim(self.hosts))
+
+        self.assertEqual(len(res), 3)
+
+    def test_claim_done_meanwhile(self):
+        queue = self.queue()
+        locks = Mock(wraps=self.locks)
+        queue.locks = locks
+        # Another worker finishes the backup while the lock is being taken
+        def acquire(path):
+            self.locks.acquire(path)
+            (queue.done / path.name).touch()
+
+        locks.acquire.side_effect = acquire
+
+        res = list(queue.claim(self.hosts))
+
+        self.assertEqual(res, [])
+        self.assertEqual(self.locks.held(), [])
+
+    def test_report_merge(self):
+        w0 = module.WorkQueue(self.tmp, run="run0", worker="w0")
+        w1 = module.WorkQueue(self.tmp, run="run0", worker="w1")
+
+        w0.report(backuper(("foo.test", "SUCCEEDED"), ("bar.test", "FAILED")))
+        w1.report(backuper(("baz.test", "SUCCEEDED")))
+        report = module.WorkQueue.merge(w0.load_reports())
+
+        self.assertEqual(report["workers"], ["w0", "w1"])
+        self.assertEqual(len(report["results"]), 3)
+        self.assertEqual(report["summary"]["SUCCEEDED"], 2)
+        self.assertEqual(report["summary"]["FAILED"], 1)
+        self.assertEqual(report["summary"]["TOTAL"], 3)
+        self.assertEqual(report["summary"]["RUNTIME"], timedelta(seconds=2))
+        self.assertEqual(report["summary"]["STATUS"], "failure")
+        # Computed over the results of all workers
+        self.assertEqual(
+            report["summary"]["PHASES"], {"connect": {"min": 1, "median": 1, "p95": 2}}
+        )
+
+    def test_merge_unclaimed(self):
+        w0 = self.queue(worker="w0")
+        w1 = self.queue(worker="w1")
+
+        # w0 dies after claiming foo.test, the other hosts are done by w1
+        next(w0.claim(self.hosts))
+        for host in w1.claim(self.hosts):
+            w1.release(host)
+        w1.report(backuper(("bar.test", "SUCCEEDED"), ("baz.test", "SUCCEEDED")))
+        report = module.WorkQueue.merge(w1.load_reports())
+
+        self.assertEqual(report["summary"]["TOTAL"], 3)
+        self.assertEqual(report["summary"]["SKIPPED"], 1)
+        self.assertEqual(report["summary"]["UNCLAIMED"], ["foo.test"])